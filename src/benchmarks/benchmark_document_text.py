@@ -0,0 +1,64 @@
+#Compare the text embedded for each movie with the previous format (json of the whole csv row) and the profiles of
+#utils/document_text.py: average tokens per document, total tokens of the dataset and the ingestion throughput with
+#a simulated embedding call whose latency grows with the number of tokens. Bedrock is not called.
+#
+#usage: python benchmark_document_text.py --csv ../../dataset/movies_metadata_small.csv --call-ms 40 --ms-per-1k-tokens 20
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+
+#adding our utils library to sys path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils import document_text
+
+#rows of the csv file as strings (as read by the ingestion of notebook 2), or synthetic movies
+def load_rows(path, count):
+    if path:
+        with open(path) as csv_file:
+            return list(csv.DictReader(csv_file))[:count]
+
+    from service import standins
+    rows = []
+    for movie in standins.load_movies(count):
+        rows.append({key: ", ".join(value) if isinstance(value, list) else str(value) for key, value in movie.items()})
+    return rows
+
+def run(rows, profile, args):
+    builder = document_text.DocumentTextBuilder(profile)
+
+    start = time.time()
+    texts = [builder.build(row) for row in rows]
+    build_seconds = time.time() - start
+
+    #simulated sequential ingestion: one embedding call per movie
+    stats = builder.stats()
+    simulated_seconds = sum(args.call_ms + document_text.context_builder.estimate_tokens(text) * args.ms_per_1k_tokens / 1000 for text in texts) / 1000
+    return {
+        "avg_tokens_per_document": round(stats["avg_tokens_per_document"], 1),
+        "total_tokens": stats["tokens"],
+        "build_us_per_document": build_seconds / len(rows) * 1e6,
+        "simulated_ingestion_documents_per_second": len(rows) / simulated_seconds,
+        "example": texts[0][:300],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the document text profiles used for the embeddings")
+    parser.add_argument("--csv", help="movies csv file, synthetic movies otherwise")
+    parser.add_argument("--count", type=int, default=1000)
+    parser.add_argument("--call-ms", type=float, default=40, help="simulated fixed latency of an embedding call")
+    parser.add_argument("--ms-per-1k-tokens", type=float, default=20, help="simulated latency per 1000 input tokens")
+    args = parser.parse_args()
+
+    rows = load_rows(args.csv, args.count)
+    results = {profile: run(rows, profile, args) for profile in document_text.text_profiles}
+    baseline = results["json"]["total_tokens"]
+    for profile in results:
+        results[profile]["tokens_vs_json"] = round(results[profile]["total_tokens"] / baseline, 3)
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
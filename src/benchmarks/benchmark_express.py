@@ -0,0 +1,130 @@
+#Compare the end-to-end latency of a conversation turn run by Step Functions (simulated: state transition, lambda invoke
+#and json serialization at every hop) with the in-process express mode (src/service/express.py), without and with speculation.
+#Bedrock and OpenSearch are replaced by the local stand-ins of src/service/standins.py, no AWS service is called.
+#
+#usage: python benchmark_express.py --turns 200 --transition-ms 25 --invoke-ms 15
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+
+#adding our utils library to sys path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+#share of the turns per routing category: specific, standard, semantic, similar, open
+category_mix = {"category_1": 0.1, "category_2": 0.2, "category_3": 0.5, "category_4": 0.1, "category_5": 0.1}
+
+tool_list_standard = [{"toolSpec": {"name": "standard_search", "description": "filters of the search",
+                                    "inputSchema": {"json": {"type": "object", "properties": {"genres": {"type": "string"}}}}}}]
+tool_list_sort = [{"toolSpec": {"name": "sort", "description": "property to sort the movies",
+                                "inputSchema": {"json": {"type": "object", "properties": {"sort_by": {"type": "string", "enum": ["popularity", "year", "vote_average"]}}}}}}]
+
+#state machine of notebooks/3-notebook_step_functions.ipynb against the stand-in opensearch
+def build_definition(host, index_name):
+    search = {"index_name": index_name, "os_host": host, "number_results": 10}
+    routing = {"question.$": "$.routing_step_output.question", "deadline.$": "$.routing_step_output.deadline"}
+    history = {"history.$": "$.routing_step_output.history"}
+    return {
+        "StartAt": "routing_step",
+        "States": {
+            "routing_step": {"Type": "Task", "ResultPath": "$.routing_step_output", "Next": "choice_state"},
+            "choice_state": {
+                "Type": "Choice",
+                "Choices": [
+                    {"Variable": "$.routing_step_output.category", "StringEquals": "category_1", "Next": "specific_question_step"},
+                    {"Variable": "$.routing_step_output.category", "StringEquals": "category_2", "Next": "standard_search"},
+                    {"Variable": "$.routing_step_output.category", "StringEquals": "category_3", "Next": "semantic_search"},
+                    {"Variable": "$.routing_step_output.category", "StringEquals": "category_4", "Next": "similar_step"},
+                    {"Variable": "$.routing_step_output.category", "StringEquals": "category_5", "Next": "open_question_step"},
+                ],
+                "Default": "default_step"
+            },
+            "semantic_search": {"Type": "Task", "ResultPath": "$.search_output", "Next": "sorting_step",
+                                "Parameters": {**routing, **search, "system_prompt": "OPTIMISE", "filter_mode": "efficient", "projection": "list"}},
+            "standard_search": {"Type": "Task", "ResultPath": "$.search_output", "Next": "sorting_step",
+                                "Parameters": {**routing, **search, "system_prompt": "STANDARD", "tool_list": tool_list_standard, "projection": "list"}},
+            "similar_step": {"Type": "Task", "ResultPath": "$.search_output", "Next": "sorting_step",
+                             "Parameters": {**routing, **history, **search, "projection": "list"}},
+            "sorting_step": {"Type": "Task", "End": True,
+                             "Parameters": {"question.$": "$.search_output.question", "tool_list": tool_list_sort, "system_prompt": "SORT",
+                                            "list_to_sort.$": "$.search_output.search_output", "result_ref.$": "$.search_output.result_ref",
+                                            "deadline.$": "$.routing_step_output.deadline", "fallbacks.$": "$.search_output.fallbacks"}},
+            "specific_question_step": {"Type": "Task", "End": True,
+                                       "Parameters": {**routing, **history, "index_name": index_name, "os_host": host,
+                                                      "system_prompt_specific": "Answer about the movie <document>{context}</document>"}},
+            "open_question_step": {"Type": "Task", "End": True, "Parameters": {**routing, **history, "system_prompt_open": "OPEN"}},
+            "default_step": {"Type": "Fail", "Cause": "Unexpected output value"}
+        }
+    }
+
+#the stand-in routing answers with the category written in the question
+def responder(system_prompt, question):
+    if system_prompt == "ROUTER":
+        match = re.search(r"category_\d", question)
+        return f"<answer>{match.group(0)}</answer>" if match else None
+    return None
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the express mode against simulated Step Functions")
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--transition-ms", type=float, default=25, help="simulated Step Functions state transition per task")
+    parser.add_argument("--invoke-ms", type=float, default=15, help="simulated lambda invoke overhead per task")
+    args = parser.parse_args()
+
+    os.environ.setdefault("STANDIN_SLOW_PROBABILITY", "0")
+    from service import app as service_app
+    from service import express
+    from service import standins
+    from utils import llm_utils
+
+    standins.install(responder=responder)
+    handlers = {route: service_app.load_handler(route) for route in ["routing", "semantic", "standard", "similar", "specific", "open", "sorting"]}
+    standins.install_handlers(handlers.values())
+    definition = build_definition(standins.standin_host, standins.standin_index)
+
+    #Step Functions: every task is a state transition and a lambda invoke, the event and the result are serialized
+    class SimulatedStepFunctions(express.ExpressOrchestrator):
+        def invoke_task(self, state_name, event):
+            time.sleep((args.transition_ms + args.invoke_ms) / 1000)
+            result = super().invoke_task(state_name, json.loads(json.dumps(event)))
+            return json.loads(json.dumps(result))
+
+    generator = random.Random(0)
+    categories = generator.choices(list(category_mix), weights=list(category_mix.values()), k=args.turns)
+
+    modes = {
+        "step_functions_simulated": SimulatedStepFunctions(definition, handlers, speculate="off"),
+        "express": express.ExpressOrchestrator(definition, handlers, speculate="off"),
+        "express_prefetch_embedding": express.ExpressOrchestrator(definition, handlers, speculate="embedding"),
+        "express_speculative_branch": express.ExpressOrchestrator(definition, handlers, speculate="branch"),
+    }
+
+    results = {}
+    for name, orchestrator in modes.items():
+        llm_utils.embedding_cache.clear()
+        latencies = []
+        for i, category in enumerate(categories):
+            execution_input = {"question": f"{name} question {i} {category}", "history": [], "system_prompt": "ROUTER", "prefill": "", "time_budget_ms": 25000}
+            start = time.time()
+            orchestrator.run(execution_input)
+            latencies.append(time.time() - start)
+        results[name] = {
+            "mean_ms": sum(latencies) / len(latencies) * 1000,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+        }
+        if orchestrator.speculate != "off":
+            results[name]["speculation"] = orchestrator.stats()
+
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
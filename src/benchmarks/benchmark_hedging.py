@@ -0,0 +1,71 @@
+#Compare the latency percentiles of a simulated call with and without request hedging.
+#The call sleeps for a fast latency most of the time and for a slow latency with a small probability,
+#like the occasional slow OpenSearch searches and Bedrock embedding calls. No AWS service is called.
+#
+#usage: python benchmark_hedging.py --requests 2000 --slow-probability 0.03
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+#adding our utils library to sys path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils import hedging
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def run(requests, call):
+    latencies = []
+    for _ in range(requests):
+        start = time.time()
+        call()
+        latencies.append(time.time() - start)
+    return {
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the request hedging on a simulated call with a slow tail")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--fast-ms", type=float, default=20)
+    parser.add_argument("--slow-ms", type=float, default=400)
+    parser.add_argument("--slow-probability", type=float, default=0.03)
+    parser.add_argument("--percentile", type=float, default=95)
+    parser.add_argument("--max-ratio", type=float, default=0.05)
+    args = parser.parse_args()
+
+    attempts = {"count": 0}
+    lock = threading.Lock()
+
+    #simulated call, the latency of each attempt is drawn independently
+    def simulated_call():
+        with lock:
+            attempts["count"] += 1
+        slow = random.random() < args.slow_probability
+        latency = args.slow_ms if slow else args.fast_ms * random.uniform(0.8, 1.2)
+        time.sleep(latency / 1000)
+        return latency
+
+    random.seed(0)
+    baseline = run(args.requests, simulated_call)
+
+    random.seed(0)
+    attempts["count"] = 0
+    hedger = hedging.Hedger("benchmark", percentile=args.percentile, max_ratio=args.max_ratio)
+    hedged = run(args.requests, lambda: hedger.call(simulated_call))
+    hedged["extra_requests_ratio"] = attempts["count"] / args.requests - 1
+    hedged.update(hedger.stats())
+
+    print(json.dumps({"baseline": baseline, "hedged": hedged}, indent=2))
+
+if __name__ == "__main__":
+    main()
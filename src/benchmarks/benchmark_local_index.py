@@ -0,0 +1,117 @@
+#Compare the latency of the standard search with the in-process inverted index (utils/local_index.py) and with OpenSearch.
+#Without --os-host only the local index is measured, on the movies file (MOVIES_CACHE_PATH json lines) or on synthetic movies.
+#With --os-host the same queries are sent to the index and the overlap of the results with the local index is reported.
+#
+#usage: python benchmark_local_index.py --movies ../../dataset/movies.jsonl --os-host <id>.us-east-1.aoss.amazonaws.com --index movies-index
+
+import argparse
+import json
+import os
+import sys
+import time
+
+#adding our utils library to sys path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils import llm_utils
+from utils import local_index
+
+data_columns = llm_utils.projection_profiles["full"]
+
+#shapes of the standard search: values taken from the catalog so that the queries have results
+def build_queries(movies):
+    movie = max(movies, key=lambda movie: movie.get("popularity") or 0)
+    genres = llm_utils.split_list_value(movie["genres"])
+    actors = llm_utils.split_list_value(movie["actors"])
+    director = llm_utils.split_list_value(movie["director"])[0]
+    keyword = llm_utils.split_list_value(movie["keywords"])[0]
+    return [
+        [{"genres": genres[0]}],
+        [{"year": "1990s"}],
+        [{"director": director}],
+        [{"actors": actors[0]}],
+        [{"actors": str(actors[:2])}],
+        [{"genres": genres[0]}, {"year": [1980, 2010]}],
+        [{"original_language": "en"}, {"keywords": keyword}],
+        [{"genres": str(genres[:2])}, {"vote_average_bins": movie["vote_average_bins"]}],
+    ]
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def measure(search, queries, iterations):
+    latencies = []
+    results = []
+    for _ in range(iterations):
+        for query in queries:
+            start = time.perf_counter()
+            result = search(query)
+            latencies.append(time.perf_counter() - start)
+        results = [search(query) for query in queries]
+    return {
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+    }, results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the local inverted index against OpenSearch for the standard search")
+    parser.add_argument("--movies", default=os.environ.get("MOVIES_CACHE_PATH"), help="movies json lines, synthetic movies otherwise")
+    parser.add_argument("--count", type=int, default=45000, help="number of synthetic movies")
+    parser.add_argument("--os-host")
+    parser.add_argument("--index", default="movies-index")
+    parser.add_argument("--region")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.movies:
+        movies = list(llm_utils.load_movies_cache(args.movies).values())
+    else:
+        from service import standins
+        movies = standins.load_movies(args.count)
+
+    start = time.time()
+    index = local_index.LocalIndex(movies)
+    build_seconds = time.time() - start
+
+    queries = build_queries(movies)
+
+    def search_local(prop_value_list):
+        query = llm_utils.compile_standard_query(prop_value_list, data_columns, k=args.k, schema=llm_utils.index_schema,
+                                                 source=llm_utils.get_source_filter("list", data_columns))
+        return index.search(query)
+
+    local_stats, local_results = measure(search_local, queries, args.iterations)
+    results = {
+        "movies": len(index),
+        "build_seconds": round(build_seconds, 2),
+        "local_index": local_stats,
+        "hits_per_query": [len(result) for result in local_results],
+    }
+
+    if args.os_host:
+        import boto3
+        from opensearchpy import AWSV4SignerAuth
+
+        credentials = boto3.Session().get_credentials()
+        auth = AWSV4SignerAuth(credentials, args.region or boto3.session.Session().region_name, 'aoss')
+        os_client = llm_utils.connect_to_aoss(auth, args.os_host)
+        schema = llm_utils.get_index_schema(os_client, args.index)
+
+        def search_opensearch(prop_value_list):
+            return llm_utils.standard_query_opensearch(prop_value_list, os_client, args.index, data_columns, k=args.k, schema=schema, projection="list")
+
+        results["opensearch"], os_results = measure(search_opensearch, queries, args.iterations)
+
+        #share of the opensearch results also returned by the local index (ties on popularity can be ordered differently)
+        overlaps = []
+        for local_result, os_result in zip(local_results, os_results):
+            os_ids = set(doc["tmdb_id"] for doc in os_result)
+            overlaps.append(len(os_ids & set(doc["tmdb_id"] for doc in local_result)) / len(os_ids) if os_ids else 1.0)
+        results["result_overlap"] = overlaps
+
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
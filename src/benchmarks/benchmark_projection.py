@@ -0,0 +1,102 @@
+#Measure the response size and the deserialization time of the search queries of each route
+#for each _source projection profile (see llm_utils.projection_profiles).
+#"none" is the query without any _source filter, as sent by standard_query_opensearch before the projection profiles.
+#
+#usage: python benchmark_projection.py --os-host <id>.us-east-1.aoss.amazonaws.com --index-name movies-index
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+import boto3
+from opensearchpy import (
+    AWSV4SignerAuth
+)
+
+#adding our utils library to sys path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils import llm_utils
+
+data_columns = llm_utils.projection_profiles["full"]
+
+#route -> (query type, inputs, k)
+routes = {
+    "semantic": ("knn", ["movies based on historical biographies of sport figures", "scifi in space or another planet"], 10),
+    "similar": ("knn", ["Avatar science fiction pandora marine", "Minions animation family comedy"], 11),
+    "standard": ("standard", [[{"actors": "Tom Cruise"}], [{"director": "James Cameron"}]], 10),
+    "specific": ("standard", [[{"original_title": "Avatar"}], [{"original_title": "Spectre"}]], 1),
+}
+
+profiles = ["none", "full", "list", "titles", "ids"]
+
+#build the query body of a route for a profile
+def build_query(query_type, query_input, k, profile, embeddings):
+    source = None if profile == "none" else llm_utils.get_source_filter(profile, data_columns)
+
+    if query_type == "standard":
+        query = json.loads(llm_utils.compile_standard_query(query_input, data_columns, k=k, source=source))
+        return query
+
+    query = {
+        "size": k,
+        "query": {"knn": {"vector_index": {"vector": embeddings[query_input], "k": k}}}
+    }
+    if source:
+        query["_source"] = source
+    return query
+
+#send the query and return the raw response size in bytes and the json deserialization time in ms
+def measure(os_client, index_name, query):
+    connection = os_client.transport.get_connection()
+    _, _, raw = connection.perform_request("POST", f"/{index_name}/_search", body=json.dumps(query).encode("utf-8"))
+
+    start = time.perf_counter()
+    response = json.loads(raw)
+    deserialization_ms = (time.perf_counter() - start) * 1000
+
+    return len(raw.encode("utf-8")), deserialization_ms, response["took"]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the _source projection profiles per route")
+    parser.add_argument("--os-host", required=True)
+    parser.add_argument("--index-name", default="movies-index")
+    parser.add_argument("--region", default=boto3.session.Session().region_name)
+    parser.add_argument("--iterations", type=int, default=10)
+    args = parser.parse_args()
+
+    credentials = boto3.Session().get_credentials()
+    auth = AWSV4SignerAuth(credentials, args.region, 'aoss')
+    os_client = llm_utils.connect_to_aoss(auth, args.os_host)
+
+    #embeddings are computed once so that bedrock is not part of the measure
+    embeddings = {}
+    for query_type, inputs, _ in routes.values():
+        if query_type == "knn":
+            for question in inputs:
+                embeddings[question] = llm_utils.get_embeddings_from_text(question, "cohere", input_type="search_query")
+
+    results = {}
+    for route, (query_type, inputs, k) in routes.items():
+        results[route] = {}
+        for profile in profiles:
+            sizes, deserialization, took = [], [], []
+            for _ in range(args.iterations):
+                for query_input in inputs:
+                    size, deserialization_ms, took_ms = measure(os_client, args.index_name, build_query(query_type, query_input, k, profile, embeddings))
+                    sizes.append(size)
+                    deserialization.append(deserialization_ms)
+                    took.append(took_ms)
+
+            results[route][profile] = {
+                "response_bytes_mean": statistics.mean(sizes),
+                "deserialization_ms_mean": statistics.mean(deserialization),
+                "took_ms_p50": statistics.median(took),
+            }
+
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#Compare the rendering time of the precompiled PromptTemplate (single join over the parsed segments)
+#with the previous implementation (one str.replace over the whole template per variable).
+#Bedrock and OpenSearch are not called.
+#
+#usage: python benchmark_prompt_template.py --iterations 20000
+
+import argparse
+import json
+import os
+import sys
+import timeit
+
+#adding our utils library to sys path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils import llm_utils
+
+#template similar to the main prompt of the ConversationalRetrievalChain, with a long static part
+main_template = """You are a movie finder assistant. Use the documents in <context> tags to answer the question in <question> tags.
+If the documents do not contain the answer, say that you do not know.
+""" + "\n".join(f"<example>\n<question>example question {i}</question>\n<answer>example answer {i}</answer>\n</example>" for i in range(20)) + """
+<chat_history>
+{chat_history}
+</chat_history>
+<context>
+{context}
+</context>
+<question>{question}</question>
+"""
+
+input_variables = ["chat_history", "context", "question"]
+
+values = {
+    "chat_history": "Question 1: list movies from Tom Cruise\nAnswer 1: The Mummy, Edge of Tomorrow\n",
+    "context": "\n".join(f"<document>\noriginal_title: movie {i}\nyear: 2010\ndescription: {'word ' * 60}\n</document>" for i in range(10)),
+    "question": "which one is the most popular?",
+}
+
+#previous implementation of PromptTemplate.format_prompt
+def legacy_format_prompt(template, input_variables, prefill="", **kwargs):
+    prompt = template
+    for var in input_variables:
+        prompt = prompt.replace("{" + var + "}", str(kwargs[var]))
+    return prompt + "\n" + prefill
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the precompiled PromptTemplate rendering")
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    template = llm_utils.PromptTemplate(input_variables, main_template, prefill="<answer>")
+
+    #both implementations must render the same prompt
+    assert template.format_prompt(**values) == legacy_format_prompt(main_template, input_variables, prefill="<answer>", **values)
+
+    legacy = timeit.timeit(lambda: legacy_format_prompt(main_template, input_variables, prefill="<answer>", **values), number=args.iterations)
+    compiled = timeit.timeit(lambda: template.format_prompt(**values), number=args.iterations)
+    compile_time = timeit.timeit(lambda: llm_utils.PromptTemplate(input_variables, main_template, prefill="<answer>"), number=1000) / 1000
+    estimate = timeit.timeit(lambda: template.estimate_tokens(**values), number=args.iterations)
+
+    results = {
+        "template_chars": len(main_template),
+        "legacy_render_us": legacy / args.iterations * 1e6,
+        "compiled_render_us": compiled / args.iterations * 1e6,
+        "speedup": legacy / compiled,
+        "compile_once_us": compile_time * 1e6,
+        "estimate_tokens_us": estimate / args.iterations * 1e6,
+        "estimated_tokens": template.estimate_tokens(**values),
+    }
+
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+#Measure the upstream calls saved by the single-flight coalescing when many requests for the same trending
+#queries arrive at the same time in a long-running process (see src/service). The upstream call is simulated,
+#no AWS service is called.
+#
+#usage: python benchmark_single_flight.py --requests 2000 --threads 64 --queries 20
+
+import argparse
+import concurrent.futures
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+#adding our utils library to sys path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils import single_flight
+
+def run(args, enabled):
+    upstream = {"calls": 0}
+    lock = threading.Lock()
+
+    #simulated embedding call
+    def upstream_call(query):
+        with lock:
+            upstream["calls"] += 1
+        time.sleep(args.latency_ms / 1000)
+        return [len(query)] * 16
+
+    #queries drawn from a skewed distribution, a few trending queries get most of the traffic
+    generator = random.Random(0)
+    weights = [1 / (rank + 1) for rank in range(args.queries)]
+    queries = generator.choices([f"query {i}" for i in range(args.queries)], weights=weights, k=args.requests)
+
+    def request(query):
+        start = time.time()
+        single_flight.call("benchmark", query, lambda: upstream_call(query), enabled=enabled)
+        return time.time() - start
+
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.threads) as executor:
+        latencies = list(executor.map(request, queries))
+    elapsed = time.time() - start
+
+    return {
+        "upstream_calls": upstream["calls"],
+        "upstream_calls_per_request": upstream["calls"] / args.requests,
+        "mean_latency_ms": sum(latencies) / len(latencies) * 1000,
+        "throughput_rps": args.requests / elapsed,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the single-flight coalescing of identical concurrent calls")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=64)
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    args = parser.parse_args()
+
+    results = {
+        "without_single_flight": run(args, False),
+        "with_single_flight": run(args, True),
+        "stats": single_flight.get_group("benchmark").stats(),
+    }
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+#Compare the server-side latency ("took") of the legacy scoring query shape (must -> match)
+#with the compiled non-scoring filter shape used by llm_utils.standard_query_opensearch.
+#
+#usage: python benchmark_standard_query.py --os-host <id>.us-east-1.aoss.amazonaws.com --index-name movies-index
+
+import argparse
+import ast
+import json
+import os
+import statistics
+import sys
+import time
+
+import boto3
+from opensearchpy import (
+    AWSV4SignerAuth
+)
+
+#adding our utils library to sys path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils import llm_utils
+
+data_columns = ['tmdb_id', 'original_language', 'original_title', 'description', 'genres', 'year', 'keywords', 'director', 'actors', 'popularity', 'popularity_bins',
+                  'vote_average', 'vote_average_bins']
+
+#typical inputs produced by the standard search tool
+benchmark_inputs = [
+    [{"actors": "['Kate Winslet', 'Leonardo DiCaprio']"}],
+    [{"actors": "Tom Cruise"}],
+    [{"director": "James Cameron"}],
+    [{"genres": "Horror", "year": "2017"}],
+    [{"genres": "['Action', 'Thriller']"}],
+    [{"director": "Christopher Nolan", "actors": "Michael Caine"}],
+    [{"original_title": "Avatar"}],
+]
+
+#query shape used before the query compiler: one scoring must/match clause per value
+def build_legacy_query(prop_value_list, data_columns, k=10):
+    query = {
+        "query": {
+            "bool": {
+                "must": []
+            }
+        },
+        "size": k,
+        "sort": [
+            {
+                "popularity": {
+                    "order": "desc"
+                }
+            }
+        ]
+    }
+
+    for elt in prop_value_list:
+        for prop, value in elt.items():
+            if prop in data_columns and isinstance(value, str):
+                value_list = ast.literal_eval(value) if "[" in value else [value]
+                for val in value_list:
+                    query["query"]["bool"]["must"].append({
+                        "match": {
+                            prop: {
+                                "query": val,
+                                "operator": "and"
+                            }
+                        }
+                    })
+    return query
+
+#percentile on a sorted list
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+#run each input `iterations` times and collect the server side and client side latencies
+def run_shape(os_client, index_name, build_query, iterations, k):
+    took = []
+    client_time = []
+    build_time = []
+
+    for _ in range(iterations):
+        for prop_value_list in benchmark_inputs:
+            start = time.perf_counter()
+            query = build_query(prop_value_list, data_columns, k)
+            build_time.append((time.perf_counter() - start) * 1000)
+
+            start = time.perf_counter()
+            response = os_client.search(body=query, index=index_name)
+            client_time.append((time.perf_counter() - start) * 1000)
+            took.append(response["took"])
+
+    return {
+        "took_p50_ms": statistics.median(took),
+        "took_p95_ms": percentile(took, 95),
+        "took_mean_ms": statistics.mean(took),
+        "client_p50_ms": statistics.median(client_time),
+        "client_p95_ms": percentile(client_time, 95),
+        "build_mean_ms": statistics.mean(build_time),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark legacy vs compiled standard search queries")
+    parser.add_argument("--os-host", required=True)
+    parser.add_argument("--index-name", default="movies-index")
+    parser.add_argument("--region", default=boto3.session.Session().region_name)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args()
+
+    credentials = boto3.Session().get_credentials()
+    auth = AWSV4SignerAuth(credentials, args.region, 'aoss')
+    os_client = llm_utils.connect_to_aoss(auth, args.os_host)
+
+    #warm up both shapes so that the first iterations are not penalised
+    run_shape(os_client, args.index_name, build_legacy_query, 1, args.k)
+    run_shape(os_client, args.index_name, lambda p, d, k: llm_utils.compile_standard_query(p, d, k=k), 1, args.k)
+
+    results = {
+        "legacy_must_match": run_shape(os_client, args.index_name, build_legacy_query, args.iterations, args.k),
+        "compiled_filter": run_shape(os_client, args.index_name, lambda p, d, k: llm_utils.compile_standard_query(p, d, k=k), args.iterations, args.k),
+    }
+
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,10 @@
 import json
 import boto3
 import os
+from utils import agent_response
 from utils import llm_utils
+from utils import profiling
+from utils import traffic_capture
 import time
 
 from opensearchpy import (
@@ -10,8 +13,14 @@ from opensearchpy import (
 
 #openAPI schema
 
+#movies returned to the agent when it does not ask for a number (max_results), and the most it can ask for.
+#the movies are read in a single search, their properties are trimmed only when they do not fit in the agent response
+default_max_results = int(os.environ.get("AGENT_MAX_RESULTS", "10"))
+max_results_limit = int(os.environ.get("AGENT_MAX_RESULTS_LIMIT", "50"))
 
 #handler
+@traffic_capture.capture("agent/movie-details")
+@profiling.profile("agent/movie-details")
 def lambda_handler(event, context):
 
     #retrieving info from the agent's request
@@ -30,10 +39,13 @@ def lambda_handler(event, context):
         raise ValueError("Invalid event format: 'parameters' key not found or not a list.")
 
     prop_value_list = []
+    max_results = default_max_results
 
     for parameter in event["parameters"]:
        if parameter['name'] == "properties":
           prop_value_list = json.loads(parameter['value'].replace("'", "\""))
+       if parameter['name'] == "max_results":
+          max_results = min(max(int(parameter['value']), 1), max_results_limit)
 
     #retrieve parameters from AWS Secret manager
     secret_value_str = llm_utils.get_secret("semantic-api", region_name)
@@ -49,29 +61,16 @@ def lambda_handler(event, context):
     #connecting to opensearch serverless
     os_client = llm_utils.connect_to_aoss(auth, os_host)
 
-    #querying opensearch
+    #querying opensearch for the first max_results movies, in a single search.
+    #they are returned with all their properties when they fit, trimmed to the titles and then fewer movies otherwise
     start_time = time.time()
-    response = llm_utils.standard_query_opensearch(prop_value_list, os_client, index_name, data_columns)
+    documents = llm_utils.stream_standard_query(prop_value_list, os_client, index_name, data_columns, page_size=max_results, max_results=max_results)
+
+    #formating response to match the agent's expectations: compact json within the size limit of the agent response
+    body, encoding_stats = agent_response.encode_movies(documents, route="agent/movie-details")
     end_time = time.time()
     execution_time = end_time - start_time
 
-    print(f"Querying OpenSearch took {execution_time:.6f} seconds.")
-
-    #formating response to match the agent's expectations
-    response_body = {
-        'application/json': {
-            'body': str(response)
-        }
-    }
-
-    action_response = {
-        'actionGroup': event['actionGroup'],
-        'apiPath': event['apiPath'],
-        'httpMethod': event['httpMethod'],
-        'httpStatusCode': 200,
-        'responseBody': response_body
-    }
-
-    response = {'response': action_response}
+    print(f"Querying OpenSearch and encoding took {execution_time:.6f} seconds, agent response: {encoding_stats}")
 
-    return response
\ No newline at end of file
+    return agent_response.action_response(event, body)
\ No newline at end of file
@@ -1,7 +1,10 @@
 import json
 import boto3
 import os
+from utils import agent_response
 from utils import llm_utils
+from utils import profiling
+from utils import traffic_capture
 import time
 
 from opensearchpy import (
@@ -63,6 +66,8 @@ from opensearchpy import (
 """
 
 #handler
+@traffic_capture.capture("agent/semantic-search")
+@profiling.profile("agent/semantic-search")
 def lambda_handler(event, context):
 
     #retrieving info from the agent's request
@@ -123,8 +128,8 @@ def lambda_handler(event, context):
       if orderby in ['rating', 'ratings']:
          orderby = "vote_average"
       
-      #sorting by descending order by default
-      response = sorted(response, key=lambda x: float(x[orderby]), reverse=True)
+      #sorting by descending order by default (numeric properties in the index, movies without value last)
+      response = llm_utils.sort_by_value(response, lambda x: x.get(orderby))
     
     # Iterate over each item in the JSON array to remove double quotes in descriptions as it is not escaped correctly when the agents is generating the final response
     for item in response:
@@ -134,24 +139,8 @@ def lambda_handler(event, context):
 
     #print(f"response after the sort:{response}")
           
-    #format the response for the agents
-    formated_response = llm_utils.generate_json_response(response)
+    #format the response for the agents: compact json within the size limit of the agent response
+    body, encoding_stats = agent_response.encode_movies(response, route="agent/semantic-search")
+    print(f"agent response: {encoding_stats}")
 
-    #formating response to match the agent's expectations
-    response_body = {
-        'application/json': {
-            'body': str(formated_response)
-        }
-    }
-
-    action_response = {
-        'actionGroup': event['actionGroup'],
-        'apiPath': event['apiPath'],
-        'httpMethod': event['httpMethod'],
-        'httpStatusCode': 200,
-        'responseBody': response_body
-    }
-
-    response = {'response': action_response}
-
-    return response
\ No newline at end of file
+    return agent_response.action_response(event, body)
\ No newline at end of file
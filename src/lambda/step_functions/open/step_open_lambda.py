@@ -1,8 +1,13 @@
 import json
 import boto3
 import re
-import copy
+import os
 import traceback
+from utils import deadline
+from utils import prompt_cache
+from utils import session_store
+from utils import profiling
+from utils import traffic_capture
 
 import logging
 logger = logging.getLogger()
@@ -20,13 +25,14 @@ def extract_answer(text, tag="answer"):
     else:
         return None
 
-#converse API call
-def converse_api_call_no_tool(question, history_list, system_prompt, bedrock_client, model_id="anthropic.claude-3-haiku-20240307-v1:0"):
+#converse API call, timeout in seconds
+def converse_api_call_no_tool(question, history_list, system_prompt, bedrock_client, model_id="anthropic.claude-3-haiku-20240307-v1:0", timeout=None):
     
     messages = []
 
     if history_list:
-        messages = copy.deepcopy(history_list)
+        #messages are not modified, a shallow copy is enough
+        messages = list(history_list)
     
     user_message = {
         "role": "user",
@@ -36,7 +42,8 @@ def converse_api_call_no_tool(question, history_list, system_prompt, bedrock_cli
     }
     messages.append(user_message)
 
-    response = bedrock_client.converse(
+    response = prompt_cache.converse(
+        bedrock_client,
         modelId=model_id,
         messages=messages,
         inferenceConfig={
@@ -44,7 +51,9 @@ def converse_api_call_no_tool(question, history_list, system_prompt, bedrock_cli
             "temperature": 0,
             "topP": 1
         },
-        system=[{"text": json.dumps(system_prompt)}]
+        system_prompt=system_prompt,
+        route="open",
+        timeout=timeout
     )
     
     #extract message
@@ -55,6 +64,8 @@ def converse_api_call_no_tool(question, history_list, system_prompt, bedrock_cli
 
 
 #handler
+@traffic_capture.capture("open")
+@profiling.profile("open")
 def lambda_handler(event, context):
 
     #retrieve parameters
@@ -62,19 +73,31 @@ def lambda_handler(event, context):
     system_prompt_open = event.get('system_prompt_open', '')
     history_list = event.get('history', [])
     model_id = event.get('model_id', 'anthropic.claude-3-haiku-20240307-v1:0')
+    #when a session store is set (dynamodb://table or sqlite://path), the history is loaded from the session instead of the event
+    session_id = event.get('session_id', '')
+    session_store_uri = event.get('session_store', os.environ.get('SESSION_STORE_URI', ''))
+    history_window = event.get('history_window', session_store.default_window)
+    history_token_budget = event.get('history_token_budget', session_store.default_token_budget)
+    use_session = bool(session_store_uri and session_id)
+    #deadline of the turn, created by the routing step
+    request_deadline = deadline.Deadline.from_event(event, context)
     
     #final output message
     output_message = ""
     status_code = 200
 
     try:
+        if use_session:
+            store = session_store.get_session_store(session_store_uri)
+            history_list = session_store.load_window(store, session_id, max_turns=history_window)
 
         #------ DEBUG ---------
         logger.debug(f"history list:{history_list}")
         logger.debug(f"system_prompt_open:{system_prompt_open}")
 
         #calling the LLM
-        response_llm = converse_api_call_no_tool(question, history_list, system_prompt_open, bedrock_client, model_id=model_id)
+        response_llm = converse_api_call_no_tool(question, history_list, system_prompt_open, bedrock_client, model_id=model_id,
+                                                 timeout=request_deadline.timeout(deadline.call_timeouts["llm"]))
         #extract answer from xml tag
         output_message = extract_answer(response_llm)
         
@@ -90,10 +113,22 @@ def lambda_handler(event, context):
             'statusCode': 500,
             'message': str(e),
             'search_output': [],
+            'fallbacks': request_deadline.fallbacks
         }
 
+    #the exchange is added to the session once the answer is known, a failure does not fail the answer
+    if use_session and status_code == 200:
+        try:
+            store = session_store.get_session_store(session_store_uri)
+            session_store.record_exchange(store, session_id, question, session_store.format_answer(output_message),
+                                          session_store.bedrock_summarizer(bedrock_client), token_budget=history_token_budget,
+                                          deadline=request_deadline, route="open")
+        except Exception as e:
+            logger.error(f"Could not record the exchange in session {session_id}: {e}")
+
     return {
             'statusCode': status_code,
             'message': json.dumps(output_message),
             'search_output': [],
+            'fallbacks': request_deadline.fallbacks
         }
\ No newline at end of file
@@ -1,6 +1,12 @@
 import json
 import boto3
+import os
 import re
+from utils import deadline
+from utils import prompt_cache
+from utils import session_store
+from utils import profiling
+from utils import traffic_capture
 
 import logging
 logger = logging.getLogger()
@@ -19,6 +25,8 @@ def extract_answer(text, tag="answer"):
         return None
 
 #handler
+@traffic_capture.capture("routing")
+@profiling.profile("routing")
 def lambda_handler(event, context):
 
     question = event.get('question', '')
@@ -26,8 +34,19 @@ def lambda_handler(event, context):
     system_prompt = event.get('system_prompt', '')
     prefill = event.get('prefill', '')
     model_id = event.get('model_id', 'anthropic.claude-3-haiku-20240307-v1:0')
+    #when a session store is set (dynamodb://table or sqlite://path), the history is loaded from the session instead of the event
+    session_id = event.get('session_id', '')
+    session_store_uri = event.get('session_store', os.environ.get('SESSION_STORE_URI', ''))
+    #the routing only needs the last exchanges to categorise the question
+    history_window = event.get('history_window', 4)
+    use_session = bool(session_store_uri and session_id)
+    #the deadline of the whole turn is created here (from the deadline or time_budget_ms of the event) and passed to the next states
+    request_deadline = deadline.Deadline.from_event(event, context, budget_ms=deadline.default_budget_ms)
 
     try:
+        if use_session:
+            store = session_store.get_session_store(session_store_uri)
+            history_list = session_store.load_window(store, session_id, max_turns=history_window)
 
         user_message = {
             "role": "user",
@@ -47,7 +66,8 @@ def lambda_handler(event, context):
             }
             history_list.append(assistant_prefill_message)
 
-        response = bedrock_client.converse(
+        response = prompt_cache.converse(
+            bedrock_client,
             modelId=model_id,
             messages=history_list,
             inferenceConfig={
@@ -55,7 +75,9 @@ def lambda_handler(event, context):
                 "temperature": 0,
                 "topP": 1
             },
-            system=[{"text": json.dumps(system_prompt)}]
+            system_prompt=system_prompt,
+            route="routing",
+            timeout=request_deadline.timeout(deadline.call_timeouts["llm"])
         )
 
         #extract message
@@ -76,7 +98,8 @@ def lambda_handler(event, context):
             'statusCode': 500,
             'category': "",
             'question': question,
-            'history': history_list,
+            'history': [] if use_session else history_list,
+            'deadline': request_deadline.to_event(),
             'message': json.dumps(f'Error: {e}')
         }
     
@@ -84,6 +107,8 @@ def lambda_handler(event, context):
         'statusCode': 200,
         'category': extracted_category,
         'question': question,
-        'history': history_list,
+        #the next steps load their own window from the session store
+        'history': [] if use_session else history_list,
+        'deadline': request_deadline.to_event(),
         'message':output_message
     }
\ No newline at end of file
@@ -1,7 +1,12 @@
 import json
 import boto3
 import os
+from utils import deadline
+from utils import prompt_cache
 from utils import llm_utils
+from utils import result_store
+from utils import profiling
+from utils import traffic_capture
 import time
 import re
 
@@ -17,6 +22,9 @@ logger.setLevel(logging.INFO)
 #bedrock client
 bedrock_client = boto3.client('bedrock-runtime')
 
+#last results per query, returned when the search cannot complete before the deadline
+fallback_results = deadline.FallbackCache()
+
 #extract answer from tags
 def extract_answer(text, tag="answer"):
     pattern = f'<{tag}>(.*?)</{tag}>'
@@ -27,6 +35,8 @@ def extract_answer(text, tag="answer"):
         return None
 
 #handler
+@traffic_capture.capture("semantic")
+@profiling.profile("semantic")
 def lambda_handler(event, context):
 
     #retrieve parameters
@@ -36,51 +46,87 @@ def lambda_handler(event, context):
     system_prompt = event.get('system_prompt', '')
     prefill = event.get('prefill', '')
     number_results = event.get('number_results', 10)
+    filter_mode = event.get('filter_mode', 'efficient')
+    projection = event.get('projection', 'list')
+    #results are stored once and passed between the states as compact references when a result store is set (s3://bucket/prefix/ or sqlite://path)
+    result_store_uri = event.get('result_store', os.environ.get('RESULT_STORE_URI', ''))
+    result_ttl = event.get('result_ttl', result_store.default_ttl)
+    #deadline of the turn, created by the routing step
+    request_deadline = deadline.Deadline.from_event(event, context)
 
     output_message = ""
     status_code = 200
     optimised_query = ""
+    search_filters = {}
     search_output = []
+    result_ref = ""
 
     try:
         #------ Query optimisation --------
-        messages = []
+        #skipped when the time runs low or when the model call fails, the question is then searched as it is
+        if request_deadline.has_time(deadline.min_time["query_optimisation"]):
+            try:
+                messages = []
+
+                user_message = {
+                    "role": "user",
+                    "content": [
+                        { "text": json.dumps(question) } 
+                    ],
+                }
+                messages.append(user_message)
+
+                if prefill != "": 
+                    assistant_prefill_message = {
+                        "role": "assistant",
+                        "content": [
+                            { "text": prefill }
+                        ],
+                    }
+                    messages.append(assistant_prefill_message)
+
+                response_optim = prompt_cache.converse(
+                    bedrock_client,
+                    modelId="anthropic.claude-3-haiku-20240307-v1:0",
+                    messages=messages,
+                    inferenceConfig={
+                        "maxTokens": 2000,
+                        "temperature": 0,
+                        "topP": 1
+                    },
+                    system_prompt=system_prompt,
+                    route="semantic",
+                    timeout=request_deadline.timeout(deadline.call_timeouts["llm"])
+                )
+
+                #extract message
+                response_message = response_optim['output']['message']
+
+                #extract the model response
+                full_response_message = prefill + response_message["content"][0]["text"]
+
+                optimised_query = extract_answer(full_response_message, tag="answer")
+
+                #structured constraints (year, genres, language, director, actors) extracted by the model, if any
+                filters_text = extract_answer(full_response_message, tag="filters")
+                if filters_text:
+                    try:
+                        search_filters = json.loads(filters_text)
+                    except Exception as e:
+                        logger.error(f"Could not parse filters -{filters_text}-: {e}")
+                        search_filters = {}
+                    if not isinstance(search_filters, dict):
+                        logger.error(f"Ignoring filters that are not an object -{filters_text}-")
+                        search_filters = {}
+            except Exception as e:
+                logger.error(f"Query optimisation failed: {e}")
+                request_deadline.record_fallback("query_optimisation_failed", route="semantic")
+                optimised_query = question
+        else:
+            request_deadline.record_fallback("skip_query_optimisation", route="semantic")
+            optimised_query = question
 
-        user_message = {
-            "role": "user",
-            "content": [
-                { "text": json.dumps(question) } 
-            ],
-        }
-        messages.append(user_message)
-
-        if prefill != "": 
-            assistant_prefill_message = {
-                "role": "assistant",
-                "content": [
-                    { "text": prefill }
-                ],
-            }
-            messages.append(assistant_prefill_message)
-
-        response_optim = bedrock_client.converse(
-            modelId="anthropic.claude-3-haiku-20240307-v1:0",
-            messages=messages,
-            inferenceConfig={
-                "maxTokens": 2000,
-                "temperature": 0,
-                "topP": 1
-            },
-            system=[{"text": json.dumps(system_prompt)}]
-        )
-
-        #extract message
-        response_message = response_optim['output']['message']
-
-        #extract the model response
-        full_response_message = prefill + response_message["content"][0]["text"]
-
-        optimised_query = extract_answer(full_response_message, tag="answer")
+        logger.debug(f"search filters:{search_filters}")
 
         if optimised_query:
             #------ OpenSearch call --------
@@ -98,16 +144,35 @@ def lambda_handler(event, context):
             #connecting to opensearch serverless
             os_client = llm_utils.connect_to_aoss(auth, os_host)
 
-            #querying opensearch
+            #querying opensearch, the last results of the same query are returned if the search fails or runs out of time
+            cache_key = json.dumps([optimised_query, search_filters, number_results, projection], sort_keys=True)
             start_time = time.time()
-            os_response = llm_utils.query_opensearch(optimised_query, os_client, index_name, data_columns, embedding_model="cohere", k=number_results)
+            try:
+                os_response = llm_utils.query_opensearch(optimised_query, os_client, index_name, data_columns, embedding_model="cohere", k=number_results,
+                                                         filters=search_filters, filter_mode=filter_mode, projection=projection, deadline=request_deadline)
+
+                #extract object from os response
+                search_output = llm_utils.extract_response_from_os_response(os_response)
+
+                #documents returned with the ids projection are completed from the local movies cache
+                movies_cache_path = os.environ.get('MOVIES_CACHE_PATH')
+                if projection == "ids" and movies_cache_path:
+                    search_output = llm_utils.hydrate_documents(search_output, movies_cache_path)
+
+                fallback_results.put(cache_key, search_output)
+            except Exception as e:
+                search_output = fallback_results.get(cache_key)
+                if search_output is None:
+                    raise
+                logger.error(f"Search failed, returning cached results: {e}")
+                request_deadline.record_fallback("cached_results", route="semantic")
             end_time = time.time()
             execution_time = end_time - start_time
 
             logger.debug(f"Querying OpenSearch took {execution_time:.6f} seconds.")
 
-            #extract object from os response
-            search_output = llm_utils.extract_response_from_os_response(os_response)
+            if result_store_uri and search_output:
+                result_ref, search_output = result_store.store_results(result_store_uri, search_output, ttl=result_ttl)
 
             output_message = f"Here is a list of movies in response to the question: {question}"
         else:
@@ -121,15 +186,21 @@ def lambda_handler(event, context):
         return {
             'statusCode': 500,
             'search_output': [],
+            'result_ref': "",
             'question': question,
             'optimised_query': "",
+            'filters': {},
+            'fallbacks': request_deadline.fallbacks,
             'message':str(e)
         }
 
     return {
             'statusCode': status_code,
             'search_output': search_output,
+            'result_ref': result_ref,
             'question': question,
             'optimised_query': optimised_query,
+            'filters': search_filters,
+            'fallbacks': request_deadline.fallbacks,
             'message':output_message
         }
\ No newline at end of file
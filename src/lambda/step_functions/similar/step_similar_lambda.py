@@ -1,6 +1,13 @@
 import json
 import boto3
+from utils import deadline
+from utils import document_text
+from utils import prompt_cache
 from utils import llm_utils
+from utils import result_store
+from utils import session_store
+from utils import profiling
+from utils import traffic_capture
 import time
 import os
 import re
@@ -26,8 +33,8 @@ def extract_answer(text, tag="answer"):
     else:
         return None
 
-#converse API call
-def converse_api_call_no_tool(question, history_list, system_prompt, bedrock_client):
+#converse API call, timeout in seconds
+def converse_api_call_no_tool(question, history_list, system_prompt, bedrock_client, timeout=None):
     
     messages = []
 
@@ -42,7 +49,8 @@ def converse_api_call_no_tool(question, history_list, system_prompt, bedrock_cli
     }
     messages.append(user_message)
 
-    response = bedrock_client.converse(
+    response = prompt_cache.converse(
+        bedrock_client,
         modelId="anthropic.claude-3-haiku-20240307-v1:0",
         messages=messages,
         inferenceConfig={
@@ -50,7 +58,9 @@ def converse_api_call_no_tool(question, history_list, system_prompt, bedrock_cli
             "temperature": 0,
             "topP": 1
         },
-        system=[{"text": json.dumps(system_prompt)}]
+        system_prompt=system_prompt,
+        route="similar",
+        timeout=timeout
     )
 
     #extract message
@@ -61,6 +71,8 @@ def converse_api_call_no_tool(question, history_list, system_prompt, bedrock_cli
 
 
 #handler
+@traffic_capture.capture("similar")
+@profiling.profile("similar")
 def lambda_handler(event, context):
 
     #retrieve parameters
@@ -71,17 +83,34 @@ def lambda_handler(event, context):
     index_name = event.get('index_name', '')
     os_host = event.get('os_host', '')
     number_results = event.get('number_results', 10)
+    projection = event.get('projection', 'list')
+    #when a session store is set (dynamodb://table or sqlite://path), the history is loaded from the session instead of the event
+    session_id = event.get('session_id', '')
+    session_store_uri = event.get('session_store', os.environ.get('SESSION_STORE_URI', ''))
+    history_window = event.get('history_window', session_store.default_window)
+    use_session = bool(session_store_uri and session_id)
+    #results are stored once and passed between the states as compact references when a result store is set (s3://bucket/prefix/ or sqlite://path)
+    result_store_uri = event.get('result_store', os.environ.get('RESULT_STORE_URI', ''))
+    result_ttl = event.get('result_ttl', result_store.default_ttl)
+    #deadline of the turn, created by the routing step
+    request_deadline = deadline.Deadline.from_event(event, context)
+    #text of the movie used as the query, built as the documents were embedded at ingestion
+    text_profile = event.get('text_profile', document_text.default_profile)
     
     data_columns = ['tmdb_id', 'original_language', 'original_title', 'description', 'genres', 'year', 'keywords', 'director', 'actors', 'popularity', 'popularity_bins',
                   'vote_average', 'vote_average_bins']
     
     #final output
     similar_list = []
+    result_ref = ""
     movie_name = ""
     status_code = 200
     output_message = ""
 
     try:
+        if use_session:
+            store = session_store.get_session_store(session_store_uri)
+            history_list = session_store.load_window(store, session_id, max_turns=history_window)
 
         #------ Check history list first ---------
 
@@ -89,13 +118,15 @@ def lambda_handler(event, context):
         if not history_list:
             
             #extract movie name from question
-            response = converse_api_call_no_tool(question, [], system_prompt_similar_from_question, bedrock_client)
+            response = converse_api_call_no_tool(question, [], system_prompt_similar_from_question, bedrock_client,
+                                                 timeout=request_deadline.timeout(deadline.call_timeouts["llm"]))
             movie_name = extract_answer(response)
 
         # if history list is not empty, we need to take into consideration for the question
         else:
             #extract movie name from question
-            response = converse_api_call_no_tool(question, history_list, system_prompt_similar_from_history, bedrock_client)
+            response = converse_api_call_no_tool(question, history_list, system_prompt_similar_from_history, bedrock_client,
+                                                 timeout=request_deadline.timeout(deadline.call_timeouts["llm"]))
             movie_name = extract_answer(response)
 
         #debug
@@ -120,14 +151,14 @@ def lambda_handler(event, context):
 
             #querying opensearch
             start_time = time.time()
-            response_aoss = llm_utils.standard_query_opensearch(prop_value_list, os_client, index_name, data_columns, k=1)
+            #the whole movie is used as the query for the semantic search
+            response_aoss = llm_utils.standard_query_opensearch(prop_value_list, os_client, index_name, data_columns, k=1, projection="full",
+                                                              deadline=request_deadline)
             end_time = time.time()
             execution_time = end_time - start_time
 
             logger.debug(f"Querying OpenSearch took {execution_time:.6f} seconds.")
 
-            response_aoss_str = json.dumps(response_aoss)
-
             logger.debug(f"response_aoss:{response_aoss}")
 
             #extracting the tmdb_id from the response
@@ -135,10 +166,14 @@ def lambda_handler(event, context):
             if response_aoss and response_aoss[0]:
                 tmdb_id = response_aoss[0]["tmdb_id"]
 
+            #the movie is embedded with the same document text as at ingestion instead of its whole json
+            query_text = document_text.build_text(response_aoss[0], profile=text_profile) if response_aoss else json.dumps(response_aoss)
+
             #now we do a semantic search to retrieve the results
             #querying opensearch
             start_time = time.time()
-            os_response = llm_utils.query_opensearch(response_aoss_str, os_client, index_name, data_columns, embedding_model="cohere", k=number_results+1)
+            os_response = llm_utils.query_opensearch(query_text, os_client, index_name, data_columns, embedding_model="cohere", k=number_results+1, projection=projection,
+                                                     deadline=request_deadline)
             end_time = time.time()
             execution_time = end_time - start_time
 
@@ -147,10 +182,18 @@ def lambda_handler(event, context):
             #extract object from os response
             similar_list = llm_utils.extract_response_from_os_response(os_response)
 
+            #documents returned with the ids projection are completed from the local movies cache
+            movies_cache_path = os.environ.get('MOVIES_CACHE_PATH')
+            if projection == "ids" and movies_cache_path:
+                similar_list = llm_utils.hydrate_documents(similar_list, movies_cache_path)
+
             #making sure that the list doesn't include the movie we used to for similar movies (very likely)
             if tmdb_id != "":
                 similar_list = [item for item in similar_list if item["tmdb_id"] != tmdb_id]
 
+            if result_store_uri and similar_list:
+                result_ref, similar_list = result_store.store_results(result_store_uri, similar_list, ttl=result_ttl)
+
             output_message = f"Here is a list of movies similar to {movie_name}"
             
         else:
@@ -166,14 +209,18 @@ def lambda_handler(event, context):
             'statusCode': 500,
             'message': str(e),
             'search_output': [],
+            'result_ref': "",
             'question': question,
-            'movie_name':movie_name
+            'movie_name':movie_name,
+            'fallbacks': request_deadline.fallbacks
         }   
 
     return {
             'statusCode': status_code,
             'search_output': similar_list,
+            'result_ref': result_ref,
             'question': question,
             'movie_name':movie_name,
+            'fallbacks': request_deadline.fallbacks,
             'message' : output_message
         }
\ No newline at end of file
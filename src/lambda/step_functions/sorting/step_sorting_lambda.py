@@ -1,6 +1,14 @@
 import json
 import boto3
+import os
 import traceback
+from utils import deadline
+from utils import llm_utils
+from utils import prompt_cache
+from utils import result_store
+from utils import session_store
+from utils import profiling
+from utils import traffic_capture
 
 import logging
 logger = logging.getLogger()
@@ -10,6 +18,8 @@ logger.setLevel(logging.DEBUG)
 bedrock_client = boto3.client('bedrock-runtime')
 
 #handler
+@traffic_capture.capture("sorting")
+@profiling.profile("sorting")
 def lambda_handler(event, context):
 
     #retrieve parameters
@@ -17,6 +27,18 @@ def lambda_handler(event, context):
     system_prompt = event.get('system_prompt', '')
     tool_list = event.get('tool_list', [])
     list_to_sort = event.get('list_to_sort', [])
+    #reference of the full results when the search state used a result store, the list to sort then only has the ids and sort properties
+    result_ref = event.get('result_ref', '')
+    result_store_uri = event.get('result_store', os.environ.get('RESULT_STORE_URI', ''))
+    #set to False to return the sorted references and let the caller fetch the documents
+    resolve_output = event.get('resolve_output', True)
+    #when a session store is set (dynamodb://table or sqlite://path), the exchange is added to the session
+    session_id = event.get('session_id', '')
+    session_store_uri = event.get('session_store', os.environ.get('SESSION_STORE_URI', ''))
+    history_token_budget = event.get('history_token_budget', session_store.default_token_budget)
+    use_session = bool(session_store_uri and session_id)
+    #deadline of the turn, created by the routing step, and the fallbacks taken by the previous states
+    request_deadline = deadline.Deadline.from_event(event, context)
 
     #final output message
     output_message = ""
@@ -26,46 +48,60 @@ def lambda_handler(event, context):
     sort_columns = ['year', 'popularity', 'vote_average']
     
     try:
-        messages = []
-
-        user_message = {
-            "role": "user",
-            "content": [
-                { "text": json.dumps(question) } 
-            ],
-        }
-        messages.append(user_message)
-
-        response = bedrock_client.converse(
-            modelId="anthropic.claude-3-haiku-20240307-v1:0",
-            messages=messages,
-            inferenceConfig={
-                "maxTokens": 2000,
-                "temperature": 0,
-                "topP": 1
-            },
-            toolConfig={
-                "tools": tool_list
-            },
-            system=[{"text": json.dumps(system_prompt)}]
-        )
-
-        #extract message
-        response_message = response['output']['message']["content"]
-
-        logger.debug(f"sorting response_message:{response_message}")
-        
         #default
         sort_by = "popularity"
 
-        for elt in response_message:
-            if "toolUse" in elt:
-                sort_by = elt["toolUse"]["input"]["sort_by"]
+        #the sorting property is chosen by the model when there is time left, else the list is sorted by popularity
+        if request_deadline.has_time(deadline.min_time["sorting_llm"]):
+            try:
+                messages = []
+
+                user_message = {
+                    "role": "user",
+                    "content": [
+                        { "text": json.dumps(question) } 
+                    ],
+                }
+                messages.append(user_message)
+
+                response = prompt_cache.converse(
+                    bedrock_client,
+                    modelId="anthropic.claude-3-haiku-20240307-v1:0",
+                    messages=messages,
+                    inferenceConfig={
+                        "maxTokens": 2000,
+                        "temperature": 0,
+                        "topP": 1
+                    },
+                    system_prompt=system_prompt,
+                    tool_list=tool_list,
+                    route="sorting",
+                    timeout=request_deadline.timeout(deadline.call_timeouts["llm"])
+                )
+
+                #extract message
+                response_message = response['output']['message']["content"]
+
+                logger.debug(f"sorting response_message:{response_message}")
+
+                for elt in response_message:
+                    if "toolUse" in elt:
+                        sort_by = elt["toolUse"]["input"]["sort_by"]
+            except Exception as e:
+                logger.error(f"Sorting property selection failed, sorting by popularity: {e}")
+                request_deadline.record_fallback("sorting_llm_failed", route="sorting")
+        else:
+            request_deadline.record_fallback("skip_sorting_llm", route="sorting")
 
         logger.debug(f"sort_by:{sort_by}")
         
-        #sorting by descending order by default
-        sorted_list = sorted(list_to_sort, key=lambda x: float(x[sort_by]), reverse=True)
+        #sorting by descending order by default (numeric properties in the index, movies without value last)
+        sorted_list = llm_utils.sort_by_value(list_to_sort, lambda x: x.get(sort_by))
+
+        #the full documents are fetched once, at the end of the workflow
+        if resolve_output:
+            sorted_list = result_store.resolve_results(result_store_uri, result_ref, sorted_list)
+            result_ref = ""
 
         #message
         output_message = f"Here is a list of movies corresponding to your question about -{question}- sorted by -{sort_by}-."
@@ -77,12 +113,26 @@ def lambda_handler(event, context):
             'statusCode': 500,
             'sorted_by':"",
             'message': str(e),
-            'search_output': []
+            'search_output': [],
+            'result_ref': "",
+            'fallbacks': request_deadline.fallbacks
         }
-    
+
+    #the exchange is added to the session once the answer is known, a failure does not fail the answer
+    if use_session:
+        try:
+            store = session_store.get_session_store(session_store_uri)
+            session_store.record_exchange(store, session_id, question, session_store.format_answer(output_message, sorted_list),
+                                          session_store.bedrock_summarizer(bedrock_client), token_budget=history_token_budget,
+                                          deadline=request_deadline, route="sorting")
+        except Exception as e:
+            logger.error(f"Could not record the exchange in session {session_id}: {e}")
+
     return {
                 'statusCode': status_code,
                 'sorted_by': sort_by,
                 'search_output': sorted_list,
+                'result_ref': result_ref,
+                'fallbacks': request_deadline.fallbacks,
                 'message': output_message
             }
\ No newline at end of file
@@ -1,11 +1,16 @@
 import json
 import boto3
+from utils import deadline
+from utils import prompt_cache
 from utils import llm_utils
+from utils import context_builder
 import time
 import os
 import re
-import copy
 import traceback
+from utils import session_store
+from utils import profiling
+from utils import traffic_capture
 
 import logging
 logger = logging.getLogger()
@@ -27,13 +32,14 @@ def extract_answer(text, tag="answer"):
     else:
         return None
 
-#converse API call
-def converse_api_call_no_tool(question, history_list, system_prompt, bedrock_client, model_id="anthropic.claude-3-haiku-20240307-v1:0"):
+#converse API call, timeout in seconds
+def converse_api_call_no_tool(question, history_list, system_prompt, bedrock_client, model_id="anthropic.claude-3-haiku-20240307-v1:0", system_suffix="", timeout=None):
     
     messages = []
 
     if history_list:
-        messages = copy.deepcopy(history_list)
+        #messages are not modified, a shallow copy is enough
+        messages = list(history_list)
     
     user_message = {
         "role": "user",
@@ -43,7 +49,8 @@ def converse_api_call_no_tool(question, history_list, system_prompt, bedrock_cli
     }
     messages.append(user_message)
 
-    response = bedrock_client.converse(
+    response = prompt_cache.converse(
+        bedrock_client,
         modelId=model_id,
         messages=messages,
         inferenceConfig={
@@ -51,7 +58,10 @@ def converse_api_call_no_tool(question, history_list, system_prompt, bedrock_cli
             "temperature": 0,
             "topP": 1
         },
-        system=[{"text": json.dumps(system_prompt)}]
+        system_prompt=system_prompt,
+        system_suffix=system_suffix,
+        route="specific",
+        timeout=timeout
     )
     
     #extract message
@@ -62,6 +72,8 @@ def converse_api_call_no_tool(question, history_list, system_prompt, bedrock_cli
 
 
 #handler
+@traffic_capture.capture("specific")
+@profiling.profile("specific")
 def lambda_handler(event, context):
 
     #retrieve parameters
@@ -73,6 +85,16 @@ def lambda_handler(event, context):
     index_name = event.get('index_name', '')
     os_host = event.get('os_host', '')
     model_id = event.get('model_id', 'anthropic.claude-3-haiku-20240307-v1:0')
+    #maximum estimated tokens of the movie information given to the model
+    context_token_budget = event.get('context_token_budget', 1500)
+    #when a session store is set (dynamodb://table or sqlite://path), the history is loaded from the session instead of the event
+    session_id = event.get('session_id', '')
+    session_store_uri = event.get('session_store', os.environ.get('SESSION_STORE_URI', ''))
+    history_window = event.get('history_window', session_store.default_window)
+    history_token_budget = event.get('history_token_budget', session_store.default_token_budget)
+    use_session = bool(session_store_uri and session_id)
+    #deadline of the turn, created by the routing step
+    request_deadline = deadline.Deadline.from_event(event, context)
     
     data_columns = ['tmdb_id', 'original_language', 'original_title', 'description', 'genres', 'year', 'keywords', 'director', 'actors', 'popularity', 'popularity_bins',
                   'vote_average', 'vote_average_bins']
@@ -84,6 +106,10 @@ def lambda_handler(event, context):
     status_code = 200
 
     try:
+        if use_session:
+            store = session_store.get_session_store(session_store_uri)
+            history_list = session_store.load_window(store, session_id, max_turns=history_window)
+
         #------ DEBUG ---------
         logger.debug(f"history list:{history_list}")
         logger.debug(f"system_prompt_specific:{system_prompt_specific}")
@@ -91,13 +117,15 @@ def lambda_handler(event, context):
         #history list is empty so we need to extract the movie name from the question
         if not history_list:
             #extract movie name from question
-            response = converse_api_call_no_tool(question, [], system_prompt_extract_movie_from_question, bedrock_client, model_id=model_id)
+            response = converse_api_call_no_tool(question, [], system_prompt_extract_movie_from_question, bedrock_client, model_id=model_id,
+                                                 timeout=request_deadline.timeout(deadline.call_timeouts["llm"]))
             movie_name = extract_answer(response)
 
         # if history list is not empty, we need to take into consideration for the question
         else:
             #extract movie name from question
-            response = converse_api_call_no_tool(question, history_list, system_prompt_extract_movie_from_history, bedrock_client, model_id=model_id)
+            response = converse_api_call_no_tool(question, history_list, system_prompt_extract_movie_from_history, bedrock_client, model_id=model_id,
+                                                 timeout=request_deadline.timeout(deadline.call_timeouts["llm"]))
             movie_name = extract_answer(response)
 
         if movie_name:
@@ -116,21 +144,27 @@ def lambda_handler(event, context):
 
             #querying opensearch
             start_time = time.time()
-            response_aoss = llm_utils.standard_query_opensearch(prop_value_list, os_client, index_name, data_columns, k=1)
+            #the whole movie is given to the model as context
+            response_aoss = llm_utils.standard_query_opensearch(prop_value_list, os_client, index_name, data_columns, k=1, projection="full",
+                                                                deadline=request_deadline)
             end_time = time.time()
             execution_time = end_time - start_time
 
             logger.debug(f"Querying OpenSearch took {execution_time:.6f} seconds.")
 
-            response_aoss_str = json.dumps(response_aoss)
+            #compact text of the movie instead of the raw json document
+            context, context_stats = context_builder.build_context(response_aoss, route="specific", token_budget=context_token_budget)
 
-            logger.debug(f"response_aoss:{response_aoss_str}")
+            logger.debug(f"response_aoss:{response_aoss}")
+            logger.debug(f"context stats:{context_stats}")
 
-            #injecting the documents into the prompt
-            system_prompt_specific = system_prompt_specific.replace("{context}", response_aoss_str)
+            #injecting the documents into the prompt: the static text before {context} is cached, the documents and the rest of the prompt are not
+            system_prompt_static, _, system_prompt_end = system_prompt_specific.partition("{context}")
 
             #now we giving the movie information to the LLM to generate a response
-            response_llm = converse_api_call_no_tool(question, history_list, system_prompt_specific, bedrock_client, model_id=model_id)
+            response_llm = converse_api_call_no_tool(question, history_list, system_prompt_static, bedrock_client, model_id=model_id,
+                                                     system_suffix=context + system_prompt_end,
+                                                     timeout=request_deadline.timeout(deadline.call_timeouts["llm"]))
             #extract answer from xml tag
             output_message = extract_answer(response_llm)
 
@@ -149,12 +183,24 @@ def lambda_handler(event, context):
             'statusCode': 500,
             'message': str(e),
             'search_output': [],
-            'movie_name':movie_name
+            'movie_name':movie_name,
+            'fallbacks': request_deadline.fallbacks
         }
-    
+
+    #the exchange is added to the session once the answer is known, a failure does not fail the answer
+    if use_session and status_code == 200:
+        try:
+            store = session_store.get_session_store(session_store_uri)
+            session_store.record_exchange(store, session_id, question, session_store.format_answer(output_message),
+                                          session_store.bedrock_summarizer(bedrock_client), token_budget=history_token_budget,
+                                          deadline=request_deadline, route="specific")
+        except Exception as e:
+            logger.error(f"Could not record the exchange in session {session_id}: {e}")
+
     return {
             'statusCode': status_code,
             'message': json.dumps(output_message),
             'search_output': [],
-            'movie_name':movie_name
+            'movie_name':movie_name,
+            'fallbacks': request_deadline.fallbacks
             }
\ No newline at end of file
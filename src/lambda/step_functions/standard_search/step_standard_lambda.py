@@ -1,8 +1,16 @@
 import json
 import boto3
 import os
+from utils import deadline
+from utils import facet_views
+from utils import prompt_cache
 from utils import llm_utils
+from utils import local_index
+from utils import result_store
+from utils import profiling
+from utils import traffic_capture
 import time
+import traceback
 
 from opensearchpy import (
     AWSV4SignerAuth
@@ -15,7 +23,12 @@ logger.setLevel(logging.INFO)
 #bedrock client
 bedrock_client = boto3.client('bedrock-runtime')
 
+#last results per query, returned when the search cannot complete before the deadline
+fallback_results = deadline.FallbackCache()
+
 #handler
+@traffic_capture.capture("standard")
+@profiling.profile("standard")
 def lambda_handler(event, context):
 
     #retrieve parameters
@@ -25,6 +38,21 @@ def lambda_handler(event, context):
     system_prompt = event.get('system_prompt', '')
     tool_list = event.get('tool_list', [])
     number_results = event.get('number_results', 10)
+    projection = event.get('projection', 'list')
+    #up to max_results movies (e.g. all the movies of a director) are streamed from opensearch in pages of page_size,
+    #within the payload limit of the state
+    max_results = event.get('max_results', number_results)
+    page_size = event.get('page_size', 100)
+    #results are stored once and passed between the states as compact references when a result store is set (s3://bucket/prefix/ or sqlite://path)
+    result_store_uri = event.get('result_store', os.environ.get('RESULT_STORE_URI', ''))
+    result_ttl = event.get('result_ttl', result_store.default_ttl)
+    #deadline of the turn, created by the routing step
+    request_deadline = deadline.Deadline.from_event(event, context)
+    #top movies of the common facets precomputed by src/tools/build_facet_views.py, packaged with the lambda
+    facet_views_path = event.get('facet_views', os.environ.get('FACET_VIEWS_PATH', ''))
+    #backend of the search: "opensearch" or "local" (in-process inverted index of the movies file MOVIES_CACHE_PATH)
+    search_backend = event.get('search_backend', os.environ.get('STANDARD_SEARCH_BACKEND', 'opensearch'))
+    movies_cache_path = os.environ.get('MOVIES_CACHE_PATH')
     
     #get region
     region_name = os.environ.get('AWS_REGION')
@@ -35,7 +63,9 @@ def lambda_handler(event, context):
     
     status_code = 200
     search_output = []
+    result_ref = ""
     output_message = ""
+    truncated = False
 
     try:
         #------ Function Calling LLM call --------
@@ -49,7 +79,8 @@ def lambda_handler(event, context):
         }
         messages.append(user_message)
 
-        response_tool = bedrock_client.converse(
+        response_tool = prompt_cache.converse(
+            bedrock_client,
             modelId="anthropic.claude-3-haiku-20240307-v1:0",
             messages=messages,
             inferenceConfig={
@@ -57,10 +88,10 @@ def lambda_handler(event, context):
                 "temperature": 0,
                 "topP": 1
             },
-            toolConfig={
-                "tools": tool_list
-            },
-            system=[{"text": json.dumps(system_prompt)}]
+            system_prompt=system_prompt,
+            tool_list=tool_list,
+            route="standard",
+            timeout=request_deadline.timeout(deadline.call_timeouts["llm"])
         )
         
         #we retrieve the list of filters from the tool
@@ -80,17 +111,62 @@ def lambda_handler(event, context):
             else:
                 prop_value_list = [tool_output]
 
-            #---------- OpenSearch call -----------
-            #auth object required to connect to opensearch
-            credentials = boto3.Session().get_credentials()
-            auth = AWSV4SignerAuth(credentials, region_name, 'aoss')
-
-            #connecting to opensearch serverless
-            os_client = llm_utils.connect_to_aoss(auth, os_host)
+            #the results are stored once by the result store, only their reference goes through the state:
+            #the results of every backend are kept under the payload limit of the state, or of the lambda with a result store
+            budget = llm_utils.payload_budgets["lambda" if result_store_uri else "step_functions"]
 
-            #querying opensearch
+            #---------- Materialized views -----------
+            #single facet queries (e.g. popular horror movies, movies from the 1990s) are answered from the precomputed views
+            #without calling opensearch. The views hold the whole movies, the ids projection is returned complete.
             start_time = time.time()
-            search_output = llm_utils.standard_query_opensearch(prop_value_list, os_client, index_name, data_columns, k=number_results)
+            search_output = facet_views.lookup(facet_views_path, prop_value_list, k=max_results, projection="list" if projection == "ids" else projection)
+
+            #---------- Local index -----------
+            #the compiled query is evaluated in process, queries the local index does not support go to opensearch
+            if search_output is None and search_backend == "local" and movies_cache_path:
+                try:
+                    search_output = local_index.standard_query_local(prop_value_list, movies_cache_path, data_columns, k=max_results,
+                                                                     projection="list" if projection == "ids" else projection)
+                except ValueError as e:
+                    logger.info(f"Local index fallback to opensearch: {e}")
+
+            if search_output is not None:
+                search_output, truncated = llm_utils.collect_within_limit(search_output, budget)
+            else:
+                #---------- OpenSearch call -----------
+                #auth object required to connect to opensearch
+                credentials = boto3.Session().get_credentials()
+                auth = AWSV4SignerAuth(credentials, region_name, 'aoss')
+
+                #connecting to opensearch serverless
+                os_client = llm_utils.connect_to_aoss(auth, os_host)
+
+                #querying opensearch, the last results of the same filters are returned if the search fails or runs out of time
+                cache_key = json.dumps([prop_value_list, max_results, projection], sort_keys=True)
+                try:
+                    if max_results > page_size:
+                        #pages read until max_results or the budget is reached
+                        documents = llm_utils.stream_standard_query(prop_value_list, os_client, index_name, data_columns, page_size=page_size,
+                                                                     max_results=max_results, projection=projection, deadline=request_deadline)
+                    else:
+                        documents = llm_utils.standard_query_opensearch(prop_value_list, os_client, index_name, data_columns, k=max_results, projection=projection,
+                                                                        deadline=request_deadline)
+
+                    #documents returned with the ids projection are completed from the local movies cache, before their size is counted
+                    if projection == "ids" and movies_cache_path:
+                        documents = (llm_utils.hydrate_documents([doc], movies_cache_path)[0] for doc in documents)
+                    search_output, truncated = llm_utils.collect_within_limit(documents, budget)
+
+                    fallback_results.put(cache_key, search_output)
+                except Exception as e:
+                    search_output = fallback_results.get(cache_key)
+                    if search_output is None:
+                        raise
+                    logger.error(f"Search failed, returning cached results: {e}")
+                    request_deadline.record_fallback("cached_results", route="standard")
+
+            if result_store_uri and search_output:
+                result_ref, search_output = result_store.store_results(result_store_uri, search_output, ttl=result_ttl)
             end_time = time.time()
             execution_time = end_time - start_time
 
@@ -111,12 +187,17 @@ def lambda_handler(event, context):
             'statusCode': 500,
             'message': str(e),
             'search_output': [],
-            'question': question
+            'result_ref': "",
+            'question': question,
+            'fallbacks': request_deadline.fallbacks
         }
     
     return {
             'statusCode': status_code,
             'search_output': search_output,
+            'result_ref': result_ref,
+            'truncated': truncated,
             'question': question,
+            'fallbacks': request_deadline.fallbacks,
             'message': output_message
         }
\ No newline at end of file
@@ -0,0 +1,375 @@
+#ASGI service hosting the lambda handlers as HTTP endpoints in a single long-running process.
+#The handlers share the process-wide clients and caches (opensearch clients per host, bedrock clients,
+#index schemas, prompt templates, result and session stores) and a pool of worker threads.
+#
+#usage (from the src folder): uvicorn service.app:app --host 0.0.0.0 --port 8080 --timeout-graceful-shutdown 30
+#
+#endpoints:
+#  POST /routing, /semantic, /standard, /similar, /specific, /open, /sorting: event of the step function state as the json body
+#  POST /agent/semantic-search, /agent/movie-details: event of the bedrock agent action group as the json body
+#  POST /chain: {"question", "session_id", "k", "time_budget_ms"}, requires SERVICE_CHAIN_CONFIG
+#  POST /turn: execution input of the state machine, run in process (see express.py), requires SERVICE_STATE_MACHINE
+#  GET /health: liveness, GET /ready: readiness (503 while starting or draining), GET /metrics: counters of the process
+
+import asyncio
+import concurrent.futures
+import importlib.util
+import json
+import logging
+import os
+import sys
+import time
+import uuid
+
+#adding our utils library to sys path
+src_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(src_path)
+from utils import deadline
+from utils import hedging
+from utils import llm_utils
+from utils import metrics
+from utils import single_flight
+
+logger = logging.getLogger("service")
+logger.setLevel(logging.INFO)
+
+#lambda file of each endpoint, relative to src/lambda
+handler_files = {
+    "routing": "step_functions/routing/step_routing_lambda.py",
+    "semantic": "step_functions/semantic_search/step_semantic_lambda.py",
+    "standard": "step_functions/standard_search/step_standard_lambda.py",
+    "similar": "step_functions/similar/step_similar_lambda.py",
+    "specific": "step_functions/specific/step_specific_lambda.py",
+    "open": "step_functions/open/step_open_lambda.py",
+    "sorting": "step_functions/sorting/step_sorting_lambda.py",
+    "agent/semantic-search": "semantic_search/semantic_lambda.py",
+    "agent/movie-details": "movie_details/standard_search_lambda.py",
+}
+
+
+#configuration from the environment variables
+class ServiceConfig:
+
+    def __init__(self, environ=None) -> None:
+        environ = os.environ if environ is None else environ
+        #endpoints to mount, all by default
+        self.routes = [route for route in environ.get("SERVICE_ROUTES", ",".join(handler_files)).split(",") if route]
+        #requests handled at the same time (worker threads), and requests waiting for a worker before new ones are rejected with a 503
+        self.max_concurrency = int(environ.get("SERVICE_MAX_CONCURRENCY", "32"))
+        self.max_queue = int(environ.get("SERVICE_MAX_QUEUE", "64"))
+        #per endpoint limits e.g. "chain=4,specific=8", within the global limit
+        self.route_concurrency = parse_limits(environ.get("SERVICE_ROUTE_CONCURRENCY", ""))
+        #time given to a request, passed to the handlers as the remaining time of the lambda context
+        self.request_timeout_ms = int(environ.get("SERVICE_REQUEST_TIMEOUT_MS", "29000"))
+        #level of the logs of the process, set after the handlers are loaded as some of them set the level of the root logger
+        self.log_level = environ.get("SERVICE_LOG_LEVEL", "INFO").upper()
+        #time given to the requests in flight to finish on shutdown
+        self.shutdown_timeout = float(environ.get("SERVICE_SHUTDOWN_TIMEOUT", "30"))
+        self.max_body_bytes = int(environ.get("SERVICE_MAX_BODY_BYTES", str(1024 * 1024)))
+        #json file with the prompts and opensearch settings of the ConversationalRetrievalChain
+        self.chain_config = environ.get("SERVICE_CHAIN_CONFIG", "")
+        #json file with the state machine definition run by /turn, and the speculation mode (off, embedding or branch)
+        self.state_machine = environ.get("SERVICE_STATE_MACHINE", "")
+        self.speculate = environ.get("SERVICE_SPECULATE", "branch")
+        #local stand-ins of bedrock and opensearch, for load tests without AWS (see standins.py)
+        self.standins = environ.get("SERVICE_STANDINS", "") in ("1", "true", "on")
+
+#parse "route=limit,route=limit"
+def parse_limits(value):
+    limits = {}
+    for item in value.split(","):
+        if "=" in item:
+            route, limit = item.split("=", 1)
+            limits[route.strip()] = int(limit)
+    return limits
+
+
+class Overloaded(Exception):
+    pass
+
+
+#concurrency limit with a bounded queue: the requests over max_concurrency wait, the requests over max_queue are rejected
+class ConcurrencyLimiter:
+
+    def __init__(self, max_concurrency, max_queue) -> None:
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.waiting = 0
+        self.active = 0
+
+    async def acquire(self):
+        if self.semaphore.locked() and self.waiting >= self.max_queue:
+            raise Overloaded()
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+
+    #called from the event loop thread
+    def release(self):
+        self.active -= 1
+        self.semaphore.release()
+
+
+#lambda context given to the handlers, the remaining time is the time left of the request
+class RequestContext:
+
+    def __init__(self, function_name, timeout_ms) -> None:
+        self.function_name = function_name
+        self.aws_request_id = str(uuid.uuid4())
+        self.expires_at = time.time() + timeout_ms / 1000
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.expires_at - time.time()) * 1000))
+
+
+#load a lambda file as a module, under a unique name as several lambdas have the same file name
+def load_handler(route):
+    path = os.path.join(src_path, "lambda", handler_files[route])
+    module_name = "service_handler_" + route.replace("/", "_").replace("-", "_")
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+#build the ConversationalRetrievalChain from a json file:
+#{"os_host", "index_name", "model", "data_columns", "max_sessions", "main_prompt": {"input_variables", "template", "system_prompt", "prefill"},
+# "decision_prompt": {...}, "retrieval_optimisation_prompt": {...}, "stages": {"decision": {"model", "max_tokens"}, ...} or "tiered"}
+def load_chain(config_path):
+    import boto3
+    from opensearchpy import AWSV4SignerAuth
+
+    with open(config_path) as file:
+        config = json.load(file)
+
+    def prompt(name):
+        return llm_utils.PromptTemplate(**config[name])
+
+    region_name = os.environ.get('AWS_REGION')
+    auth = AWSV4SignerAuth(boto3.Session().get_credentials(), region_name, 'aoss')
+    os_client = llm_utils.connect_to_aoss(auth, config["os_host"])
+
+    return llm_utils.ConversationalRetrievalChain(
+        os_client,
+        config["index_name"],
+        config.get("data_columns", llm_utils.projection_profiles["full"]),
+        prompt("main_prompt"),
+        prompt("decision_prompt"),
+        prompt("retrieval_optimisation_prompt"),
+        model=config.get("model", "anthropic.claude-3-sonnet-20240229-v1:0"),
+        memory=llm_utils.SessionMemoryManager(max_sessions=config.get("max_sessions", 1000)),
+        stages=llm_utils.tiered_chain_stages if config.get("stages") == "tiered" else config.get("stages")
+    )
+
+
+class Service:
+
+    def __init__(self, config=None) -> None:
+        self.config = config or ServiceConfig()
+        self.handlers = {}
+        self.chain = None
+        self.orchestrator = None
+        self.executor = None
+        self.limiter = None
+        self.route_limiters = {}
+        self.ready = False
+        self.draining = False
+        self.in_flight = 0
+        self.started_at = None
+        self.counters = {"requests": 0, "errors": 0, "rejected": 0, "timeouts": 0}
+
+    #load the handlers once, the clients and caches created at import time are then shared by all the requests
+    def startup(self):
+        if self.config.standins:
+            from service import standins
+            standins.install()
+
+        for route in self.config.routes:
+            if route == "chain":
+                continue
+            self.handlers[route] = load_handler(route)
+            logger.info(f"mounted /{route}")
+
+        if self.config.chain_config:
+            self.chain = load_chain(self.config.chain_config)
+            logger.info("mounted /chain")
+
+        if self.config.standins:
+            standins.install_handlers(self.handlers.values())
+
+        #the handlers set the level of the root logger when they are imported (e.g. DEBUG for sorting)
+        logging.getLogger().setLevel(self.config.log_level)
+
+        if self.config.state_machine:
+            from service import express
+            with open(self.config.state_machine) as file:
+                definition = json.load(file)
+            self.orchestrator = express.ExpressOrchestrator(definition, self.handlers, speculate=self.config.speculate,
+                                                            context_factory=lambda route: RequestContext(route, self.config.request_timeout_ms))
+            logger.info("mounted /turn")
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.config.max_concurrency, thread_name_prefix="handler")
+        self.limiter = ConcurrencyLimiter(self.config.max_concurrency, self.config.max_queue)
+        self.route_limiters = {route: ConcurrencyLimiter(limit, self.config.max_queue) for route, limit in self.config.route_concurrency.items()}
+        self.started_at = time.time()
+        self.ready = True
+
+    #stop accepting requests, wait for the requests in flight, then stop the workers
+    async def shutdown(self):
+        self.draining = True
+        self.ready = False
+        end = time.time() + self.config.shutdown_timeout
+        while self.in_flight > 0 and time.time() < end:
+            await asyncio.sleep(0.1)
+        if self.in_flight > 0:
+            logger.warning(f"shutting down with {self.in_flight} requests in flight")
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+    #run the handler of a route in a worker thread
+    def invoke(self, route, event):
+        if route == "chain":
+            request_deadline = deadline.Deadline.from_event(event, budget_ms=self.config.request_timeout_ms)
+            answer = self.chain.run(event.get("question", ""), k=event.get("k", 10), session_id=event.get("session_id"), deadline=request_deadline)
+            return {"statusCode": 200, "message": answer, "fallbacks": request_deadline.fallbacks}
+        if route == "turn":
+            return self.orchestrator.run(event)
+
+        context = RequestContext(route, self.config.request_timeout_ms)
+        return self.handlers[route].lambda_handler(event, context)
+
+    async def handle(self, route, event):
+        self.counters["requests"] += 1
+        self.in_flight += 1
+        start = time.time()
+        try:
+            #the endpoint limit is taken first so that a request waiting for it does not hold a worker
+            limiters = ([self.route_limiters[route]] if route in self.route_limiters else []) + [self.limiter]
+            acquired = []
+            try:
+                for limiter in limiters:
+                    await limiter.acquire()
+                    acquired.append(limiter)
+                future = asyncio.get_running_loop().run_in_executor(self.executor, self.invoke, route, event)
+            except BaseException:
+                for limiter in reversed(acquired):
+                    limiter.release()
+                raise
+
+            #the slots are released when the worker finishes, not when the request times out: the worker is not
+            #interrupted (the handler stops at its own deadline) and still counts in the concurrency until then
+            future.add_done_callback(lambda _: [limiter.release() for limiter in reversed(acquired)])
+            return await asyncio.wait_for(asyncio.shield(future), timeout=self.config.request_timeout_ms / 1000 + 1)
+        finally:
+            self.in_flight -= 1
+            metrics.put_metrics({"ServiceLatency": (time.time() - start) * 1000}, dimensions={"Route": route}, unit="Milliseconds")
+
+    def stats(self):
+        return {
+            "ready": self.ready,
+            "draining": self.draining,
+            "uptime": time.time() - self.started_at if self.started_at else 0,
+            "in_flight": self.in_flight,
+            "active": self.limiter.active if self.limiter else 0,
+            "waiting": self.limiter.waiting if self.limiter else 0,
+            "routes": sorted(self.handlers) + (["chain"] if self.chain else []) + (["turn"] if self.orchestrator else []),
+            "speculation": self.orchestrator.stats() if self.orchestrator else {},
+            **self.counters,
+        }
+
+
+#json http response
+async def send_json(send, status, body):
+    payload = json.dumps(body, default=str).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(payload)).encode())]
+    })
+    await send({"type": "http.response.body", "body": payload})
+
+async def read_body(receive, max_bytes):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if len(body) > max_bytes:
+            raise ValueError("request body too large")
+        if not message.get("more_body", False):
+            return body
+
+
+#ASGI application
+class App:
+
+    def __init__(self, service=None) -> None:
+        self.service = service or Service()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    #the handlers create their clients at import time, outside of the event loop
+                    await asyncio.get_running_loop().run_in_executor(None, self.service.startup)
+                    await send({"type": "lifespan.startup.complete"})
+                except Exception as e:
+                    logger.exception("startup failed")
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+            elif message["type"] == "lifespan.shutdown":
+                await self.service.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def http(self, scope, receive, send):
+        service = self.service
+        method = scope["method"]
+        route = scope["path"].strip("/")
+
+        if method == "GET" and route == "health":
+            return await send_json(send, 200, {"status": "ok"})
+        if method == "GET" and route == "ready":
+            return await send_json(send, 200 if service.ready else 503, {"ready": service.ready, "draining": service.draining})
+        if method == "GET" and route == "metrics":
+            return await send_json(send, 200, {"service": service.stats(), "hedging": hedging.get_stats(),
+                                                "single_flight": single_flight.get_stats(), "metrics": metrics.get_totals()})
+
+        if route not in service.handlers and not (route == "chain" and service.chain is not None) and not (route == "turn" and service.orchestrator is not None):
+            return await send_json(send, 404, {"message": f"unknown route /{route}"})
+        if method != "POST":
+            return await send_json(send, 405, {"message": "use POST"})
+        if not service.ready:
+            service.counters["rejected"] += 1
+            return await send_json(send, 503, {"message": "service not ready"})
+
+        try:
+            event = json.loads(await read_body(receive, service.config.max_body_bytes) or b"{}")
+        except ValueError as e:
+            return await send_json(send, 400, {"message": f"invalid body: {e}"})
+
+        try:
+            result = await service.handle(route, event)
+        except Overloaded:
+            service.counters["rejected"] += 1
+            return await send_json(send, 503, {"message": "too many requests in flight"})
+        except asyncio.TimeoutError:
+            service.counters["timeouts"] += 1
+            return await send_json(send, 504, {"message": "request timed out"})
+        except Exception as e:
+            service.counters["errors"] += 1
+            logger.exception(f"/{route} failed")
+            return await send_json(send, 500, {"message": str(e)})
+
+        await send_json(send, 200, result)
+
+
+app = App()
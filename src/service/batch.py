@@ -0,0 +1,239 @@
+#Offline batch runner of question sets (evaluation and regression runs) through the ConversationalRetrievalChain, the state
+#machine run in process (express mode, see express.py) or one handler, with a pool of worker threads.
+#The input is a jsonl file, one question or conversation per line:
+#  {"id": "q1", "question": "movies with tom cruise", ...other fields of the event}
+#  {"id": "c1", "conversation": ["movies with tom cruise", "which one is the most recent?"]}  (turns run in order, same session)
+#The results of each finished line are appended to a checkpoint (<output>.checkpoint.jsonl): an interrupted run started again
+#with the same output skips the lines already done. At the end, one row per turn (output, status, latency and the time and
+#number of the llm, embedding and search calls) is written to the output: .parquet (pandas and pyarrow), .csv or .json (columns).
+#The bedrock calls are limited per model with --rate-limits (see utils/rate_limit.py) to stay under the account quotas.
+#
+#usage:
+#  python batch.py --input questions.jsonl --output results.parquet --mode chain --chain-config chain.json --concurrency 32
+#  python batch.py --input questions.jsonl --output results.parquet --mode turn --state-machine state_machine.json --defaults prompts.json \
+#                  --rate-limits "anthropic.claude-3-haiku-20240307-v1:0=2000,cohere.embed-english-v3=2000"
+#  python batch.py --input questions.jsonl --output results.csv --mode semantic --standins
+
+import argparse
+import concurrent.futures
+import csv
+import json
+import os
+import sys
+import threading
+import time
+
+#adding our utils library to sys path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from service import app as service_app
+from service import loadtest
+from utils import metrics
+from utils import rate_limit
+from utils import traffic_capture
+
+stage_names = ["llm", "embedding", "search"]
+
+columns = ["id", "turn", "route", "question", "output", "status", "error", "latency_ms"] + \
+          [f"{stage}_{value}" for stage in stage_names for value in ["calls", "ms"]]
+
+
+def read_input(path):
+    lines = []
+    with open(path) as file:
+        for number, line in enumerate(file):
+            if line.strip():
+                line = json.loads(line)
+                line.setdefault("id", str(number))
+                lines.append(line)
+    return lines
+
+#rows of the checkpoint, the last rows of each line when a line was run several times
+def read_checkpoint(path):
+    rows = {}
+    if os.path.exists(path):
+        with open(path) as file:
+            for line in file:
+                if line.strip():
+                    row = json.loads(line)
+                    rows[(row["id"], row["turn"])] = row
+    return rows
+
+#turns of a line: the conversation, or the line itself as a single question
+def turns_of(line):
+    turns = line.get("conversation", [line])
+    return [turn if isinstance(turn, dict) else {"question": turn} for turn in turns]
+
+#text of the answer of a handler, the chain or the state machine
+def output_of(result):
+    if isinstance(result, dict) and isinstance(result.get("message"), str):
+        return result["message"]
+    return json.dumps(result, default=str)
+
+def status_of(result):
+    status = traffic_capture.status_of(result)
+    return status if status is not None else 200
+
+
+class BatchRunner:
+
+    def __init__(self, service, route, defaults, checkpoint_path) -> None:
+        self.service = service
+        self.route = route
+        self.defaults = defaults
+        self.checkpoint_path = checkpoint_path
+        self.lock = threading.Lock()
+
+    #event of a turn: the defaults, the fields of the line and of the turn, the conversation so far
+    def build_event(self, line, turn, history):
+        event = {**self.defaults, **{key: value for key, value in line.items() if key not in ["id", "conversation"]}, **turn}
+        if self.route == "chain":
+            event.setdefault("session_id", f"batch-{line['id']}")
+        else:
+            event.setdefault("history", list(history))
+        return event
+
+    #run the turns of a line in order, the following turns get the history of the previous ones
+    def run_line(self, line):
+        rows = []
+        history = []
+        for number, turn in enumerate(turns_of(line)):
+            event = self.build_event(line, turn, history)
+            row = {"id": line["id"], "turn": number, "route": self.route, "question": event.get("question", ""), "output": "", "error": ""}
+
+            start = time.time()
+            with traffic_capture.collect() as stages:
+                try:
+                    result = self.service.invoke(self.route, event)
+                    row["output"] = output_of(result)
+                    row["status"] = status_of(result)
+                except Exception as e:
+                    row["status"] = "error"
+                    row["error"] = f"{type(e).__name__}: {e}"
+            row["latency_ms"] = round((time.time() - start) * 1000, 2)
+            for stage in stage_names:
+                row[f"{stage}_calls"] = len(stages.get(stage, []))
+                row[f"{stage}_ms"] = round(sum(stages.get(stage, [])), 2)
+            rows.append(row)
+
+            history.append({"role": "user", "content": [{"text": row["question"]}]})
+            history.append({"role": "assistant", "content": [{"text": row["output"]}]})
+
+        self.save(rows)
+        return rows
+
+    #append the rows of a finished line to the checkpoint
+    def save(self, rows):
+        lines = "".join(json.dumps(row, default=str) + "\n" for row in rows)
+        with self.lock:
+            with open(self.checkpoint_path, "a") as file:
+                file.write(lines)
+                file.flush()
+
+
+def write_output(rows, path):
+    if path.endswith(".parquet"):
+        import pandas as pd
+
+        pd.DataFrame(rows, columns=columns).astype({"status": str}).to_parquet(path, index=False)
+    elif path.endswith(".csv"):
+        with open(path, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(rows)
+    else:
+        with open(path, "w") as file:
+            json.dump({column: [row.get(column) for row in rows] for column in columns}, file)
+
+def summarize(rows, elapsed, lines_run, lines_skipped):
+    latencies = [row["latency_ms"] for row in rows]
+    summary = {
+        "lines_run": lines_run,
+        "lines_skipped": lines_skipped,
+        "turns": len(rows),
+        "errors": sum(1 for row in rows if row["status"] == "error" or (isinstance(row["status"], int) and row["status"] >= 400)),
+        "elapsed_s": round(elapsed, 1),
+        "turns_per_s": round(len(rows) / elapsed, 2) if elapsed else 0,
+        "latency_p50_ms": loadtest.percentile(latencies, 50),
+        "latency_p95_ms": loadtest.percentile(latencies, 95),
+        "rate_limit_waits": metrics.get_total("RateLimitWaits"),
+    }
+    for stage in stage_names:
+        summary[f"{stage}_calls"] = sum(row[f"{stage}_calls"] for row in rows)
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a question set through the chain, the state machine or a handler with bounded concurrency")
+    parser.add_argument("--input", required=True, help="jsonl file of questions and conversations")
+    parser.add_argument("--output", required=True, help=".parquet, .csv or .json file of the results")
+    parser.add_argument("--mode", default="turn", help="chain, turn (state machine in process) or the route of a handler e.g. semantic")
+    parser.add_argument("--chain-config", default=os.environ.get("SERVICE_CHAIN_CONFIG", ""), help="json configuration of the chain (see service/app.py)")
+    parser.add_argument("--state-machine", default=os.environ.get("SERVICE_STATE_MACHINE", ""), help="state machine definition saved by notebook 3")
+    parser.add_argument("--defaults", help="json file of the fields added to every event e.g. prompts, os_host, index_name")
+    parser.add_argument("--concurrency", type=int, default=32, help="lines running at the same time")
+    parser.add_argument("--rate-limits", default="", help="requests per minute per model id: model=rpm,model=rpm")
+    parser.add_argument("--timeout-ms", type=int, default=29000, help="time given to each turn")
+    parser.add_argument("--retry-errors", action="store_true", help="run again the lines of the checkpoint with an error")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint")
+    parser.add_argument("--standins", action="store_true", help="local stand-ins of bedrock and opensearch (see standins.py)")
+    args = parser.parse_args()
+
+    if args.mode == "chain" and not args.chain_config:
+        parser.error("--chain-config is required with --mode chain")
+    if args.mode == "turn" and not args.state_machine:
+        parser.error("--state-machine is required with --mode turn")
+    if args.mode not in ["chain", "turn"] and args.mode not in service_app.handler_files:
+        parser.error(f"unknown mode {args.mode}")
+
+    if args.rate_limits:
+        rate_limit.configure(rate_limit.parse_limits(args.rate_limits))
+
+    defaults = {}
+    if args.defaults:
+        with open(args.defaults) as file:
+            defaults = json.load(file)
+    if args.standins:
+        from service import standins
+        defaults = {"os_host": standins.standin_host, "index_name": standins.standin_index, **defaults}
+
+    #the handlers, chain and state machine are loaded as in the service
+    routes = {"chain": ["chain"], "turn": sorted(set(service_app.handler_files) - {"agent/semantic-search", "agent/movie-details"})}
+    service = service_app.Service(service_app.ServiceConfig({
+        "SERVICE_ROUTES": ",".join(routes.get(args.mode, [args.mode])),
+        "SERVICE_CHAIN_CONFIG": args.chain_config if args.mode == "chain" else "",
+        "SERVICE_STATE_MACHINE": args.state_machine if args.mode == "turn" else "",
+        "SERVICE_REQUEST_TIMEOUT_MS": str(args.timeout_ms),
+        "SERVICE_MAX_CONCURRENCY": str(args.concurrency),
+        "SERVICE_STANDINS": "1" if args.standins else "",
+    }))
+    service.startup()
+
+    checkpoint_path = args.output + ".checkpoint.jsonl"
+    if args.restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    done = read_checkpoint(checkpoint_path)
+    failed = {line_id for (line_id, _), row in done.items() if row["status"] == "error"}
+    done_ids = {line_id for line_id, _ in done} - (failed if args.retry_errors else set())
+
+    lines = read_input(args.input)
+    todo = [line for line in lines if line["id"] not in done_ids]
+    runner = BatchRunner(service, args.mode, defaults, checkpoint_path)
+
+    start = time.time()
+    rows = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="batch") as executor:
+        futures = [executor.submit(runner.run_line, line) for line in todo]
+        for count, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            rows.extend(future.result())
+            if count % 100 == 0:
+                print(f"{count}/{len(todo)} lines, {count / (time.time() - start):.1f} lines/s", file=sys.stderr)
+    elapsed = time.time() - start
+
+    #results of the lines of the input, from this run and the previous ones
+    all_rows = read_checkpoint(checkpoint_path)
+    input_ids = {line["id"] for line in lines}
+    write_output(sorted((row for (line_id, _), row in all_rows.items() if line_id in input_ids), key=lambda row: (str(row["id"]), row["turn"])), args.output)
+
+    print(json.dumps(summarize(rows, elapsed, len(todo), len(lines) - len(todo)), indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+#In-process executor of the conversational search state machine ("express mode").
+#The state machine definition of notebooks/3-notebook_step_functions.ipynb is interpreted in the process and the
+#lambda_handler functions are called directly with the same events, without state transitions, lambda invokes and
+#payload serialization between the states.
+#While the routing step runs, the work of the likely branch is started speculatively:
+#  "embedding": the embedding of the question is prefetched (used when the question is searched as it is)
+#  "branch": the most frequent side-effect free branch (semantic or standard search) is run with the question,
+#            its result is used if the routing chooses it with the same event, discarded otherwise
+#
+#usage:
+#  orchestrator = ExpressOrchestrator(state_machine_definition, handlers)
+#  output = orchestrator.run({"question": ..., "history": [], "system_prompt": ..., "prefill": ..., "session_id": ...})
+
+import concurrent.futures
+import copy
+import os
+import sys
+import threading
+
+#adding our utils library to sys path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils import deadline
+from utils import llm_utils
+from utils import metrics
+
+#handler route of each task state of the state machine
+state_routes = {
+    "routing_step": "routing",
+    "semantic_search": "semantic",
+    "standard_search": "standard",
+    "similar_step": "similar",
+    "specific_question_step": "specific",
+    "open_question_step": "open",
+    "sorting_step": "sorting",
+}
+
+#branches that can run before the routing is known: they do not write to the session store
+speculative_states = ["semantic_search", "standard_search"]
+
+
+class ExecutionFailed(Exception):
+
+    def __init__(self, error, cause="") -> None:
+        super().__init__(f"{error}: {cause}")
+        self.error = error
+        self.cause = cause
+
+
+#value of a JSONPath ("$" or "$.a.b"), KeyError if a property is missing as in Step Functions
+def get_path(doc, path):
+    value = doc
+    for part in path[2:].split(".") if path != "$" else []:
+        if not isinstance(value, dict) or part not in value:
+            raise KeyError(path)
+        value = value[part]
+    return value
+
+#document with the value set at the JSONPath, the original document is not modified
+def set_path(doc, path, value):
+    if path == "$":
+        return value
+    parts = path[2:].split(".")
+    result = dict(doc)
+    current = result
+    for part in parts[:-1]:
+        current[part] = dict(current.get(part, {}))
+        current = current[part]
+    current[parts[-1]] = value
+    return result
+
+#Parameters of a state: static values and ".$" paths of the state input
+def resolve_parameters(parameters, doc):
+    event = {}
+    for key, value in parameters.items():
+        if key.endswith(".$"):
+            event[key[:-2]] = get_path(doc, value)
+        elif isinstance(value, dict):
+            event[key] = resolve_parameters(value, doc)
+        else:
+            event[key] = value
+    return event
+
+
+class ExpressOrchestrator:
+
+    #definition: state machine definition (Amazon States Language dict), handlers: route -> module with lambda_handler
+    #context_factory: function (route) -> lambda context given to the handlers, None by default
+    def __init__(self, definition, handlers, speculate="branch", executor=None, context_factory=None, routes=None, min_share=0.3, min_runs=10) -> None:
+        self.definition = definition
+        self.handlers = handlers
+        self.speculate = speculate
+        self.executor = executor or concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="express")
+        self.context_factory = context_factory
+        self.routes = routes or state_routes
+        self.min_share = min_share
+        self.min_runs = min_runs
+        #branch taken after the routing, used to predict the next one
+        self.branch_counts = {}
+        self.lock = threading.Lock()
+        self.counters = {"runs": 0, "speculations": 0, "hits": 0, "misses": 0}
+
+    #run the handler of a task state
+    def invoke_task(self, state_name, event):
+        route = self.routes[state_name]
+        context = self.context_factory(route) if self.context_factory else None
+        return self.handlers[route].lambda_handler(event, context)
+
+    #most frequent branch after the routing if it can run speculatively, the semantic search until there are enough runs
+    def predict_branch(self):
+        with self.lock:
+            total = sum(self.branch_counts.values())
+            if total < self.min_runs:
+                return speculative_states[0]
+            state, count = max(self.branch_counts.items(), key=lambda item: item[1])
+        if state in speculative_states and count / total >= self.min_share:
+            return state
+        return None
+
+    #start the speculative work of the turn, returns (state name, event, future) of a speculative branch or None
+    def start_speculation(self, doc):
+        question = doc.get("question", "")
+        if self.speculate == "embedding" and question:
+            self.executor.submit(llm_utils.get_embeddings_from_text, question, "cohere", input_type="search_query")
+            return None
+
+        if self.speculate != "branch":
+            return None
+
+        state_name = self.predict_branch()
+        start = self.definition["States"][self.definition["StartAt"]]
+        if state_name is None or "Parameters" not in self.definition["States"][state_name]:
+            return None
+
+        #output expected from the routing step: the question and the deadline of the turn
+        predicted = set_path(doc, start.get("ResultPath", "$"), {"question": question, "deadline": doc.get("deadline")})
+        try:
+            event = resolve_parameters(self.definition["States"][state_name]["Parameters"], predicted)
+        except KeyError:
+            return None
+
+        with self.lock:
+            self.counters["speculations"] += 1
+        return state_name, event, self.executor.submit(self.invoke_task, state_name, copy.deepcopy(event))
+
+    #run a turn and return the output of the last state, ExecutionFailed for a Fail state or a handler error
+    def run(self, execution_input):
+        doc = dict(execution_input)
+        #one deadline for the turn, shared by the routing and the speculative branch
+        if not doc.get("deadline"):
+            doc["deadline"] = deadline.Deadline.from_event(doc, budget_ms=deadline.default_budget_ms).to_event()
+
+        with self.lock:
+            self.counters["runs"] += 1
+        speculation = self.start_speculation(doc)
+        state_name = self.definition["StartAt"]
+        after_routing = False
+        branch = None
+
+        while True:
+            state = self.definition["States"][state_name]
+
+            if state["Type"] == "Task":
+                #the whole document is given when there are no Parameters, it is copied as the handlers can modify their event
+                event = resolve_parameters(state["Parameters"], doc) if "Parameters" in state else copy.deepcopy(doc)
+                if speculation is not None and speculation[0] == state_name and speculation[1] == event:
+                    result = self.take_speculation(speculation)
+                    speculation = None
+                else:
+                    try:
+                        result = self.invoke_task(state_name, event)
+                    except Exception as e:
+                        raise ExecutionFailed("Lambda.Unknown", str(e))
+                doc = set_path(doc, state.get("ResultPath", "$"), result)
+                if after_routing and branch is None:
+                    branch = state_name
+                after_routing = True
+
+            elif state["Type"] == "Choice":
+                state_name = self.choose(state, doc)
+                continue
+
+            elif state["Type"] == "Pass":
+                doc = set_path(doc, state.get("ResultPath", "$"), state["Result"]) if "Result" in state else doc
+
+            elif state["Type"] == "Fail":
+                self.finish(branch or state_name, speculation)
+                raise ExecutionFailed(state.get("Error", "States.Fail"), state.get("Cause", ""))
+
+            if state.get("End"):
+                self.finish(branch or state_name, speculation)
+                return doc
+            state_name = state["Next"]
+
+    def take_speculation(self, speculation):
+        with self.lock:
+            self.counters["hits"] += 1
+        metrics.put_metrics({"SpeculationHits": 1}, dimensions={"State": speculation[0]})
+        try:
+            return speculation[2].result()
+        except Exception as e:
+            raise ExecutionFailed("Lambda.Unknown", str(e))
+
+    #record the branch taken, a speculative branch that was not used is a miss (its result is dropped)
+    def finish(self, branch, speculation):
+        with self.lock:
+            self.branch_counts[branch] = self.branch_counts.get(branch, 0) + 1
+            if speculation is not None:
+                self.counters["misses"] += 1
+        if speculation is not None:
+            metrics.put_metrics({"SpeculationMisses": 1}, dimensions={"State": speculation[0]})
+
+    #next state of a Choice state (StringEquals, NumericEquals and BooleanEquals rules)
+    def choose(self, state, doc):
+        for choice in state.get("Choices", []):
+            try:
+                value = get_path(doc, choice["Variable"])
+            except KeyError:
+                continue
+            for operator in ["StringEquals", "NumericEquals", "BooleanEquals"]:
+                if operator in choice and value == choice[operator]:
+                    return choice["Next"]
+        if "Default" not in state:
+            raise ExecutionFailed("States.NoChoiceMatched", f"no choice matched in {state}")
+        return state["Default"]
+
+    def stats(self):
+        with self.lock:
+            return {
+                **self.counters,
+                "hit_rate": self.counters["hits"] / self.counters["speculations"] if self.counters["speculations"] else 0.0,
+                "branches": dict(self.branch_counts),
+            }
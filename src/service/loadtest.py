@@ -0,0 +1,196 @@
+#Load test of the service: latency percentiles, throughput and status codes per endpoint.
+#Without --target, the service is started in this process with the local stand-ins of Bedrock and OpenSearch
+#(see standins.py) and the requests are sent to the ASGI application directly, so no AWS account nor HTTP server is needed.
+#With --target, the requests are sent over HTTP to a running service (e.g. started with SERVICE_STANDINS=1).
+#
+#usage: python loadtest.py --requests 2000 --concurrency 64 --routes semantic,standard,sorting
+#       python loadtest.py --target http://localhost:8080 --requests 2000 --concurrency 64
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import random
+import sys
+import time
+import urllib.error
+import urllib.request
+
+#adding our utils library to sys path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+questions = ["movies with tom cruise", "a funny movie for kids", "best thrillers of the 90s", "movies like inception", "who directed the godfather?"]
+
+tool_list_standard = [{"toolSpec": {"name": "standard_search", "description": "filters of the search",
+                                    "inputSchema": {"json": {"type": "object", "properties": {"genres": {"type": "string"}}}}}}]
+tool_list_sort = [{"toolSpec": {"name": "sort", "description": "property to sort the movies",
+                                "inputSchema": {"json": {"type": "object", "properties": {"sort_by": {"type": "string", "enum": ["popularity", "year", "vote_average"]}}}}}}]
+
+#event of each endpoint for a question, against the stand-in opensearch
+def build_event(route, question, host, index_name):
+    search = {"question": question, "index_name": index_name, "os_host": host, "number_results": 10}
+    events = {
+        "routing": {"question": question, "history": []},
+        "semantic": {**search, "filter_mode": "efficient", "projection": "list"},
+        "standard": {**search, "tool_list": tool_list_standard, "projection": "list"},
+        "similar": {**search, "history": [], "projection": "list"},
+        "specific": {**search, "history": [], "system_prompt_specific": "Answer about the movie <document>{context}</document>"},
+        "open": {"question": question, "history": []},
+        "sorting": {"question": question, "tool_list": tool_list_sort,
+                    "list_to_sort": [{"tmdb_id": i, "popularity": random.random(), "year": 2000 + i} for i in range(10)]},
+        "agent/semantic-search": {"actionGroup": "semantic", "apiPath": "/semantic-search", "httpMethod": "GET",
+                                  "parameters": [{"name": "question", "value": question}, {"name": "orderby", "value": "popularity"}]},
+        "agent/movie-details": {"actionGroup": "details", "apiPath": "/movie-details", "httpMethod": "GET",
+                                "parameters": [{"name": "properties", "value": "[{'genres': 'Drama'}]"}]},
+        "chain": {"question": question, "session_id": f"loadtest-{random.randrange(100)}"},
+    }
+    return events[route]
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0
+
+def summarize(results, elapsed):
+    summary = {"requests": len(results), "elapsed_s": elapsed, "throughput_rps": len(results) / elapsed, "routes": {}}
+    for route in sorted({route for route, _, _ in results}):
+        latencies = [latency for r, _, latency in results if r == route]
+        statuses = {}
+        for r, status, _ in results:
+            if r == route:
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+        summary["routes"][route] = {
+            "requests": len(latencies),
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "status": statuses,
+            "error_rate": sum(count for status, count in statuses.items() if not status.startswith("2")) / len(latencies),
+        }
+    return summary
+
+
+#requests sent to the ASGI application of this process
+async def asgi_request(app, method, path, body=None):
+    payload = json.dumps(body).encode("utf-8") if body is not None else b""
+    scope = {"type": "http", "method": method, "path": path, "headers": [(b"content-type", b"application/json")]}
+    sent = {"status": None, "body": b""}
+
+    async def receive():
+        return {"type": "http.request", "body": payload, "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            sent["status"] = message["status"]
+        else:
+            sent["body"] += message.get("body", b"")
+
+    await app(scope, receive, send)
+    return sent["status"], sent["body"]
+
+async def run_in_process(args, routes):
+    os.environ["SERVICE_STANDINS"] = "1"
+    os.environ.setdefault("SERVICE_MAX_CONCURRENCY", str(args.concurrency))
+    from service import app as service_app
+    from service import standins
+
+    app = service_app.App(service_app.Service(service_app.ServiceConfig()))
+    startup_task = await lifespan_start(app)
+
+    results = []
+    counter = {"sent": 0}
+
+    async def worker():
+        while counter["sent"] < args.requests:
+            counter["sent"] += 1
+            route = random.choice(routes)
+            event = build_event(route, random.choice(questions), standins.standin_host, standins.standin_index)
+            start = time.time()
+            status, _ = await asgi_request(app, "POST", f"/{route}", event)
+            results.append((route, status, time.time() - start))
+
+    start = time.time()
+    await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    elapsed = time.time() - start
+
+    _, metrics_body = await asgi_request(app, "GET", "/metrics")
+    await lifespan_stop(app, startup_task)
+
+    summary = summarize(results, elapsed)
+    summary["service"] = json.loads(metrics_body)["service"]
+    return summary
+
+#the lifespan of the application runs in a single task receiving the startup then the shutdown message
+async def lifespan_start(app):
+    queue = asyncio.Queue()
+    started = asyncio.Event()
+    stopped = asyncio.Event()
+
+    async def receive():
+        return await queue.get()
+
+    async def send(message):
+        if message["type"].startswith("lifespan.startup"):
+            started.set()
+        else:
+            stopped.set()
+
+    await queue.put({"type": "lifespan.startup"})
+    task = asyncio.ensure_future(app({"type": "lifespan"}, receive, send))
+    await started.wait()
+    return task, queue, stopped
+
+async def lifespan_stop(app, startup_task):
+    task, queue, stopped = startup_task
+    await queue.put({"type": "lifespan.shutdown"})
+    await stopped.wait()
+    await task
+
+
+#requests sent over HTTP to a running service
+def http_request(target, route, event, timeout):
+    request = urllib.request.Request(f"{target}/{route}", data=json.dumps(event).encode("utf-8"),
+                                     headers={"content-type": "application/json"}, method="POST")
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except Exception:
+        return "error"
+
+def run_http(args, routes):
+    from service import standins
+
+    def one(_):
+        route = random.choice(routes)
+        event = build_event(route, random.choice(questions), standins.standin_host, standins.standin_index)
+        start = time.time()
+        status = http_request(args.target.rstrip("/"), route, event, args.timeout)
+        return route, status, time.time() - start
+
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(one, range(args.requests)))
+    return summarize(results, time.time() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the service, in process with the local stand-ins or against a running service")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--routes", default="semantic,standard,similar,specific,sorting,agent/semantic-search")
+    parser.add_argument("--target", default="", help="url of a running service, the service runs in this process with the stand-ins otherwise")
+    parser.add_argument("--timeout", type=float, default=30)
+    args = parser.parse_args()
+
+    random.seed(0)
+    routes = args.routes.split(",")
+    if args.target:
+        summary = run_http(args, routes)
+    else:
+        summary = asyncio.run(run_in_process(args, routes))
+    print(json.dumps(summary, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+#Replay the traffic captured by utils/traffic_capture.py (TRAFFIC_CAPTURE jsonl files) at a target rate.
+#The requests arrive in open loop: each request is sent at its scheduled time whether or not the previous ones completed,
+#and its latency is measured from that time, so the queueing when the handlers are saturated is part of the latency.
+#Without --target, the handlers run in this process against the local stand-ins of Bedrock and OpenSearch (see standins.py),
+#whose latencies are sampled from the stage timings of the capture. With --target, the requests are sent to a running service.
+#
+#usage: python replay.py --capture capture.jsonl --qps 50 --duration 60 --concurrency 32
+#       python replay.py --capture capture.jsonl --qps 50 --arrivals recorded --speedup 4 --target http://localhost:8080
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import random
+import sys
+
+#adding our utils library to sys path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from service import loadtest
+
+#stage of the capture -> kind of call of the stand-ins
+stage_kinds = {"llm": "llm", "embedding": "embedding", "search": "search"}
+
+
+def load_capture(paths, routes=None):
+    records = []
+    for path in paths:
+        with open(path) as file:
+            for line in file:
+                if line.strip():
+                    record = json.loads(line)
+                    if not routes or record["route"] in routes:
+                        records.append(record)
+    records.sort(key=lambda record: record["ts"])
+    return records
+
+#latencies in ms of each kind of call of the stand-ins, from the stage timings of the capture
+def latency_distributions(records):
+    samples = {}
+    for record in records:
+        for stage, durations in record.get("stages", {}).items():
+            if stage in stage_kinds:
+                samples.setdefault(stage_kinds[stage], []).extend(durations)
+    return samples
+
+#question of a record, a question of the load test when it was redacted
+def question_of(value, generator):
+    return value if isinstance(value, str) else generator.choice(loadtest.questions)
+
+#handler event rebuilt from a sanitized event: placeholders of the recorded size for the prompts, the history and the documents
+def replay_event(record, host, index_name, generator):
+    sanitized = record["event"]
+    question = question_of(sanitized.get("question", ""), generator)
+    event = loadtest.build_event(record["route"], question, host, index_name)
+
+    for key in ["number_results", "projection", "filter_mode", "k", "history_window", "text_profile", "search_backend", "time_budget_ms"]:
+        if key in sanitized:
+            event[key] = sanitized[key]
+    if "history_length" in sanitized:
+        event["history"] = [{"role": "user" if i % 2 == 0 else "assistant", "content": [{"text": f"replayed turn {i}"}]}
+                            for i in range(sanitized["history_length"])]
+    if "list_length" in sanitized:
+        event["list_to_sort"] = [{"tmdb_id": i, "popularity": generator.random(), "year": 2000 + i % 25, "vote_average": generator.uniform(1, 10)}
+                                 for i in range(sanitized["list_length"])]
+    for key, chars in sanitized.get("prompt_chars", {}).items():
+        event[key] = ("replayed prompt " * (chars // 16 + 1))[:chars]
+    if "session" in sanitized:
+        event["session_id"] = f"replay-{sanitized['session']}"
+    if isinstance(sanitized.get("parameters"), dict):
+        event["parameters"] = [{"name": name, "value": question_of(value, generator) if name == "question" else value}
+                               for name, value in sanitized["parameters"].items()]
+    return event
+
+#arrival times in seconds from the start: poisson arrivals at the target rate, or the recorded arrivals sped up
+def schedule(records, args, generator):
+    if args.arrivals == "recorded":
+        first = records[0]["ts"]
+        times = [(record["ts"] - first) / args.speedup for record in records]
+        return [(t, record) for t, record in zip(times, records) if not args.duration or t <= args.duration]
+
+    arrivals = []
+    t = 0.0
+    while len(arrivals) < (args.requests or float("inf")):
+        t += generator.expovariate(args.qps)
+        if args.duration and t > args.duration:
+            break
+        arrivals.append((t, records[len(arrivals) % len(records)]))
+    return arrivals
+
+
+async def replay(arrivals, send, concurrency):
+    loop = asyncio.get_running_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="replay")
+    results = []
+
+    async def one(scheduled, route, event):
+        status = await loop.run_in_executor(executor, send, route, event)
+        results.append((route, status, loop.time() - scheduled))
+
+    start = loop.time()
+    tasks = []
+    for t, route, event in arrivals:
+        delay = start + t - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(one(start + t, route, event)))
+    await asyncio.gather(*tasks)
+    elapsed = loop.time() - start
+    executor.shutdown(wait=False)
+    return results, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured traffic against the handlers with the local stand-ins or a running service")
+    parser.add_argument("--capture", required=True, nargs="+", help="jsonl files written by the traffic capture")
+    parser.add_argument("--qps", type=float, default=20, help="target rate of the poisson arrivals")
+    parser.add_argument("--arrivals", default="poisson", choices=["poisson", "recorded"])
+    parser.add_argument("--speedup", type=float, default=1, help="speed up of the recorded arrivals")
+    parser.add_argument("--duration", type=float, default=60, help="seconds of traffic, 0 for no limit")
+    parser.add_argument("--requests", type=int, default=0, help="maximum number of requests, 0 for no limit")
+    parser.add_argument("--concurrency", type=int, default=32, help="requests running at the same time, the others wait")
+    parser.add_argument("--routes", default="", help="routes to replay, all by default")
+    parser.add_argument("--target", default="", help="url of a running service, the handlers run in this process otherwise")
+    parser.add_argument("--recorded-latency", default="on", choices=["on", "off"], help="stand-in latencies sampled from the capture")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if not args.duration and not args.requests and args.arrivals == "poisson":
+        parser.error("--duration or --requests is required")
+
+    generator = random.Random(args.seed)
+    records = load_capture(args.capture, args.routes.split(",") if args.routes else None)
+    if not records:
+        parser.error("no record to replay")
+
+    from service import standins
+    arrivals = [(t, record["route"], replay_event(record, standins.standin_host, standins.standin_index, generator))
+                for t, record in schedule(records, args, generator)]
+
+    if args.target:
+        def send(route, event):
+            return loadtest.http_request(args.target.rstrip("/"), route, event, args.timeout)
+    else:
+        from service import app as service_app
+
+        if args.recorded_latency == "on":
+            standins.latency_samples.update(latency_distributions(records))
+        standins.install()
+        handlers = {route: service_app.load_handler(route) for route in sorted({route for _, route, _ in arrivals})}
+        standins.install_handlers(handlers.values())
+
+        def send(route, event):
+            try:
+                result = handlers[route].lambda_handler(event, service_app.RequestContext(route, args.timeout * 1000))
+            except Exception:
+                return "error"
+            status = result.get("statusCode") if isinstance(result, dict) else None
+            if status is None and isinstance(result, dict):
+                status = result.get("response", {}).get("httpStatusCode")
+            return status or 200
+
+    results, elapsed = asyncio.run(replay(arrivals, send, args.concurrency))
+    summary = loadtest.summarize(results, elapsed)
+    summary["offered_rps"] = len(arrivals) / arrivals[-1][0] if arrivals and arrivals[-1][0] > 0 else 0
+    summary["stand_in_latency_samples"] = {kind: len(values) for kind, values in standins.latency_samples.items()}
+    print(json.dumps(summary, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+#Local stand-ins of Bedrock and OpenSearch Serverless to load test the service without AWS.
+#They answer with the shape expected by the handlers after a simulated latency, the answers are not meaningful.
+#
+#STANDIN_LATENCY_MS: latency of the bedrock calls (default 50), STANDIN_SEARCH_LATENCY_MS: latency of the searches (default 20)
+#STANDIN_SLOW_PROBABILITY / STANDIN_SLOW_FACTOR: share of the calls slower by the factor (default 0.02 and 10)
+#MOVIES_CACHE_PATH: movies returned by the searches (json lines), synthetic movies otherwise
+#latency_samples: latencies in ms per kind of call ("llm", "embedding", "search") sampled instead of the simulated latency,
+#                 e.g. recorded by the traffic capture (see replay.py)
+
+import io
+import json
+import os
+import random
+import re
+import sys
+import time
+
+#adding our utils library to sys path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils import deadline
+from utils import llm_utils
+
+#host and index of the stand-in opensearch, used by the events of the load test and by the secret of the agent lambdas
+standin_host = "standin.aoss.local"
+standin_index = "movies"
+
+latency_samples = {}
+
+
+#sleep for the simulated latency of a call, with a slow tail, or for a latency of the samples of its kind
+def simulate_latency(latency_ms, kind=None):
+    if latency_samples.get(kind):
+        time.sleep(random.choice(latency_samples[kind]) / 1000)
+        return
+    slow_probability = float(os.environ.get("STANDIN_SLOW_PROBABILITY", "0.02"))
+    slow_factor = float(os.environ.get("STANDIN_SLOW_FACTOR", "10"))
+    latency = latency_ms * random.uniform(0.8, 1.2)
+    if random.random() < slow_probability:
+        latency *= slow_factor
+    time.sleep(latency / 1000)
+
+
+#bedrock runtime client answering the converse and invoke_model calls of the handlers
+class StandInBedrock:
+
+    #responder: optional function (system prompt, question) -> answer text, the question is echoed when it returns None
+    def __init__(self, latency_ms=None, dimension=1024, responder=None) -> None:
+        self.latency_ms = float(os.environ.get("STANDIN_LATENCY_MS", "50")) if latency_ms is None else latency_ms
+        self.dimension = dimension
+        self.responder = responder
+
+    #the text of the last user message is echoed between answer tags, the tools are called with the first value of their schema
+    def converse(self, modelId, messages, system=None, toolConfig=None, inferenceConfig=None, **kwargs):
+        simulate_latency(self.latency_ms, "llm")
+
+        question = ""
+        for message in messages:
+            if message["role"] == "user":
+                question = message["content"][0].get("text", "")
+
+        content = []
+        tools = [tool["toolSpec"] for tool in (toolConfig or {}).get("tools", []) if "toolSpec" in tool]
+        if tools:
+            properties = tools[0].get("inputSchema", {}).get("json", {}).get("properties", {})
+            tool_input = {}
+            for name, definition in list(properties.items())[:1]:
+                tool_input[name] = definition.get("enum", ["popularity" if name == "sort_by" else "Drama"])[0]
+            content.append({"toolUse": {"toolUseId": "standin", "name": tools[0]["name"], "input": tool_input}})
+        else:
+            system_prompt = " ".join(block.get("text", "") for block in system or [])
+            answer = self.responder(system_prompt, question) if self.responder else None
+            content.append({"text": answer if answer is not None else f"<answer>{question.strip(chr(34))}</answer>"})
+
+        return {
+            "output": {"message": {"role": "assistant", "content": content}},
+            "stopReason": "tool_use" if tools else "end_turn",
+            "usage": {"inputTokens": sum(len(json.dumps(message)) for message in messages) // 4, "outputTokens": 20},
+        }
+
+    #embeddings (titan and cohere) and anthropic messages
+    def invoke_model(self, body, modelId, accept="application/json", contentType="application/json", **kwargs):
+        if "embed" in modelId:
+            simulate_latency(self.latency_ms / 2, "embedding")
+        else:
+            simulate_latency(self.latency_ms, "llm")
+
+        request = json.loads(body)
+        if "cohere" in modelId:
+            result = {"embeddings": [self.embedding(text) for text in request["texts"]]}
+        elif "titan" in modelId:
+            result = {"embedding": self.embedding(request["inputText"])}
+        else:
+            result = {"content": [{"type": "text", "text": "<response>yes</response>"}]}
+        return {"body": io.BytesIO(json.dumps(result).encode("utf-8"))}
+
+    #deterministic vector of a text
+    def embedding(self, text):
+        generator = random.Random(text)
+        return [generator.uniform(-1, 1) for _ in range(self.dimension)]
+
+
+class StandInIndices:
+
+    def get_mapping(self, index):
+        return {index: {"mappings": llm_utils.get_movies_index_body()["mappings"]}}
+
+
+#opensearch client returning consecutive documents of a local dataset
+class StandInOpenSearch:
+
+    def __init__(self, movies=None, latency_ms=None) -> None:
+        self.latency_ms = float(os.environ.get("STANDIN_SEARCH_LATENCY_MS", "20")) if latency_ms is None else latency_ms
+        self.movies = movies if movies is not None else load_movies()
+        self.positions = {movie["tmdb_id"]: i for i, movie in enumerate(self.movies)}
+        self.indices = StandInIndices()
+
+    def search(self, body, index, **kwargs):
+        simulate_latency(self.latency_ms, "search")
+
+        #the compiled standard queries are json strings
+        if isinstance(body, str):
+            body = json.loads(body)
+        size = body.get("size", 10)
+        source = body.get("_source")
+        includes = source.get("includes") if isinstance(source, dict) else None
+        start = random.randrange(max(1, len(self.movies) - size))
+        #next page of a search_after pagination: the movies after the last one of the previous page (tmdb_id tie breaker)
+        if "search_after" in body:
+            start = self.positions.get(body["search_after"][-1], len(self.movies)) + 1
+        sort_fields = [next(iter(sort)) for sort in body.get("sort", [])]
+
+        hits = []
+        for movie in self.movies[start:start + size]:
+            doc = {key: value for key, value in movie.items() if includes is None or key in includes}
+            hits.append({"_index": index, "_id": str(movie["tmdb_id"]), "_score": 1.0, "_source": doc,
+                         "sort": [movie.get(field) for field in sort_fields]})
+        return {"took": int(self.latency_ms), "timed_out": False, "hits": {"total": {"value": len(hits)}, "hits": hits}}
+
+
+#movies of MOVIES_CACHE_PATH, or synthetic movies
+def load_movies(count=500):
+    path = os.environ.get("MOVIES_CACHE_PATH")
+    if path:
+        return list(llm_utils.load_movies_cache(path).values())
+
+    genres = ["Drama", "Comedy", "Action", "Thriller", "Romance", "Animation", "Science Fiction"]
+    words = re.findall(r"\w+", "a retired detective returns to the city to solve one last case with an unlikely partner while old friends become enemies")
+    generator = random.Random(0)
+    return [{
+        "tmdb_id": i,
+        "original_language": "en",
+        "original_title": f"Movie {i}",
+        "description": " ".join(generator.choice(words) for _ in range(60)),
+        "genres": generator.sample(genres, 2),
+        "year": generator.randint(1970, 2024),
+        "keywords": generator.sample(words, 5),
+        "director": [f"Director {i % 50}"],
+        "actors": [f"Actor {i % 80}", f"Actor {(i * 7) % 80}"],
+        "popularity": round(generator.uniform(0, 100), 2),
+        "popularity_bins": "medium",
+        "vote_average": round(generator.uniform(1, 10), 1),
+        "vote_average_bins": "medium",
+    } for i in range(count)]
+
+
+#stand-ins for the clients created by the utils library: bedrock clients of every timeout, the opensearch client of the
+#stand-in host and the secret of the agent lambdas. To call before loading the handlers (they create clients at import time).
+def install(responder=None):
+    #fake credentials and region so that the handlers can create their signers and clients
+    os.environ.setdefault("AWS_REGION", "us-east-1")
+    os.environ.setdefault("AWS_DEFAULT_REGION", os.environ["AWS_REGION"])
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "standin")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "standin")
+
+    bedrock = StandInBedrock(responder=responder)
+    for bucket in [None] + deadline.timeout_buckets:
+        deadline.bedrock_clients[bucket] = bedrock
+
+    llm_utils.opensearch_clients[standin_host] = StandInOpenSearch()
+    llm_utils.secrets_cache["semantic-api"] = json.dumps({"os_host": standin_host, "index_name": standin_index})
+    return bedrock
+
+#replace the bedrock clients created at import time by the handlers
+def install_handlers(modules):
+    bedrock = deadline.bedrock_clients[None]
+    for module in modules:
+        if hasattr(module, "bedrock_client"):
+            module.bedrock_client = bedrock
@@ -0,0 +1,5 @@
+import os
+import sys
+
+#the modules of src are imported as in the lambdas and the service (from utils import ...)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
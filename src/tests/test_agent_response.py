@@ -0,0 +1,99 @@
+import json
+
+from utils import agent_response
+from utils import llm_utils
+
+
+def movie(i, title="Movie"):
+    return {"tmdb_id": i, "original_language": "en", "original_title": f"{title} {i}", "description": "A long description " * 20,
+            "genres": ["Drama", "Action"], "year": 1990 + i % 30, "keywords": ["keyword"] * 10, "director": "A Director",
+            "actors": ["An Actor", "Another Actor"], "popularity": 100.0 - i, "popularity_bins": "popular",
+            "vote_average": 7.5, "vote_average_bins": "good"}
+
+#size of the body once it is in the json of the lambda response, as the lambda runtime serializes it
+def response_size(body):
+    return len(json.dumps({"body": body})) - len('{"body": ""}')
+
+
+def test_small_response_keeps_every_property():
+    body, stats = agent_response.encode_movies([movie(i) for i in range(3)], max_bytes=20000)
+    decoded = json.loads(body)
+    assert stats["level"] == "full"
+    assert decoded["truncated"] is False
+    assert [doc["tmdb_id"] for doc in decoded["movies"]] == [0, 1, 2]
+    assert set(decoded["movies"][0]) == set(llm_utils.projection_profiles["full"])
+
+
+#the properties are dropped before the movies
+def test_properties_are_trimmed_before_the_movies():
+    movies = [movie(i) for i in range(20)]
+    body, stats = agent_response.encode_movies(movies, max_bytes=8000)
+    decoded = json.loads(body)
+    assert stats["level"] == "list"
+    assert len(decoded["movies"]) == 20
+    assert decoded["truncated"] is False
+    assert set(decoded["movies"][0]) == set(llm_utils.projection_profiles["list"])
+    assert response_size(body) <= 8000
+
+
+def test_last_movies_are_dropped_with_the_smallest_projection():
+    movies = [movie(i) for i in range(500)]
+    body, stats = agent_response.encode_movies(movies, max_bytes=5000)
+    decoded = json.loads(body)
+    assert stats["level"] == "titles"
+    assert decoded["truncated"] is True
+    assert 0 < len(decoded["movies"]) < 500
+    assert [doc["tmdb_id"] for doc in decoded["movies"]] == list(range(len(decoded["movies"])))
+    assert response_size(body) <= 5000
+
+
+#a stream is read only until the movies do not fit with the smallest projection
+def test_stream_stops_when_full():
+    read = []
+    def stream():
+        for i in range(1000):
+            read.append(i)
+            yield movie(i)
+
+    body, stats = agent_response.encode_movies(stream(), max_bytes=5000)
+    assert json.loads(body)["truncated"] is True
+    assert len(read) == stats["movies"] + 1
+
+
+#the non-ascii titles are counted as they are escaped (\uXXXX) in the lambda response
+def test_size_bound_with_non_ascii_titles():
+    movies = [movie(i, title="Amélie 千と千尋の神隠し 🎬") for i in range(200)]
+    for max_bytes in [2000, 5000, 20000]:
+        body, stats = agent_response.encode_movies(movies, max_bytes=max_bytes)
+        assert response_size(body) <= max_bytes
+        assert stats["escaped_bytes"] == response_size(body)
+
+
+def test_action_response_keeps_message_version():
+    event = {"messageVersion": "1.0", "actionGroup": "movies", "apiPath": "/movies", "httpMethod": "GET"}
+    response = agent_response.action_response(event, '{"movies":[],"truncated":false}')
+    assert response["messageVersion"] == "1.0"
+    assert response["response"]["responseBody"]["application/json"]["body"] == '{"movies":[],"truncated":false}'
+
+
+class SearchClient:
+
+    def __init__(self, movies) -> None:
+        self.movies = movies
+        self.searches = []
+
+    def search(self, body, index):
+        self.searches.append(body)
+        start = len(self.movies) if "search_after" in body else 0
+        return {"hits": {"hits": [{"_source": doc, "sort": [doc["popularity"], doc["tmdb_id"]]} for doc in self.movies[start:start + body["size"]]]}}
+
+#the movie details route reads its capped number of movies in one search and keeps their properties when they fit
+def test_capped_search_keeps_full_records():
+    client = SearchClient([movie(i) for i in range(200)])
+    documents = llm_utils.stream_standard_query([{"genres": "Drama"}], client, "movies", llm_utils.projection_profiles["full"],
+                                                 page_size=10, max_results=10, schema=llm_utils.index_schema)
+    body, stats = agent_response.encode_movies(documents)
+    assert len(client.searches) == 1
+    assert stats["level"] == "full"
+    assert stats["movies"] == 10
+    assert json.loads(body)["truncated"] is False
@@ -0,0 +1,63 @@
+import time
+
+import pytest
+
+from utils import deadline
+
+
+class Context:
+
+    def __init__(self, remaining_ms) -> None:
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_ms
+
+
+#the earliest of the deadline of the event and of the lambda timeout (minus the margin) is used
+def test_from_event_takes_the_earliest_deadline():
+    now = time.time()
+    request_deadline = deadline.Deadline.from_event({"deadline": int((now + 20) * 1000)}, Context(10500))
+    assert 9.5 < request_deadline.remaining() <= 10
+
+    request_deadline = deadline.Deadline.from_event({"time_budget_ms": 5000}, Context(60000))
+    assert 4.5 < request_deadline.remaining() <= 5
+
+    assert deadline.Deadline.from_event({}).remaining() == float("inf")
+    assert 24 < deadline.Deadline.from_event({}, budget_ms=deadline.default_budget_ms).remaining() <= 25
+
+#the deadline and the fallbacks are passed to the next state in the event
+def test_deadline_round_trip_through_the_event():
+    request_deadline = deadline.Deadline.from_event({"time_budget_ms": 8000})
+    request_deadline.record_fallback("skip_query_optimisation")
+    next_deadline = deadline.Deadline.from_event({"deadline": request_deadline.to_event(), "fallbacks": request_deadline.fallbacks})
+    assert abs(next_deadline.expires_at - request_deadline.expires_at) < 0.001
+    assert next_deadline.fallbacks == ["skip_query_optimisation"]
+
+#the timeout of a call is the remaining time capped by the timeout of the call
+def test_call_timeout():
+    request_deadline = deadline.Deadline(time.time() + 4)
+    assert 3.9 < request_deadline.timeout(deadline.call_timeouts["llm"]) <= 4
+    assert request_deadline.timeout(2) == 2
+    assert deadline.Deadline().timeout(deadline.call_timeouts["llm"]) == 30
+    assert deadline.Deadline().timeout() is None
+    assert deadline.Deadline(time.time() - 1).timeout(10) == 0.1
+
+#the read timeout of the client is rounded down to a whole second, never above the time left
+@pytest.mark.parametrize("timeout, bucket", [(29.9, 29), (30, 30), (1.0, 1), (1.99, 1), (25, 25), (90, 60)])
+def test_timeout_bucket_rounds_down(timeout, bucket):
+    assert deadline.timeout_bucket(timeout) == bucket
+
+#under a second left the call fails fast instead of running past the deadline
+@pytest.mark.parametrize("timeout", [0.99, 0.5, 0.1])
+def test_timeout_bucket_fails_fast(timeout):
+    with pytest.raises(deadline.DeadlineExceeded):
+        deadline.timeout_bucket(timeout)
+
+def test_get_bedrock_client_uses_the_bucket(monkeypatch):
+    clients = {None: "default", 29: "client-29"}
+    monkeypatch.setattr(deadline, "bedrock_clients", clients)
+    assert deadline.get_bedrock_client(29.9) == "client-29"
+    assert deadline.get_bedrock_client() == "default"
+    with pytest.raises(deadline.DeadlineExceeded):
+        deadline.get_bedrock_client(0.4)
@@ -0,0 +1,94 @@
+import threading
+import types
+
+import pytest
+
+from service import express
+
+definition = {
+    "StartAt": "routing_step",
+    "States": {
+        "routing_step": {"Type": "Task", "Parameters": {"question.$": "$.question", "deadline.$": "$.deadline"},
+                         "ResultPath": "$.routing_step_output", "Next": "choice_state"},
+        "choice_state": {"Type": "Choice", "Choices": [
+            {"Variable": "$.routing_step_output.category", "StringEquals": "semantic", "Next": "semantic_search"},
+            {"Variable": "$.routing_step_output.category", "StringEquals": "standard", "Next": "standard_search"},
+        ], "Default": "fail_state"},
+        "semantic_search": {"Type": "Task", "Parameters": {"question.$": "$.routing_step_output.question", "deadline.$": "$.routing_step_output.deadline",
+                                                           "projection": "list"}, "ResultPath": "$.search_output", "End": True},
+        "standard_search": {"Type": "Task", "Parameters": {"question.$": "$.routing_step_output.question", "deadline.$": "$.routing_step_output.deadline"},
+                            "ResultPath": "$.search_output", "End": True},
+        "fail_state": {"Type": "Fail", "Error": "UnknownCategory", "Cause": "no category"},
+    }
+}
+
+
+#handlers recording their events, the routing answers the category given in the question
+class Handlers(dict):
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.calls = []
+        self.lock = threading.Lock()
+        self["routing"] = self.handler("routing", lambda event: {"question": event["question"], "deadline": event["deadline"],
+                                                                 "category": event["question"].split()[0]})
+        self["semantic"] = self.handler("semantic", lambda event: {"statusCode": 200, "search_output": [{"tmdb_id": 1}]})
+        self["standard"] = self.handler("standard", lambda event: {"statusCode": 200, "search_output": [{"tmdb_id": 2}]})
+
+    def handler(self, route, respond):
+        def lambda_handler(event, context):
+            with self.lock:
+                self.calls.append((route, event))
+            if event.get("question", "").endswith("error") and route != "routing":
+                raise RuntimeError("search failed")
+            return respond(event)
+        return types.SimpleNamespace(lambda_handler=lambda_handler)
+
+    def routes(self):
+        return [route for route, _ in self.calls]
+
+
+#the speculative semantic search started with the routing is used when the routing chooses it with the same event
+def test_speculation_hit():
+    handlers = Handlers()
+    orchestrator = express.ExpressOrchestrator(definition, handlers)
+    output = orchestrator.run({"question": "semantic thrillers"})
+    assert output["search_output"]["search_output"] == [{"tmdb_id": 1}]
+    assert sorted(handlers.routes()) == ["routing", "semantic"]
+    assert orchestrator.stats()["hits"] == 1
+    assert output["routing_step_output"]["deadline"] == output["deadline"]
+
+#a speculative branch that is not chosen is dropped
+def test_speculation_miss():
+    handlers = Handlers()
+    orchestrator = express.ExpressOrchestrator(definition, handlers)
+    output = orchestrator.run({"question": "standard horror"})
+    assert output["search_output"]["search_output"] == [{"tmdb_id": 2}]
+    stats = orchestrator.stats()
+    assert stats["misses"] == 1 and stats["hits"] == 0
+    assert stats["branches"] == {"standard_search": 1}
+
+#without speculation only the states of the path run
+def test_without_speculation():
+    handlers = Handlers()
+    orchestrator = express.ExpressOrchestrator(definition, handlers, speculate="off")
+    orchestrator.run({"question": "semantic thrillers"})
+    assert handlers.routes() == ["routing", "semantic"]
+
+#the prediction follows the most frequent branch once there are enough runs
+def test_predicted_branch():
+    handlers = Handlers()
+    orchestrator = express.ExpressOrchestrator(definition, handlers, min_runs=3)
+    for _ in range(3):
+        orchestrator.run({"question": "standard horror"})
+    assert orchestrator.predict_branch() == "standard_search"
+
+#a Fail state and a handler error fail the execution as in step functions
+def test_failures():
+    orchestrator = express.ExpressOrchestrator(definition, Handlers(), speculate="off")
+    with pytest.raises(express.ExecutionFailed) as failure:
+        orchestrator.run({"question": "other question"})
+    assert failure.value.error == "UnknownCategory"
+    with pytest.raises(express.ExecutionFailed) as failure:
+        orchestrator.run({"question": "standard error"})
+    assert failure.value.error == "Lambda.Unknown"
@@ -0,0 +1,52 @@
+import pytest
+
+from utils import facet_views
+from utils import llm_utils
+from utils import local_index
+
+movies = [
+    {"tmdb_id": 1, "original_title": "Top Gun", "original_language": "en", "genres": ["Action", "Drama"], "year": 1986,
+     "director": "Tony Scott", "popularity": 50.0, "popularity_bins": "popular", "vote_average": 6.9, "vote_average_bins": "good"},
+    {"tmdb_id": 2, "original_title": "Top Gun: Maverick", "original_language": "en", "genres": ["Action", "Drama"], "year": 2022,
+     "director": "Joseph Kosinski", "popularity": 90.0, "popularity_bins": "very popular", "vote_average": 8.2, "vote_average_bins": "very good"},
+    {"tmdb_id": 3, "original_title": "Jerry Maguire", "original_language": "en", "genres": ["Comedy", "Drama"], "year": 1996,
+     "director": "Cameron Crowe", "popularity": 30.0, "popularity_bins": "popular", "vote_average": 6.7, "vote_average_bins": "good"},
+    {"tmdb_id": 4, "original_title": "Amélie", "original_language": "fr", "genres": ["Comedy", "Romance"], "year": 2001,
+     "director": "Jean-Pierre Jeunet", "popularity": 0.0, "popularity_bins": "unpopular", "vote_average": 7.9, "vote_average_bins": "very good"},
+    {"tmdb_id": 5, "original_title": "Cruise Control", "original_language": "en", "genres": ["Comedy"], "year": 1999,
+     "director": "Tom Scott", "popularity": None, "popularity_bins": "unpopular", "vote_average": None, "vote_average_bins": "bad"},
+]
+
+@pytest.fixture(scope="module")
+def views():
+    return facet_views.FacetViews(facet_views.build_views(movies, top_n=3))
+
+@pytest.fixture(scope="module")
+def index():
+    return local_index.LocalIndex(movies)
+
+def ids(documents):
+    return [doc["tmdb_id"] for doc in documents]
+
+
+#a single facet value is answered from the views with the movies and the order of the search
+@pytest.mark.parametrize("query", [[{"genres": "comedy"}], [{"year": "1990s"}], [{"year": 2022}], [{"director": "Tony Scott"}],
+                                   [{"original_language": "FR"}], [{"popularity_bins": "unpopular"}]])
+def test_views_match_the_search(views, index, query):
+    compiled = llm_utils.compile_standard_query(query, llm_utils.projection_profiles["full"], k=3, schema=llm_utils.index_schema)
+    assert ids(views.lookup(query, k=3)) == ids(index.search(compiled))
+
+#the movies without popularity come after the movies with a popularity of 0
+def test_missing_values_last():
+    views = facet_views.FacetViews(facet_views.build_views(list(reversed(movies)), top_n=3))
+    assert ids(views.lookup([{"popularity_bins": "unpopular"}], k=3)) == [4, 5]
+
+#the other queries go to the search
+@pytest.mark.parametrize("query, k", [([{"genres": "Drama"}, {"year": 1986}], 3), ([{"year": [1986, 2001]}], 3), ([{"director": "Scott"}], 3),
+                                      ([{"genres": "Drama"}], 4), ([{"budget": 10}], 3)])
+def test_views_misses(views, query, k):
+    assert views.lookup(query, k=k) is None
+
+#the projection of the route is applied to the movies of the views
+def test_views_projection(views):
+    assert set(views.lookup([{"genres": "Drama"}], k=3, projection="titles")[0]) == set(llm_utils.projection_profiles["titles"])
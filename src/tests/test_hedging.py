@@ -0,0 +1,80 @@
+import concurrent.futures
+import threading
+import time
+
+from utils import hedging
+
+
+def warm_up(hedger, latency=0.0):
+    for _ in range(hedger.min_samples):
+        hedger.call(lambda: time.sleep(latency))
+
+
+#the first attempts are not run by the shared executor, so the hedged calls are not limited to its threads
+def test_first_attempts_not_capped_by_executor():
+    hedger = hedging.Hedger("test-concurrency", max_ratio=1.0, max_tokens=100, min_delay=2.0, max_delay=2.0)
+    warm_up(hedger)
+
+    calls = hedging.executor._max_workers * 3
+    barrier = threading.Barrier(calls, timeout=5)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=calls) as pool:
+        results = list(pool.map(lambda i: hedger.call(lambda: barrier.wait() is not None and i), range(calls)))
+
+    assert results == list(range(calls))
+    assert hedger.stats()["hedges"] == 0
+
+
+#without budget for a duplicate, the call runs on the caller thread
+def test_runs_on_caller_thread_without_budget():
+    hedger = hedging.Hedger("test-caller", max_ratio=0.0)
+    warm_up(hedger)
+    assert hedger.call(threading.current_thread) is threading.current_thread()
+
+
+#the latency recorded is the time of the attempt, not the time it waited for a thread of the executor
+def test_latency_excludes_queue_wait():
+    hedger = hedging.Hedger("test-queue")
+    release = threading.Event()
+    busy = [hedging.executor.submit(release.wait, 5) for _ in range(hedging.executor._max_workers)]
+
+    future = concurrent.futures.Future()
+    hedging.executor.submit(hedger.run, lambda: "done", future)
+    time.sleep(0.3)
+    release.set()
+    concurrent.futures.wait(busy)
+
+    assert future.result(timeout=5) == "done"
+    assert hedger.tracker.percentile(100) < 0.1
+
+
+def test_slow_first_attempt_is_hedged():
+    hedger = hedging.Hedger("test-hedge", max_ratio=1.0, max_tokens=10, min_delay=0.05)
+    warm_up(hedger, 0.01)
+
+    attempts = []
+    def fn():
+        attempts.append(1)
+        #the first attempt is slow, the duplicate is fast
+        time.sleep(1.0 if len(attempts) == 1 else 0.01)
+        return len(attempts)
+
+    start = time.time()
+    assert hedger.call(fn) == 2
+    assert time.time() - start < 0.5
+    assert hedger.stats()["wins"] == 1
+
+
+def test_error_of_both_attempts_is_raised():
+    hedger = hedging.Hedger("test-error", max_ratio=1.0, max_tokens=10, min_delay=0.01)
+    warm_up(hedger)
+
+    def fn():
+        time.sleep(0.05)
+        raise RuntimeError("failed")
+
+    try:
+        hedger.call(fn)
+    except RuntimeError as e:
+        assert str(e) == "failed"
+    else:
+        assert False, "the error was not raised"
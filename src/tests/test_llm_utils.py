@@ -0,0 +1,124 @@
+import io
+import json
+
+import pytest
+
+from utils import llm_utils
+
+
+def ids(documents):
+    return [doc["tmdb_id"] for doc in documents]
+
+
+#the movies without value are last in both orders, whatever the sign of the other values
+def test_sort_by_value_puts_missing_values_last():
+    documents = [{"tmdb_id": 1, "vote_average": None}, {"tmdb_id": 2, "vote_average": -1.0}, {"tmdb_id": 3, "vote_average": 0.0},
+                 {"tmdb_id": 4}, {"tmdb_id": 5, "vote_average": 7.5}]
+    assert ids(llm_utils.sort_by_value(documents, lambda doc: doc.get("vote_average"))) == [5, 3, 2, 1, 4]
+    assert ids(llm_utils.sort_by_value(documents, lambda doc: doc.get("vote_average"), descending=False)) == [2, 3, 5, 1, 4]
+
+#values are compared as numbers, a string year is not a TypeError and a value that is not a number counts as missing
+def test_sort_by_value_coerces_the_values():
+    documents = [{"tmdb_id": 1, "year": "1994"}, {"tmdb_id": 2, "year": 2001}, {"tmdb_id": 3, "year": "unknown"}, {"tmdb_id": 4, "year": 1986.0}]
+    assert ids(llm_utils.sort_by_value(documents, lambda doc: doc.get("year"))) == [2, 1, 4, 3]
+
+#the partial sort returns the same first k items as the full sort, ties keep their order
+def test_sort_by_value_top_k():
+    documents = [{"tmdb_id": i, "popularity": [3, None, 5, 3, 1][i]} for i in range(5)]
+    full = ids(llm_utils.sort_by_value(documents, lambda doc: doc["popularity"]))
+    assert full == [2, 0, 3, 4, 1]
+    for k in range(1, 6):
+        assert ids(llm_utils.sort_by_value(documents, lambda doc: doc["popularity"], k=k)) == full[:k]
+
+
+#filters of the model that are not an object are ignored instead of failing the search
+def test_build_search_filters_ignores_invalid_filters():
+    assert llm_utils.build_search_filters([{"year": 1994}]) == []
+    assert llm_utils.build_search_filters("1994") == []
+    assert llm_utils.build_search_filters({"year": None, "budget": 10, "genres": ["Drama"]}) == [{"term": {"genres.keyword": "Drama"}}]
+
+
+class EmbeddingClient:
+
+    def __init__(self) -> None:
+        self.calls = 0
+
+    def invoke_model(self, body, modelId, accept, contentType):
+        self.calls += 1
+        return {"body": io.BytesIO(json.dumps({"embeddings": [[0.1, 0.2, 0.3]]}).encode("utf8"))}
+
+#a cached embedding is returned as a copy, a caller changing its vector does not change it for the others
+def test_embedding_cache_returns_copies(monkeypatch):
+    client = EmbeddingClient()
+    monkeypatch.setattr(llm_utils, "get_bedrock_client", lambda timeout=None: client)
+    monkeypatch.setattr(llm_utils, "embedding_cache", llm_utils.collections.OrderedDict())
+
+    first = llm_utils.get_embeddings_from_text("top gun", "cohere")
+    first[0] = 42.0
+    second = llm_utils.get_embeddings_from_text("top gun", "cohere")
+    second.append(0.4)
+    assert llm_utils.get_embeddings_from_text("top gun", "cohere") == [0.1, 0.2, 0.3]
+    assert client.calls == 1
+
+
+def filters(prop_value_list, schema=None):
+    query = json.loads(llm_utils.compile_standard_query(prop_value_list, llm_utils.projection_profiles["full"], schema=schema or llm_utils.index_schema))
+    return query["query"]["bool"]["filter"]
+
+#several years are alternatives, matched with terms, only the explicit forms are ranges
+def test_year_values():
+    assert filters([{"year": [1994, 2001]}]) == [{"terms": {"year": [1994, 2001]}}]
+    assert filters([{"year": "1994"}]) == [{"term": {"year": 1994}}]
+    assert filters([{"year": "1990s"}]) == [{"range": {"year": {"gte": 1990, "lte": 1999}}}]
+    assert filters([{"year": "1990-1999"}]) == [{"range": {"year": {"gte": 1990, "lte": 1999}}}]
+    assert filters([{"year": {"from": 1990, "to": 1999}}]) == [{"range": {"year": {"gte": 1990, "lte": 1999}}}]
+    assert filters([{"year": [1986, "1990s"]}]) == [{"bool": {"should": [{"term": {"year": 1986}}, {"range": {"year": {"gte": 1990, "lte": 1999}}}],
+                                                              "minimum_should_match": 1}}]
+
+#the values of the other numeric fields are alternatives too, ranges keep their decimals
+def test_numeric_values():
+    assert filters([{"vote_average": [7.5, 8]}]) == [{"terms": {"vote_average": [7.5, 8.0]}}]
+    assert filters([{"vote_average": {"gte": 7.5}}]) == [{"range": {"vote_average": {"gte": 7.5}}}]
+
+#closed vocabularies use the keyword subfield, multi-valued properties match all the values and names any of them
+def test_text_and_keyword_values():
+    assert filters([{"genres": ["Drama", "Action"]}]) == [{"term": {"genres.keyword": "Drama"}}, {"term": {"genres.keyword": "Action"}}]
+    assert filters([{"original_language": ["en", "fr"]}]) == [{"terms": {"original_language": ["en", "fr"]}}]
+    assert filters([{"director": ["Tony Scott", "Ridley Scott"]}]) == [{"bool": {"should": [{"match_phrase": {"director": "Tony Scott"}},
+                                                                                           {"match_phrase": {"director": "Ridley Scott"}}],
+                                                                                "minimum_should_match": 1}}]
+    assert filters([{"actors": "['Tom Cruise', 'Kelly McGillis']"}]) == [{"match_phrase": {"actors": "Tom Cruise"}}, {"match_phrase": {"actors": "Kelly McGillis"}}]
+
+#unknown properties and invalid values are ignored
+def test_invalid_values_are_ignored():
+    assert filters([{"budget": 10}, {"year": "recent"}, {"genres": ""}]) == []
+
+#the compiled query follows the schema of the index: without keyword subfield the genres are phrases
+def test_schema_of_the_index():
+    legacy_schema = {prop: field_type for prop, field_type in llm_utils.index_schema.items() if not prop.endswith(".keyword")}
+    assert filters([{"genres": "Drama"}], schema=legacy_schema) == [{"match_phrase": {"genres": "Drama"}}]
+    assert filters([{"genres": "Drama"}]) == [{"term": {"genres.keyword": "Drama"}}]
+
+
+class MappingClient:
+
+    def __init__(self, error=None) -> None:
+        self.indices = self
+        self.error = error
+
+    def get_mapping(self, index):
+        if self.error is not None:
+            raise self.error
+        return {f"{index}-v2": {"mappings": llm_utils.get_movies_index_body()["mappings"]}}
+
+#the schema is read from the mapping (also behind an alias), a missing index is an error and an unreadable mapping a warning
+def test_get_index_schema(monkeypatch, caplog):
+    monkeypatch.setattr(llm_utils, "index_schema_cache", {})
+    schema = llm_utils.get_index_schema(MappingClient(), "movies")
+    assert schema["genres.keyword"] == "keyword" and schema["year"] == "integer"
+
+    with pytest.raises(ValueError):
+        llm_utils.get_index_schema(MappingClient(llm_utils.NotFoundError(404, "index_not_found_exception")), "missing")
+
+    assert llm_utils.get_index_schema(MappingClient(PermissionError("forbidden")), "forbidden") is llm_utils.index_schema
+    assert "could not load the schema of forbidden" in caplog.text
@@ -0,0 +1,75 @@
+import pytest
+
+from utils import llm_utils
+from utils import local_index
+
+data_columns = llm_utils.projection_profiles["full"]
+
+movies = [
+    {"tmdb_id": 1, "original_title": "Top Gun", "original_language": "en", "genres": ["Action", "Drama"], "year": 1986,
+     "director": "Tony Scott", "actors": ["Tom Cruise", "Kelly McGillis"], "keywords": ["navy", "pilot"],
+     "popularity": 50.0, "popularity_bins": "popular", "vote_average": 6.9, "vote_average_bins": "good"},
+    {"tmdb_id": 2, "original_title": "Top Gun: Maverick", "original_language": "en", "genres": ["Action", "Drama"], "year": 2022,
+     "director": "Joseph Kosinski", "actors": ["Tom Cruise", "Miles Teller"], "keywords": ["navy", "sequel"],
+     "popularity": 90.0, "popularity_bins": "very popular", "vote_average": 8.2, "vote_average_bins": "very good"},
+    {"tmdb_id": 3, "original_title": "Jerry Maguire", "original_language": "en", "genres": ["Comedy", "Drama", "Romance"], "year": 1996,
+     "director": "Cameron Crowe", "actors": ["Tom Cruise", "Renée Zellweger"], "keywords": ["sports agent"],
+     "popularity": 30.0, "popularity_bins": "popular", "vote_average": 6.7, "vote_average_bins": "good"},
+    {"tmdb_id": 4, "original_title": "Amélie", "original_language": "fr", "genres": ["Comedy", "Romance"], "year": 2001,
+     "director": "Jean-Pierre Jeunet", "actors": ["Audrey Tautou", "Mathieu Kassovitz"], "keywords": ["paris"],
+     "popularity": 40.0, "popularity_bins": "popular", "vote_average": 7.9, "vote_average_bins": "very good"},
+    {"tmdb_id": 5, "original_title": "Cruise Control", "original_language": "en", "genres": ["Comedy"], "year": 1999,
+     "director": "Tom Scott", "actors": ["Tom Hanks"], "keywords": [],
+     "popularity": None, "popularity_bins": "unpopular", "vote_average": None, "vote_average_bins": "bad"},
+]
+
+@pytest.fixture(scope="module")
+def index():
+    return local_index.LocalIndex(movies)
+
+def search(index, prop_value_list, k=10, sort_field="popularity"):
+    query = llm_utils.compile_standard_query(prop_value_list, data_columns, k=k, schema=llm_utils.index_schema, sort_field=sort_field)
+    return [doc["tmdb_id"] for doc in index.search(query)]
+
+
+#keyword fields match the whole value, case insensitive
+def test_keyword_filters(index):
+    assert search(index, [{"genres": "drama"}]) == [2, 1, 3]
+    assert search(index, [{"original_language": "FR"}]) == [4]
+
+#multi-valued properties must match all the values
+def test_multi_valued_match_all(index):
+    assert search(index, [{"genres": "['Comedy', 'Romance']"}]) == [4, 3]
+
+#names are matched as phrases within one value, e.g. a last name alone
+def test_phrase_match(index):
+    assert search(index, [{"actors": "Cruise"}]) == [2, 1, 3]
+    assert search(index, [{"actors": "Tom Cruise"}]) == [2, 1, 3]
+    #the words of the phrase must be in the same value
+    assert search(index, [{"actors": "Cruise Teller"}]) == []
+    assert search(index, [{"director": "Scott"}]) == [1, 5]
+
+def test_year_ranges(index):
+    assert search(index, [{"year": "1990s"}]) == [3, 5]
+    assert search(index, [{"year": "1980-2000"}]) == [1, 3, 5]
+    assert search(index, [{"year": {"gte": 1980, "lte": 2000}}]) == [1, 3, 5]
+    assert search(index, [{"year": 2022}]) == [2]
+
+#several years are alternatives, a list of two years is not a range
+def test_discrete_years(index):
+    assert search(index, [{"year": [1986, 2001]}]) == [1, 4]
+    assert search(index, [{"year": ["1986", "1990s"]}]) == [1, 3, 5]
+
+def test_combined_filters_and_k(index):
+    assert search(index, [{"actors": "Tom Cruise"}, {"year": "1980-1999"}]) == [1, 3]
+    assert search(index, [{"actors": "Tom Cruise"}], k=1) == [2]
+
+#other sorts than popularity, the movies without value come last as with the default sort of opensearch (missing: _last)
+def test_sort_on_another_field(index):
+    assert search(index, [{"original_language": "en"}], sort_field="vote_average") == [2, 1, 3, 5]
+    assert search(index, [{"original_language": "en"}], k=2, sort_field="vote_average") == [2, 1]
+
+def test_source_projection(index):
+    query = llm_utils.compile_standard_query([{"genres": "Action"}], data_columns, k=1, schema=llm_utils.index_schema,
+                                             source=llm_utils.get_source_filter("titles", data_columns))
+    assert index.search(query) == [{prop: movies[1][prop] for prop in llm_utils.projection_profiles["titles"]}]
@@ -0,0 +1,44 @@
+import pytest
+
+from utils import llm_utils
+
+
+def template():
+    return llm_utils.PromptTemplate(["context", "question"], 'Example: {"genres": ["Drama"]}\n<context>{context}</context>\nQuestion: {question}',
+                                    system_prompt="You are a movie finder.", prefill="<answer>")
+
+
+#the variables are replaced in a single pass, the other braces (json examples) are kept and the prefill is appended
+def test_format_prompt():
+    prompt = template().format_prompt(context="{question}", question="movies with tom cruise")
+    assert prompt == 'Example: {"genres": ["Drama"]}\n<context>{question}</context>\nQuestion: movies with tom cruise\n<answer>'
+
+def test_static_prefix():
+    assert template().get_static_prefix() == 'Example: {"genres": ["Drama"]}\n<context>'
+
+#a missing value and a value for an undeclared variable are both a ValueError
+def test_format_prompt_validates_the_values():
+    with pytest.raises(ValueError):
+        template().format_prompt(question="movies")
+    with pytest.raises(ValueError):
+        template().format_prompt(context="", question="movies", chat_history="")
+
+#the values of the variables the template does not use are dropped, the declared variables are still required
+def test_format_prompt_ignoring_extra():
+    assert template().format_prompt_ignoring_extra(context="c", question="q", chat_history="h").endswith("Question: q\n<answer>")
+    with pytest.raises(ValueError):
+        template().format_prompt_ignoring_extra(question="q", chat_history="h")
+
+#the template and the declared variables must match
+def test_template_errors():
+    with pytest.raises(ValueError):
+        llm_utils.PromptTemplate(["context", "question"], "Question: {question}")
+    with pytest.raises(ValueError):
+        llm_utils.PromptTemplate(["question"], "Question: {question} {history}")
+
+#the estimate counts the template, the prefill, the system prompt and the values without rendering the prompt
+def test_estimate_tokens():
+    prompt_template = template()
+    values = {"context": "x" * 400, "question": "movies with tom cruise"}
+    rendered = prompt_template.format_prompt(**values) + prompt_template.get_system_prompt()
+    assert abs(prompt_template.estimate_tokens(**values) - llm_utils.estimate_tokens(rendered)) <= 4
@@ -0,0 +1,40 @@
+import pytest
+
+from utils import result_store
+
+uri = "sqlite://:memory:"
+
+documents = [{"tmdb_id": i, "original_title": f"Movie {i}", "description": "A description", "popularity": 10.0 - i, "vote_average": 7.0,
+              "year": 2000 + i} for i in range(5)]
+
+
+#the states pass the ids and sort properties, the full documents are stored once
+def test_store_results_returns_compact_references():
+    result_ref, compact = result_store.store_results(uri, documents)
+    assert compact[0] == {"tmdb_id": 0, "popularity": 10.0, "vote_average": 7.0, "year": 2000}
+    assert result_store.get_result_store(uri).get(result_ref) == documents
+
+#the full documents are returned in the order of the items, e.g. after the sorting state
+def test_resolve_results_follows_the_order_of_the_items():
+    result_ref, compact = result_store.store_results(uri, documents)
+    resolved = result_store.resolve_results(uri, result_ref, list(reversed(compact)) + [{"tmdb_id": 99}])
+    assert [doc["tmdb_id"] for doc in resolved] == [4, 3, 2, 1, 0, 99]
+    assert resolved[0]["description"] == "A description"
+    assert resolved[-1] == {"tmdb_id": 99}
+
+#without a reference the items are the documents
+def test_resolve_without_reference():
+    assert result_store.resolve_results("", "", documents) is documents
+    assert result_store.resolve_results(uri, "", documents) is documents
+
+#an expired or unknown reference is an error rather than a partial answer
+def test_expired_results():
+    store = result_store.get_result_store(uri)
+    key = store.put(documents, ttl=-1)
+    assert store.get(key) is None
+    with pytest.raises(KeyError):
+        result_store.resolve_results(uri, key, documents)
+
+def test_unsupported_uri():
+    with pytest.raises(ValueError):
+        result_store.get_result_store("redis://localhost")
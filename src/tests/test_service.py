@@ -0,0 +1,106 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+import types
+
+import pytest
+
+from service import app as service_app
+
+
+#service with handlers defined by the test, without the lambdas
+def make_service(handlers, **environ):
+    config = service_app.ServiceConfig({"SERVICE_ROUTES": ",".join(handlers), **environ})
+    service = service_app.Service(config)
+    service.handlers = {route: types.SimpleNamespace(lambda_handler=handler) for route, handler in handlers.items()}
+    service.executor = concurrent.futures.ThreadPoolExecutor(max_workers=config.max_concurrency)
+    service.limiter = service_app.ConcurrencyLimiter(config.max_concurrency, config.max_queue)
+    service.route_limiters = {route: service_app.ConcurrencyLimiter(limit, config.max_queue) for route, limit in config.route_concurrency.items()}
+    service.ready = True
+    return service
+
+
+#a timed out request keeps its slot until its worker finishes, so the limit still bounds the running handlers
+def test_slot_released_when_the_worker_finishes():
+    release = threading.Event()
+    service = make_service({"slow": lambda event, context: release.wait(5) and {"statusCode": 200}},
+                           SERVICE_REQUEST_TIMEOUT_MS="100", SERVICE_MAX_CONCURRENCY="1")
+
+    async def run():
+        with pytest.raises(asyncio.TimeoutError):
+            await service.handle("slow", {})
+        assert service.limiter.active == 1
+        release.set()
+        for _ in range(100):
+            if service.limiter.active == 0:
+                break
+            await asyncio.sleep(0.01)
+        assert service.limiter.active == 0
+        assert await service.handle("slow", {}) == {"statusCode": 200}
+
+    asyncio.run(run())
+    service.executor.shutdown()
+
+#requests over the concurrency and the queue are rejected, the queued ones run in turn
+def test_queue_and_overload():
+    running = []
+    peak = []
+
+    def handler(event, context):
+        running.append(1)
+        peak.append(len(running))
+        time.sleep(0.05)
+        running.pop()
+        return {"statusCode": 200}
+
+    service = make_service({"search": handler}, SERVICE_MAX_CONCURRENCY="2", SERVICE_MAX_QUEUE="2")
+
+    async def run():
+        return await asyncio.gather(*[service.handle("search", {}) for _ in range(6)], return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert sum(isinstance(result, service_app.Overloaded) for result in results) == 2
+    assert sum(result == {"statusCode": 200} for result in results) == 4
+    assert max(peak) == 2
+    assert service.limiter.active == 0 and service.limiter.waiting == 0
+    service.executor.shutdown()
+
+#a route limit is applied within the global limit
+def test_route_concurrency():
+    peak = {"specific": 0, "search": 0}
+    running = {"specific": 0, "search": 0}
+    lock = threading.Lock()
+
+    def handler(route):
+        def run(event, context):
+            with lock:
+                running[route] += 1
+                peak[route] = max(peak[route], running[route])
+            time.sleep(0.05)
+            with lock:
+                running[route] -= 1
+            return {"statusCode": 200}
+        return run
+
+    service = make_service({"specific": handler("specific"), "search": handler("search")}, SERVICE_MAX_CONCURRENCY="4",
+                           SERVICE_ROUTE_CONCURRENCY="specific=1")
+
+    async def run():
+        return await asyncio.gather(*[service.handle(route, {}) for route in ["specific", "search"] * 4])
+
+    assert all(result == {"statusCode": 200} for result in asyncio.run(run()))
+    assert peak["specific"] == 1
+    assert peak["search"] > 1
+    service.executor.shutdown()
+
+#a handler error is raised to the caller and frees the slot
+def test_handler_error():
+    def handler(event, context):
+        raise RuntimeError("failed")
+
+    service = make_service({"broken": handler})
+    with pytest.raises(RuntimeError):
+        asyncio.run(service.handle("broken", {}))
+    assert service.limiter.active == 0
+    service.executor.shutdown()
@@ -0,0 +1,99 @@
+import json
+
+import pytest
+
+from utils import deadline
+from utils import session_store
+
+
+@pytest.fixture
+def store():
+    return session_store.SqliteSessionStore(path=":memory:")
+
+#summarize function recording the messages it was given
+class Summarizer:
+
+    def __init__(self) -> None:
+        self.calls = []
+
+    def __call__(self, previous_summary, messages, timeout=None):
+        self.calls.append({"previous_summary": previous_summary, "messages": messages, "timeout": timeout})
+        return f"summary of {len(messages)} messages"
+
+def roles(messages):
+    return [message["role"] for message in messages]
+
+
+#under the budget nothing is summarized
+def test_no_compaction_under_the_budget(store):
+    summarize = Summarizer()
+    assert session_store.record_exchange(store, "s", "question", session_store.format_answer("answer"), summarize) is False
+    assert summarize.calls == []
+    assert roles(session_store.load_window(store, "s")) == ["user", "assistant"]
+
+#the oldest exchanges are summarized, the recent ones are kept and the window starts with the summary
+def test_oldest_turns_are_compacted(store):
+    summarize = Summarizer()
+    for i in range(6):
+        session_store.record_exchange(store, "s", f"question {i}", session_store.format_answer("x" * 800), summarize, token_budget=1000)
+
+    assert summarize.calls
+    window = session_store.load_window(store, "s")
+    assert window[0]["content"][0]["text"].startswith("<conversation_summary>")
+    assert roles(window)[-1] == "assistant"
+    assert json.loads(window[-2]["content"][-1]["text"]) == "question 5"
+
+#an answer over half of the budget stays in the window, which still ends with an answer
+def test_oversized_last_answer_is_kept(store):
+    summarize = Summarizer()
+    session_store.record_exchange(store, "s", "first question", session_store.format_answer("short"), summarize)
+    session_store.record_exchange(store, "s", "second question", session_store.format_answer("y" * 9000), summarize)
+
+    assert len(summarize.calls) == 1
+    assert [json.loads(message["content"][0]["text"]) for message in summarize.calls[0]["messages"]][0] == "first question"
+    window = session_store.load_window(store, "s")
+    assert roles(window) == ["user", "assistant"]
+    assert json.loads(window[0]["content"][-1]["text"]) == "second question"
+    assert "y" * 9000 in window[-1]["content"][0]["text"]
+
+#a single exchange over the budget is not summarized at all
+def test_single_oversized_exchange_is_not_compacted(store):
+    summarize = Summarizer()
+    session_store.record_exchange(store, "s", "question", session_store.format_answer("y" * 9000), summarize)
+    assert summarize.calls == []
+    assert roles(session_store.load_window(store, "s")) == ["user", "assistant"]
+
+#max_tokens drops the oldest turns but never the last exchange
+def test_window_token_limit_keeps_the_last_exchange(store):
+    session_store.append_exchange(store, "s", "first question", session_store.format_answer("short"))
+    session_store.append_exchange(store, "s", "second question", session_store.format_answer("y" * 9000))
+    window = session_store.load_window(store, "s", max_tokens=100)
+    assert roles(window) == ["user", "assistant"]
+    assert json.loads(window[0]["content"][0]["text"]) == "second question"
+
+#the compaction is skipped when the deadline is too close, and limited to the time left otherwise
+def test_compaction_follows_the_deadline(store):
+    summarize = Summarizer()
+    for i in range(3):
+        session_store.append_exchange(store, "s", f"question {i}", session_store.format_answer("x" * 4000))
+
+    close = deadline.Deadline.from_event({"time_budget_ms": 1000})
+    assert session_store.record_exchange(store, "s", "q", session_store.format_answer("a"), summarize, deadline=close) is False
+    assert summarize.calls == []
+    assert close.fallbacks == ["skip_session_compaction"]
+
+    far = deadline.Deadline.from_event({"time_budget_ms": 10000})
+    assert session_store.record_exchange(store, "s", "q", session_store.format_answer("a"), summarize, deadline=far) is True
+    assert 9 < summarize.calls[0]["timeout"] <= 10
+
+#a failed summary does not fail the exchange
+def test_failed_compaction_is_a_fallback(store):
+    def summarize(previous_summary, messages, timeout=None):
+        raise TimeoutError("read timeout")
+
+    for i in range(3):
+        session_store.append_exchange(store, "s", f"question {i}", session_store.format_answer("x" * 4000))
+    request_deadline = deadline.Deadline.from_event({"time_budget_ms": 10000})
+    assert session_store.record_exchange(store, "s", "q", session_store.format_answer("a"), summarize, deadline=request_deadline) is False
+    assert request_deadline.fallbacks == ["session_compaction_failed"]
+    assert roles(session_store.load_window(store, "s"))[-1] == "assistant"
@@ -0,0 +1,137 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from utils import single_flight
+
+
+#start the leader and the waiters of the same key, the leader returns once all the waiters joined
+def run_concurrently(group, waiters, make_result, use_result):
+    joined = threading.Event()
+    results = {}
+
+    def fn():
+        joined.wait(5)
+        return make_result()
+
+    def leader():
+        result = group.do("key", fn)
+        results["leader"] = result
+        use_result(result)
+
+    def waiter(i):
+        results[i] = group.do("key", fn)
+
+    leader_thread = threading.Thread(target=leader)
+    leader_thread.start()
+    while "key" not in group.calls:
+        time.sleep(0.001)
+    threads = [threading.Thread(target=waiter, args=(i,)) for i in range(waiters)]
+    for thread in threads:
+        thread.start()
+    while group.calls["key"].waiters < waiters:
+        time.sleep(0.001)
+    joined.set()
+
+    for thread in [leader_thread] + threads:
+        thread.join(5)
+    return results
+
+
+#the caller of the leader modifies its result while the waiters copy theirs
+def test_waiters_get_copies_not_changed_by_the_leader():
+    group = single_flight.SingleFlight("test-copies")
+
+    def use_result(result):
+        for i in range(10000):
+            result[f"added {i}"] = i
+        result["hits"].clear()
+
+    results = run_concurrently(group, 16, lambda: {"hits": list(range(1000))}, use_result)
+
+    waiter_results = [results[i] for i in range(16)]
+    for result in waiter_results:
+        assert result == {"hits": list(range(1000))}
+    assert len({id(result) for result in waiter_results + [results["leader"]]}) == 17
+    assert group.stats()["executions"] == 1
+
+
+def test_error_of_the_leader_is_raised_to_the_waiters():
+    group = single_flight.SingleFlight("test-error")
+    started = threading.Event()
+    errors = []
+
+    def fn():
+        started.set()
+        time.sleep(0.1)
+        raise RuntimeError("failed")
+
+    def run():
+        try:
+            group.do("key", fn)
+        except RuntimeError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run)]
+    threads[0].start()
+    started.wait(5)
+    threads += [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads[1:]:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert len(errors) == 5
+
+
+#a waiter gives up after its timeout while the leader is still running
+def test_waiter_timeout():
+    group = single_flight.SingleFlight("test-timeout")
+    started = threading.Event()
+    leader = threading.Thread(target=group.do, args=("key", lambda: started.set() or time.sleep(1)))
+    leader.start()
+    started.wait(5)
+
+    start = time.time()
+    with pytest.raises(TimeoutError):
+        group.do("key", lambda: None, timeout=0.1)
+    assert time.time() - start < 0.5
+    leader.join(5)
+
+
+def test_async_waiters_get_copies():
+    group = single_flight.SingleFlight("test-async")
+
+    async def fn():
+        await asyncio.sleep(0.05)
+        return {"hits": [1, 2, 3]}
+
+    async def main():
+        leader = asyncio.ensure_future(group.do_async("key", fn))
+        await asyncio.sleep(0)
+        waiters = [asyncio.ensure_future(group.do_async("key", fn)) for _ in range(4)]
+        results = await asyncio.gather(leader, *waiters)
+        results[0]["hits"].append(4)
+        return results
+
+    results = asyncio.run(main())
+    assert all(result == {"hits": [1, 2, 3]} for result in results[1:])
+    assert len({id(result) for result in results}) == 5
+    assert group.stats()["executions"] == 1
+
+
+def test_async_waiter_timeout():
+    group = single_flight.SingleFlight("test-async-timeout")
+
+    async def fn():
+        await asyncio.sleep(1)
+
+    async def main():
+        leader = asyncio.ensure_future(group.do_async("key", fn))
+        await asyncio.sleep(0)
+        with pytest.raises(TimeoutError):
+            await group.do_async("key", fn, timeout=0.1)
+        await leader
+
+    asyncio.run(main())
@@ -0,0 +1,21 @@
+import time
+
+from utils import traffic_capture
+
+
+#the deadline of the event is kept as the time left, prompts and infrastructure names are dropped
+def test_sanitize_keeps_the_time_left():
+    event = {"question": "movies with tom cruise", "deadline": int((time.time() + 12) * 1000), "os_host": "host", "index_name": "movies",
+             "system_prompt": "x" * 120, "session_id": "abc", "history": [{}, {}], "projection": "list"}
+    sanitized = traffic_capture.sanitize(event)
+    assert 11000 < sanitized["time_budget_ms"] <= 12000
+    assert sanitized["prompt_chars"] == {"system_prompt": 120}
+    assert sanitized["history_length"] == 2
+    assert sanitized["projection"] == "list"
+    assert "os_host" not in sanitized and "index_name" not in sanitized
+    assert sanitized["session"] != "abc"
+
+#an explicit time budget of the event wins over the deadline
+def test_sanitize_keeps_the_time_budget():
+    sanitized = traffic_capture.sanitize({"time_budget_ms": 5000, "deadline": int((time.time() + 12) * 1000)})
+    assert sanitized["time_budget_ms"] == 5000
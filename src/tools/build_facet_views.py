@@ -0,0 +1,65 @@
+#Build the materialized views of the standard search (see utils/facet_views.py): the top movies by popularity for every
+#genre, year, decade, director, language and popularity / vote bins, from the movies csv file or from the index.
+#The file is packaged with the standard search lambda and its path set in the FACET_VIEWS_PATH environment variable.
+#The views are also refreshed by reindex_movies.py and embedding_artifacts.py restore with --facet-views.
+#
+#usage:
+#  python build_facet_views.py --csv ../../dataset/movies_metadata.csv --output facet_views.json.gz
+#  python build_facet_views.py --os-host <id>.us-east-1.aoss.amazonaws.com --index movies-index --output facet_views.json.gz
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+
+#adding our utils library to sys path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils import facet_views
+from utils import llm_utils
+
+#typed movies of the csv file
+def read_csv(path):
+    with open(path) as csv_file:
+        for row in csv.DictReader(csv_file):
+            yield llm_utils.to_typed_document(row)
+
+#typed movies of the index, without their vector
+def read_index(os_host, index_name, region=None, page_size=500):
+    import boto3
+    from opensearchpy import AWSV4SignerAuth
+    from tools.reindex_movies import iterate_index
+
+    credentials = boto3.Session().get_credentials()
+    auth = AWSV4SignerAuth(credentials, region or boto3.session.Session().region_name, 'aoss')
+    os_client = llm_utils.connect_to_aoss(auth, os_host)
+    for doc in iterate_index(os_client, index_name, page_size=page_size):
+        doc.pop("vector_index", None)
+        yield llm_utils.to_typed_document(doc)
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the top movies of the common facets for the standard search")
+    parser.add_argument("--csv", help="movies csv file")
+    parser.add_argument("--os-host", help="opensearch host, used when no csv file is given")
+    parser.add_argument("--index", default="movies-index")
+    parser.add_argument("--region")
+    parser.add_argument("--output", default="facet_views.json.gz")
+    parser.add_argument("--top-n", type=int, default=facet_views.default_top_n)
+    args = parser.parse_args()
+
+    if args.csv:
+        documents = read_csv(args.csv)
+    elif args.os_host:
+        documents = read_index(args.os_host, args.index, region=args.region)
+    else:
+        parser.error("--csv or --os-host is required")
+
+    start = time.time()
+    stats = facet_views.write_views(documents, args.output, top_n=args.top_n)
+    stats["size_bytes"] = os.path.getsize(args.output)
+    stats["seconds"] = round(time.time() - start, 1)
+    print(json.dumps(stats, indent=2))
+
+if __name__ == "__main__":
+    main()
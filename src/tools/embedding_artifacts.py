@@ -0,0 +1,100 @@
+#Export the embeddings of a movies index to an artifact (see utils/embedding_store.py), or restore an artifact into
+#a new index with the bulk API. Bedrock is not called: restoring a collection or creating a new one only takes the
+#time of the bulk load instead of embedding every movie again.
+#
+#usage:
+#  python embedding_artifacts.py export --os-host <id>.us-east-1.aoss.amazonaws.com --index movies-index --artifact ../../artifacts/embeddings/movies-v1
+#  python embedding_artifacts.py restore --os-host <id>.us-east-1.aoss.amazonaws.com --index movies-index-v2 --artifact ../../artifacts/embeddings/movies-v1
+#  python embedding_artifacts.py info --artifact ../../artifacts/embeddings/movies-v1
+#
+#the model id, input type and text profile are not stored in the index, the export records the ones given as arguments.
+#With --facet-views, restore also rebuilds the materialized views of the standard search (see build_facet_views.py).
+
+import argparse
+import json
+import os
+import sys
+import time
+
+#adding our utils library to sys path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils import embedding_store
+from utils import facet_views
+from utils import llm_utils
+
+def connect(args):
+    import boto3
+    from opensearchpy import AWSV4SignerAuth
+
+    credentials = boto3.Session().get_credentials()
+    auth = AWSV4SignerAuth(credentials, args.region or boto3.session.Session().region_name, 'aoss')
+    return llm_utils.connect_to_aoss(auth, args.os_host)
+
+#write the documents and the embeddings of the index to an artifact
+def export_index(os_client, index_name, path, model_id, input_type, dimension, dtype="float32", page_size=500, text_profile=None):
+    from tools.reindex_movies import iterate_index
+
+    with embedding_store.EmbeddingArtifactWriter(path, model_id, input_type, dimension, dtype=dtype, text_profile=text_profile) as writer:
+        for doc in iterate_index(os_client, index_name, page_size=page_size):
+            writer.add(llm_utils.to_typed_document(doc), doc[embedding_store.vector_field])
+    return len(writer.vectors)
+
+#bulk load the documents and the embeddings of an artifact into the index, created if it doesn't exist
+def restore_index(os_client, index_name, path, engine="faiss", chunk_size=500):
+    from opensearchpy.helpers import bulk
+
+    artifact = embedding_store.EmbeddingArtifact.load(path)
+    if os_client.indices.exists(index=index_name):
+        print(f"index {index_name} already exists, documents will be added to it")
+    else:
+        index_body = llm_utils.get_movies_index_body(dimension=artifact.metadata["dimension"], engine=engine)
+        print(os_client.indices.create(index_name, body=index_body))
+
+    actions = ({"_op_type": "index", "_index": index_name, "_source": doc} for doc in artifact.documents())
+    return bulk(os_client, actions, chunk_size=chunk_size, raise_on_error=False)
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or restore the embeddings of the movies index")
+    parser.add_argument("command", choices=["export", "restore", "info"])
+    parser.add_argument("--artifact", required=True, help="folder of the artifact")
+    parser.add_argument("--os-host")
+    parser.add_argument("--index", default="movies-index")
+    parser.add_argument("--region")
+    parser.add_argument("--model-id", default="cohere.embed-english-v3")
+    parser.add_argument("--input-type", default="search_document")
+    parser.add_argument("--text-profile", default=None, help="text profile of the documents embedded in the index (see utils/document_text.py)")
+    parser.add_argument("--dimension", type=int, default=1024)
+    parser.add_argument("--dtype", default="float32", choices=["float32", "int8"])
+    parser.add_argument("--engine", default="faiss")
+    parser.add_argument("--page-size", type=int, default=500)
+    parser.add_argument("--facet-views", help="path of the materialized views of the standard search to refresh after a restore")
+    args = parser.parse_args()
+
+    if args.command == "info":
+        print(json.dumps(embedding_store.EmbeddingArtifact.load(args.artifact).describe(), indent=2))
+        return
+
+    if not args.os_host:
+        parser.error("--os-host is required to export or restore")
+    os_client = connect(args)
+
+    start = time.time()
+    if args.command == "export":
+        count = export_index(os_client, args.index, args.artifact, args.model_id, args.input_type, args.dimension, dtype=args.dtype, page_size=args.page_size,
+                             text_profile=args.text_profile)
+        print(f"Exported {count} documents of {args.index} to {args.artifact} in {time.time() - start:.1f} seconds")
+    else:
+        success, failed = restore_index(os_client, args.index, args.artifact, engine=args.engine, chunk_size=args.page_size)
+        print(f"Restored {success} documents, {len(failed) if isinstance(failed, list) else failed} failed in {time.time() - start:.1f} seconds")
+
+        #document counts are eventually consistent in opensearch serverless
+        time.sleep(10)
+        print(f"documents in {args.index}: {os_client.count(index=args.index)['count']}")
+
+        if args.facet_views:
+            artifact = embedding_store.EmbeddingArtifact.load(args.artifact)
+            documents = (artifact.document(row) for row in range(len(artifact)))
+            print(f"facet views refreshed: {facet_views.write_views(documents, args.facet_views)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#Move the documents of an existing movies index (comma separated strings, string years) to a new index
+#using the typed schema from llm_utils.get_movies_index_body (arrays with keyword subfields, numeric year).
+#The embeddings are copied as they are, Bedrock is not called.
+#
+#usage: python reindex_movies.py --os-host <id>.us-east-1.aoss.amazonaws.com --source-index movies-index --target-index movies-index-v2
+#
+#OpenSearch Serverless supports neither the _reindex API nor scroll, so the source index is read with search_after.
+#Once done, update the index_name in the "semantic-api" secret and in the state machine definition.
+#With --facet-views, the materialized views of the standard search are rebuilt from the new index (see build_facet_views.py).
+
+import argparse
+import os
+import sys
+import time
+
+import boto3
+from opensearchpy import (
+    AWSV4SignerAuth
+)
+from opensearchpy.helpers import bulk
+
+#adding our utils library to sys path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils import facet_views
+from utils import llm_utils
+
+#read all the documents of the index, page by page
+def iterate_index(os_client, index_name, page_size=500):
+    query = {
+        "size": page_size,
+        "query": {"match_all": {}},
+        #tmdb_id is not unique in the dataset (duplicated rows), the other properties are used as tie breakers
+        "sort": [
+            {"tmdb_id": {"order": "asc"}},
+            {"popularity": {"order": "asc"}},
+            {"vote_average": {"order": "asc"}}
+        ]
+    }
+
+    while True:
+        response = os_client.search(body=query, index=index_name)
+        hits = response["hits"]["hits"]
+        if not hits:
+            break
+
+        for hit in hits:
+            yield hit["_source"]
+
+        query["search_after"] = hits[-1]["sort"]
+
+#format typed documents for the bulk helper
+def to_bulk_actions(documents, index_name):
+    for doc in documents:
+        yield {
+            "_op_type": "index",
+            "_index": index_name,
+            "_source": llm_utils.to_typed_document(doc)
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description="Reindex the movies into the typed schema")
+    parser.add_argument("--os-host", required=True)
+    parser.add_argument("--source-index", default="movies-index")
+    parser.add_argument("--target-index", default="movies-index-v2")
+    parser.add_argument("--region", default=boto3.session.Session().region_name)
+    parser.add_argument("--dimension", type=int, default=1024)
+    parser.add_argument("--engine", default="faiss")
+    parser.add_argument("--page-size", type=int, default=500)
+    parser.add_argument("--facet-views", help="path of the materialized views of the standard search to refresh")
+    args = parser.parse_args()
+
+    credentials = boto3.Session().get_credentials()
+    auth = AWSV4SignerAuth(credentials, args.region, 'aoss')
+    os_client = llm_utils.connect_to_aoss(auth, args.os_host)
+
+    #create the target index with the typed schema
+    if os_client.indices.exists(index=args.target_index):
+        print(f"index {args.target_index} already exists, documents will be added to it")
+    else:
+        index_body = llm_utils.get_movies_index_body(dimension=args.dimension, engine=args.engine)
+        print(os_client.indices.create(args.target_index, body=index_body))
+
+    start = time.time()
+    success, failed = bulk(
+        os_client,
+        to_bulk_actions(iterate_index(os_client, args.source_index, page_size=args.page_size), args.target_index),
+        chunk_size=args.page_size,
+        raise_on_error=False
+    )
+    end = time.time()
+
+    print(f"Reindexed {success} documents, {len(failed) if isinstance(failed, list) else failed} failed in {end - start:.1f} seconds")
+
+    #document counts are eventually consistent in opensearch serverless
+    time.sleep(10)
+    print(f"documents in {args.source_index}: {os_client.count(index=args.source_index)['count']}")
+    print(f"documents in {args.target_index}: {os_client.count(index=args.target_index)['count']}")
+
+    if args.facet_views:
+        documents = (llm_utils.to_typed_document(doc) for doc in iterate_index(os_client, args.target_index, page_size=args.page_size))
+        print(f"facet views refreshed: {facet_views.write_views(documents, args.facet_views)}")
+
+if __name__ == "__main__":
+    main()
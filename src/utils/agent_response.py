@@ -0,0 +1,119 @@
+import json
+import os
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from utils import llm_utils
+    from utils import metrics
+except ImportError:
+    import llm_utils
+    import metrics
+
+#Responses of the bedrock agent action groups (semantic_lambda and standard_search_lambda).
+#The movies are serialized once as compact json, with orjson when it is installed, into the body {"movies": [...], "truncated": bool}
+#and trimmed to the size limit of the agent response: the properties left out by the projections of trim_levels first
+#(e.g. no description and keywords), then the last movies.
+#AGENT_RESPONSE_MAX_BYTES: size of the body (default llm_utils.payload_budgets["agent"]), counted as it is escaped in the lambda response
+
+default_max_bytes = int(os.environ.get("AGENT_RESPONSE_MAX_BYTES", str(llm_utils.payload_budgets["agent"])))
+
+#projection profiles tried in order until the movies fit
+trim_levels = ["full", "list", "titles"]
+
+
+def dumps(value):
+    if orjson is not None:
+        return orjson.dumps(value, default=str)
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False, default=str).encode("utf-8")
+
+#size of encoded json once it is a string in the json of the lambda response: the quotes and backslashes are escaped,
+#and each non-ascii character becomes \uXXXX (a surrogate pair \uXXXX\uXXXX out of the basic multilingual plane)
+def escaped_size(encoded):
+    size = len(encoded) + encoded.count(b'"') + encoded.count(b"\\")
+    if not encoded.isascii():
+        for char in encoded.decode("utf-8"):
+            if ord(char) > 127:
+                size += (6 if ord(char) <= 0xFFFF else 12) - len(char.encode("utf-8"))
+    return size
+
+#bytes of the body around the movies
+envelope_bytes = escaped_size(b'{"movies":[],"truncated":false}')
+
+#encode the movies in a body of at most max_bytes, returns the body (str) and the statistics of the encoding.
+#documents: list or stream of movies (e.g. llm_utils.stream_standard_query), a stream is read until the movies do not fit
+#even with the smallest projection, so the properties are dropped before the movies.
+#truncated: the movies are already a part of the results (e.g. the stream of the search was stopped)
+def encode_movies(documents, max_bytes=None, truncated=False, route=""):
+    max_bytes = max_bytes or default_max_bytes
+    #time spent encoding, without the time spent reading the stream
+    encode_time = 0.0
+
+    #movies encoded with each projection, and the size of the body with them (a comma after each movie)
+    encoded = {level: [] for level in trim_levels}
+    sizes = {level: envelope_bytes for level in trim_levels}
+    iterator = iter(documents)
+    try:
+        for doc in iterator:
+            start = time.time()
+            for level in trim_levels:
+                movie = dumps({prop: doc[prop] for prop in llm_utils.projection_profiles[level] if prop in doc})
+                encoded[level].append(movie)
+                sizes[level] += escaped_size(movie) + 1
+            encode_time += time.time() - start
+            if sizes[trim_levels[-1]] > max_bytes:
+                #the next movies would be dropped with every projection
+                truncated = True
+                break
+    finally:
+        if hasattr(iterator, "close"):
+            iterator.close()
+
+    #richest projection with all the movies read, the smallest one otherwise
+    start = time.time()
+    level = next((level for level in trim_levels if sizes[level] <= max_bytes), trim_levels[-1])
+    movies = encoded[level]
+
+    kept = 0
+    size = envelope_bytes
+    for movie in movies:
+        size += escaped_size(movie) + 1
+        if size > max_bytes:
+            break
+        kept += 1
+    truncated = truncated or kept < len(movies)
+
+    body = b'{"movies":[' + b",".join(movies[:kept]) + b'],"truncated":' + (b"true" if truncated else b"false") + b"}"
+    encode_ms = (encode_time + time.time() - start) * 1000
+
+    stats = {"bytes": len(body), "escaped_bytes": escaped_size(body), "encode_ms": round(encode_ms, 3), "level": level,
+             "movies": kept, "trimmed_movies": len(movies) - kept}
+    metrics.put_metrics({"AgentResponseBytes": stats["escaped_bytes"]}, dimensions={"Route": route}, unit="Bytes")
+    metrics.put_metrics({"AgentResponseEncodeTime": encode_ms}, dimensions={"Route": route}, unit="Milliseconds")
+    if level != trim_levels[0] or stats["trimmed_movies"]:
+        metrics.put_metrics({"AgentResponseTrimmed": 1}, dimensions={"Route": route, "Level": level})
+    return body.decode("utf-8"), stats
+
+#response of the action group for the request of the agent
+#https://docs.aws.amazon.com/bedrock/latest/userguide/agents-lambda.html#agents-lambda-response
+def action_response(event, body, status_code=200):
+    return {
+        'messageVersion': event.get('messageVersion', '1.0'),
+        'response': {
+            'actionGroup': event['actionGroup'],
+            'apiPath': event['apiPath'],
+            'httpMethod': event['httpMethod'],
+            'httpStatusCode': status_code,
+            'responseBody': {
+                'application/json': {
+                    'body': body
+                }
+            }
+        },
+        'sessionAttributes': event.get('sessionAttributes', {}),
+        'promptSessionAttributes': event.get('promptSessionAttributes', {})
+    }
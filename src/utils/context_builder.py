@@ -0,0 +1,164 @@
+import json
+import re
+
+try:
+    from utils import metrics
+except ImportError:
+    import metrics
+
+#fields, truncation and format of the documents given to the LLM for each route
+#wrap: each document in <document> tags (the prompt of the specific route already has the tags)
+route_profiles = {
+    "chain": {
+        "fields": ['original_title', 'year', 'genres', 'director', 'actors', 'description'],
+        "description_words": 60,
+        "list_items": 5,
+        "wrap": True
+    },
+    "specific": {
+        "fields": ['original_title', 'year', 'original_language', 'genres', 'director', 'actors', 'keywords', 'description', 'vote_average', 'popularity'],
+        "description_words": 150,
+        "list_items": 10,
+        "wrap": False
+    },
+    "similar": {
+        "fields": ['original_title', 'year', 'genres', 'keywords', 'description'],
+        "description_words": 80,
+        "list_items": 8,
+        "wrap": True
+    },
+}
+
+#fields holding lists, as arrays or comma separated strings
+list_fields = ['genres', 'keywords', 'actors']
+
+#fields truncated to a number of words
+long_text_fields = ['description']
+
+
+#approximate number of tokens of a text (about 4 characters per token)
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+def as_list(value):
+    if isinstance(value, list):
+        return value
+    if isinstance(value, str):
+        return [item.strip() for item in value.split(",") if item.strip()]
+    return [value]
+
+def truncate_words(text, max_words):
+    words = str(text).split()
+    if len(words) <= max_words:
+        return " ".join(words)
+    return " ".join(words[:max_words]) + "..."
+
+#set of words of a text, used to compare descriptions
+def word_set(text):
+    return set(re.findall(r"\w+", str(text).lower()))
+
+def jaccard(set_a, set_b):
+    if not set_a or not set_b:
+        return 0.0
+    return len(set_a & set_b) / len(set_a | set_b)
+
+
+#build the context of a prompt from the retrieved documents within a token budget:
+#selected fields only, long texts and lists truncated, near-duplicate documents dropped
+class ContextBuilder:
+
+    def __init__(self, route="chain", token_budget=1500, fields=None, description_words=None, list_items=None, duplicate_threshold=0.8, wrap=None) -> None:
+        profile = route_profiles.get(route, route_profiles["chain"])
+        self.route = route
+        self.token_budget = token_budget
+        self.fields = fields or profile["fields"]
+        self.description_words = description_words or profile["description_words"]
+        self.list_items = list_items or profile["list_items"]
+        self.duplicate_threshold = duplicate_threshold
+        self.wrap = profile["wrap"] if wrap is None else wrap
+
+    #compact text of a document, one "field: value" line per field
+    def format_document(self, doc):
+        lines = []
+        for field in self.fields:
+            value = doc.get(field)
+            if value is None or value == "" or value == []:
+                continue
+            if field in list_fields:
+                value = ", ".join(str(item) for item in as_list(value)[:self.list_items])
+            elif field in long_text_fields:
+                value = truncate_words(value, self.description_words)
+            lines.append(f"{field}: {value}")
+
+        text = "\n".join(lines)
+        if self.wrap:
+            text = f"<document>\n{text}\n</document>"
+        return text
+
+    #True if the document is a near duplicate of one of the kept documents (same title and year, or very similar description)
+    def is_duplicate(self, doc, kept):
+        key = (str(doc.get("original_title", "")).lower(), doc.get("year"))
+        words = word_set(doc.get("description", ""))
+        for other_key, other_words in kept:
+            if key == other_key or jaccard(words, other_words) >= self.duplicate_threshold:
+                return True
+        return False
+
+    #return the context text and the statistics of the compression
+    def build(self, documents):
+        parts = []
+        kept = []
+        context_tokens = 0
+        duplicates = 0
+        over_budget = 0
+
+        for doc in documents:
+            if self.is_duplicate(doc, kept):
+                duplicates += 1
+                continue
+
+            text = self.format_document(doc)
+            tokens = estimate_tokens(text)
+            if context_tokens + tokens > self.token_budget:
+                #the first document is always given, cut to the budget
+                if not parts:
+                    text = text[:self.token_budget * 4]
+                    tokens = estimate_tokens(text)
+                else:
+                    over_budget += 1
+                    continue
+
+            parts.append(text)
+            kept.append(((str(doc.get("original_title", "")).lower(), doc.get("year")), word_set(doc.get("description", ""))))
+            context_tokens += tokens
+
+        context = "\n".join(parts)
+        raw_tokens = estimate_tokens(json.dumps(documents))
+        stats = {
+            "documents": len(documents),
+            "documents_kept": len(parts),
+            "duplicates_dropped": duplicates,
+            "over_budget_dropped": over_budget,
+            "raw_tokens": raw_tokens,
+            "context_tokens": estimate_tokens(context),
+            "tokens_saved": max(0, raw_tokens - estimate_tokens(context)),
+        }
+
+        metrics.put_metrics({
+            "ContextTokens": stats["context_tokens"],
+            "ContextTokensSaved": stats["tokens_saved"],
+            "ContextDocumentsDropped": duplicates + over_budget,
+        }, dimensions={"Route": self.route})
+
+        return context, stats
+
+
+#context builders per (route, token budget), created once per process
+builders = {}
+
+#build the context of a route with the default profile
+def build_context(documents, route="chain", token_budget=1500):
+    key = (route, token_budget)
+    if key not in builders:
+        builders[key] = ContextBuilder(route=route, token_budget=token_budget)
+    return builders[key].build(documents)
@@ -0,0 +1,154 @@
+import collections
+import math
+import threading
+import time
+
+try:
+    from utils import metrics
+except ImportError:
+    import metrics
+
+#time kept to build and return the response before the lambda timeout, in milliseconds
+default_margin_ms = 500
+
+#time budget of a conversation turn when the caller does not give one, in milliseconds
+default_budget_ms = 25000
+
+#maximum time of each call in seconds, shortened to the remaining time of the deadline
+call_timeouts = {"embedding": 5, "search": 10, "llm": 30}
+
+#minimum remaining time in seconds to run the optional steps, they are skipped below it
+min_time = {
+    "query_optimisation": 4,
+    "sorting_llm": 2,
+    "search": 1,
+    "session_compaction": 3,
+}
+
+#the bedrock read timeouts are rounded down to whole seconds, one client per value (created on first use).
+#a call with less than the first value left fails fast with DeadlineExceeded instead of outliving the deadline.
+timeout_buckets = list(range(1, 61))
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+#absolute deadline of a request (epoch seconds), carried between the states in the event as epoch milliseconds
+class Deadline:
+
+    def __init__(self, expires_at=None) -> None:
+        self.expires_at = expires_at
+        #fallbacks taken while handling the request
+        self.fallbacks = []
+
+    #earliest of the deadline of the event, the time budget of the event and the remaining time of the lambda.
+    #budget_ms is used by the entry point when the event has neither a deadline nor a time budget.
+    @classmethod
+    def from_event(cls, event, context=None, margin_ms=default_margin_ms, budget_ms=None):
+        now = time.time()
+        candidates = []
+
+        if event.get("deadline"):
+            candidates.append(event["deadline"] / 1000)
+        elif event.get("time_budget_ms"):
+            candidates.append(now + event["time_budget_ms"] / 1000)
+        elif budget_ms:
+            candidates.append(now + budget_ms / 1000)
+
+        if context is not None and hasattr(context, "get_remaining_time_in_millis"):
+            candidates.append(now + (context.get_remaining_time_in_millis() - margin_ms) / 1000)
+
+        deadline = cls(min(candidates) if candidates else None)
+        deadline.fallbacks = list(event.get("fallbacks", []))
+        return deadline
+
+    #remaining time in seconds, infinite without a deadline
+    def remaining(self):
+        if self.expires_at is None:
+            return math.inf
+        return self.expires_at - time.time()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    #True if there are at least `seconds` left
+    def has_time(self, seconds):
+        return self.remaining() >= seconds
+
+    #raise DeadlineExceeded if there is no time left
+    def check(self, operation=""):
+        if self.expired():
+            raise DeadlineExceeded(f"deadline exceeded before {operation}")
+
+    #timeout of a call: the remaining time, capped by max_timeout
+    def timeout(self, max_timeout=None, min_timeout=0.1):
+        remaining = self.remaining()
+        if max_timeout is not None:
+            remaining = min(remaining, max_timeout)
+        if remaining == math.inf:
+            return None
+        return max(min_timeout, remaining)
+
+    #deadline for the next state of the step function
+    def to_event(self):
+        if self.expires_at is None:
+            return None
+        return int(round(self.expires_at * 1000))
+
+    #record a fallback taken because the time budget was running low or a call timed out
+    def record_fallback(self, name, route=""):
+        self.fallbacks.append(name)
+        metrics.put_metrics({"Fallback": 1}, dimensions={"Fallback": name, "Route": route})
+
+
+#bedrock runtime clients per read timeout, without retries as the deadline leaves no time for them
+bedrock_clients = {}
+bedrock_clients_lock = threading.Lock()
+
+#read timeout of the client of a call: the largest bucket at or below the timeout, so that the call does not outlive the deadline
+def timeout_bucket(timeout):
+    if timeout < timeout_buckets[0]:
+        raise DeadlineExceeded(f"{timeout:.2f}s left, under the minimum timeout of a bedrock call ({timeout_buckets[0]}s)")
+    return max(value for value in timeout_buckets if value <= timeout)
+
+def get_bedrock_client(timeout=None):
+    bucket = timeout_bucket(timeout) if timeout is not None else None
+
+    with bedrock_clients_lock:
+        if bucket not in bedrock_clients:
+            import boto3
+            from botocore.config import Config
+
+            if bucket is None:
+                bedrock_clients[bucket] = boto3.client('bedrock-runtime')
+            else:
+                bedrock_clients[bucket] = boto3.client('bedrock-runtime', config=Config(
+                    connect_timeout=min(bucket, 2),
+                    read_timeout=bucket,
+                    retries={"mode": "standard", "total_max_attempts": 1}
+                ))
+        return bedrock_clients[bucket]
+
+
+#last results per key, returned when there is no time left to search
+class FallbackCache:
+
+    def __init__(self, maxsize=256) -> None:
+        self.maxsize = maxsize
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.items:
+                return None
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
@@ -0,0 +1,101 @@
+import json
+import os
+import threading
+
+try:
+    from utils import context_builder
+except ImportError:
+    import context_builder
+
+#text of the movies given to the embedding model, for each profile:
+#fields: ordered (field, label) pairs, max_words: truncation of the long text fields, list_items: items kept in the list fields
+#"json" is the previous format (json.dumps of the whole row), kept to compare and to query indexes embedded with it
+text_profiles = {
+    "compact": {
+        "fields": [("original_title", "Title"), ("year", "Year"), ("genres", "Genres"), ("director", "Director"),
+                   ("actors", "Actors"), ("keywords", "Keywords"), ("description", "Description")],
+        "max_words": 120,
+        "list_items": 8,
+        "separator": "\n",
+    },
+    "short": {
+        "fields": [("original_title", "Title"), ("genres", "Genres"), ("keywords", "Keywords"), ("description", "Description")],
+        "max_words": 60,
+        "list_items": 5,
+        "separator": "\n",
+    },
+    "json": None,
+}
+
+#profile used at ingestion and for the "document as query" embeddings (similar movies), to keep the same at both ends
+default_profile = os.environ.get("EMBEDDING_TEXT_PROFILE", "compact")
+
+
+#build the text embedded for a movie from a declarative profile, the same builder is used at ingestion and at query time.
+#The builder counts the documents and tokens it built to report the average tokens per document and the throughput.
+class DocumentTextBuilder:
+
+    def __init__(self, profile=default_profile, fields=None, max_words=None, list_items=None, separator=None) -> None:
+        if profile not in text_profiles:
+            raise ValueError(f"unknown text profile {profile}, expected one of {list(text_profiles)}")
+        spec = text_profiles[profile] or {}
+        self.profile = profile
+        self.fields = fields or spec.get("fields")
+        self.max_words = max_words or spec.get("max_words")
+        self.list_items = list_items or spec.get("list_items")
+        self.separator = separator if separator is not None else spec.get("separator", "\n")
+        self.lock = threading.Lock()
+        self.documents = 0
+        self.tokens = 0
+
+    #text of a document (csv row, typed document or search hit)
+    def build(self, doc):
+        if self.fields is None:
+            text = json.dumps(doc)
+        else:
+            parts = []
+            for field, label in self.fields:
+                value = doc.get(field)
+                if value is None or value == "" or value == []:
+                    continue
+                if field in context_builder.list_fields:
+                    value = ", ".join(str(item) for item in context_builder.as_list(value)[:self.list_items])
+                elif field in context_builder.long_text_fields:
+                    value = context_builder.truncate_words(value, self.max_words)
+                parts.append(f"{label}: {value}")
+            text = self.separator.join(parts)
+
+        with self.lock:
+            self.documents += 1
+            self.tokens += context_builder.estimate_tokens(text)
+        return text
+
+    def estimate_tokens(self, doc):
+        return context_builder.estimate_tokens(self.build(doc))
+
+    #average tokens per document and, with the elapsed time in seconds of the ingestion, its throughput
+    def stats(self, elapsed=None):
+        with self.lock:
+            stats = {
+                "profile": self.profile,
+                "documents": self.documents,
+                "tokens": self.tokens,
+                "avg_tokens_per_document": self.tokens / self.documents if self.documents else 0.0,
+            }
+        if elapsed:
+            stats["documents_per_second"] = stats["documents"] / elapsed
+            stats["tokens_per_second"] = stats["tokens"] / elapsed
+        return stats
+
+
+#builders per profile, created once per process
+builders = {}
+
+def get_builder(profile=default_profile):
+    if profile not in builders:
+        builders[profile] = DocumentTextBuilder(profile)
+    return builders[profile]
+
+#text embedded for a movie with the profile
+def build_text(doc, profile=default_profile):
+    return get_builder(profile).build(doc)
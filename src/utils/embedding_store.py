@@ -0,0 +1,166 @@
+#Versioned artifact of the movie embeddings, reusable to restore or create an index without calling Bedrock.
+#An artifact is a folder with:
+#  vectors.npy    matrix (number of movies x dimension), float32 or int8, loaded memory-mapped
+#  scales.npy     scale of each row of an int8 matrix (vector = int8 row * scale)
+#  metadata.json  format version, model id, input_type, text profile (see document_text), dimension, dtype and the columns of the movies:
+#                 the data columns (tmdb_id, title, ...) and content_hash (hash of the data columns of the typed document)
+#
+#usage:
+#  with EmbeddingArtifactWriter("../artifacts/embeddings/movies-v1", "cohere.embed-english-v3", "search_document", 1024) as writer:
+#      writer.add(typed_document, vector)
+#  artifact = EmbeddingArtifact.load("../artifacts/embeddings/movies-v1")
+#  for doc in artifact.documents(): ...
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+#version of the artifact format, written in the metadata and checked when loading
+format_version = 1
+
+#properties of the documents kept as columns of the metadata
+data_columns = ['tmdb_id', 'original_language', 'original_title', 'description', 'genres', 'year', 'keywords', 'director', 'actors',
+                'popularity', 'popularity_bins', 'vote_average', 'vote_average_bins']
+
+vector_field = "vector_index"
+
+
+#hash of the columns of a document, used to detect the movies that changed since the artifact was written
+def content_hash(doc, columns=None):
+    content = {column: doc.get(column) for column in columns or data_columns}
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:32]
+
+#int8 rows and the scale of each row (symmetric quantization)
+def quantize(matrix):
+    scales = np.abs(matrix).max(axis=1) / 127
+    scales[scales == 0] = 1
+    return np.round(matrix / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+
+#write an artifact. The files are written to a temporary folder renamed at the end, a failed run does not leave a partial artifact.
+class EmbeddingArtifactWriter:
+
+    def __init__(self, path, model_id, input_type, dimension, dtype="float32", columns=None, text_profile=None) -> None:
+        if dtype not in ["float32", "int8"]:
+            raise ValueError(f"dtype must be float32 or int8, not {dtype}")
+        self.path = path
+        self.model_id = model_id
+        self.input_type = input_type
+        self.text_profile = text_profile
+        self.dimension = dimension
+        self.dtype = dtype
+        self.columns = columns or data_columns
+        self.vectors = []
+        self.metadata = {column: [] for column in self.columns}
+        self.metadata["content_hash"] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    #add a typed document (see llm_utils.to_typed_document) and its vector
+    def add(self, doc, vector):
+        if len(vector) != self.dimension:
+            raise ValueError(f"vector of dimension {len(vector)} for tmdb_id {doc.get('tmdb_id')}, expected {self.dimension}")
+        self.vectors.append(np.asarray(vector, dtype=np.float32))
+        for column in self.columns:
+            self.metadata[column].append(doc.get(column))
+        self.metadata["content_hash"].append(content_hash(doc, self.columns))
+
+    def close(self):
+        tmp_path = f"{self.path}.tmp"
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        matrix = np.vstack(self.vectors) if self.vectors else np.zeros((0, self.dimension), dtype=np.float32)
+        if self.dtype == "int8":
+            matrix, scales = quantize(matrix)
+            np.save(os.path.join(tmp_path, "scales.npy"), scales)
+        np.save(os.path.join(tmp_path, "vectors.npy"), matrix)
+
+        with open(os.path.join(tmp_path, "metadata.json"), "w") as file:
+            json.dump({
+                "format_version": format_version,
+                "model_id": self.model_id,
+                "input_type": self.input_type,
+                "text_profile": self.text_profile,
+                "dimension": self.dimension,
+                "dtype": self.dtype,
+                "count": len(self.vectors),
+                "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "columns": self.metadata,
+            }, file)
+
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.rename(tmp_path, self.path)
+        return self.path
+
+
+#artifact loaded with a memory-mapped matrix: only the rows that are read are loaded in memory
+class EmbeddingArtifact:
+
+    def __init__(self, path, vectors, scales, metadata) -> None:
+        self.path = path
+        self.vectors = vectors
+        self.scales = scales
+        self.metadata = metadata
+        self.columns = metadata["columns"]
+        self.data_columns = [column for column in self.columns if column != "content_hash"]
+        self.row_by_hash = {value: row for row, value in enumerate(self.columns["content_hash"])}
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(os.path.join(path, "metadata.json")) as file:
+            metadata = json.load(file)
+        if metadata.get("format_version") != format_version:
+            raise ValueError(f"artifact {path} has format version {metadata.get('format_version')}, expected {format_version}")
+
+        mmap_mode = "r" if mmap else None
+        vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode=mmap_mode)
+        scales = np.load(os.path.join(path, "scales.npy"), mmap_mode=mmap_mode) if metadata["dtype"] == "int8" else None
+        if vectors.shape != (metadata["count"], metadata["dimension"]):
+            raise ValueError(f"artifact {path} has vectors of shape {vectors.shape}, expected {(metadata['count'], metadata['dimension'])}")
+        return cls(path, vectors, scales, metadata)
+
+    def __len__(self):
+        return self.metadata["count"]
+
+    #float32 vector of a row
+    def vector(self, row):
+        if self.scales is None:
+            return np.asarray(self.vectors[row], dtype=np.float32)
+        return self.vectors[row].astype(np.float32) * self.scales[row]
+
+    #document of a row without its vector
+    def document(self, row):
+        return {column: self.columns[column][row] for column in self.data_columns}
+
+    #typed documents with their vector, ready to be indexed
+    def documents(self):
+        for row in range(len(self)):
+            doc = self.document(row)
+            doc[vector_field] = self.vector(row).tolist()
+            yield doc
+
+    #vector of the document if it was embedded with the same model, input type and text profile and did not change, None otherwise
+    def get_vector(self, doc, model_id=None, input_type=None, text_profile=None):
+        if model_id is not None and model_id != self.metadata["model_id"]:
+            return None
+        if input_type is not None and input_type != self.metadata["input_type"]:
+            return None
+        if text_profile is not None and text_profile != self.metadata.get("text_profile"):
+            return None
+        row = self.row_by_hash.get(content_hash(doc, self.data_columns))
+        return None if row is None else self.vector(row).tolist()
+
+    def describe(self):
+        return {key: value for key, value in self.metadata.items() if key != "columns"}
@@ -0,0 +1,163 @@
+import gzip
+import json
+import threading
+import time
+
+try:
+    from utils import llm_utils
+    from utils import metrics
+except ImportError:
+    import llm_utils
+    import metrics
+
+#precomputed top-N movies for every value of the common facets, sorted like the standard search (popularity, descending).
+#A standard search filtering on a single facet value (e.g. {"genres": "Horror"}, {"year": "1990s"}, {"director": "Ridley Scott"})
+#is answered from the views without calling OpenSearch. Directors are matched on their full name only.
+
+#version of the views file format
+format_version = 1
+
+#facet -> property of the movies. decade is derived from the year
+facets = {
+    "genres": "genres",
+    "year": "year",
+    "decade": "year",
+    "director": "director",
+    "original_language": "original_language",
+    "popularity_bins": "popularity_bins",
+    "vote_average_bins": "vote_average_bins",
+}
+
+#values compared in lowercase, as the lowercase normalizer of their keyword (sub)field in the index
+lowercase_facets = ["genres", "director", "original_language"]
+
+#default number of movies per view, queries asking for more go to opensearch
+default_top_n = 50
+
+
+def facet_keys(facet, movie):
+    value = movie.get(facets[facet])
+    if value is None or value == "":
+        return []
+    if facet == "decade":
+        return [str(int(value) // 10 * 10)]
+    values = llm_utils.split_list_value(value) if facets[facet] in llm_utils.multi_valued_fields or facet == "director" else [value]
+    return [str(val).lower() if facet in lowercase_facets else str(val) for val in values]
+
+#build the views from typed documents (see llm_utils.to_typed_document), the movies are stored once and the views hold their rows
+def build_views(documents, top_n=default_top_n, sort_field="popularity"):
+    movies = []
+    for doc in documents:
+        movies.append({column: doc.get(column) for column in llm_utils.projection_profiles["full"]})
+    #same order as the standard search, the movies without value last (see llm_utils.sort_by_value)
+    order = llm_utils.sort_by_value(range(len(movies)), lambda row: movies[row].get(sort_field))
+
+    views = {facet: {} for facet in facets}
+    for row in order:
+        for facet in facets:
+            for key in facet_keys(facet, movies[row]):
+                rows = views[facet].setdefault(key, [])
+                if len(rows) < top_n:
+                    rows.append(row)
+
+    return {
+        "format_version": format_version,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "sort_field": sort_field,
+        "top_n": top_n,
+        "movies": movies,
+        "views": views,
+    }
+
+#write the views to a compressed json file
+def write_views(documents, path, top_n=default_top_n):
+    views = build_views(documents, top_n=top_n)
+    with open(path, "wb") as file:
+        file.write(gzip.compress(json.dumps(views, separators=(",", ":")).encode("utf-8")))
+    return {"movies": len(views["movies"]), "views": sum(len(values) for values in views["views"].values())}
+
+
+#facet and key of a standard search filtering on a single facet value, None for any other query
+def match_query(prop_value_list):
+    if not isinstance(prop_value_list, list):
+        prop_value_list = [prop_value_list]
+    props = [(prop, value) for elt in prop_value_list for prop, value in elt.items()]
+    if len(props) != 1 or props[0][0] not in facets:
+        return None
+    prop, value = props[0]
+
+    try:
+        values = llm_utils.parse_value_list(value)
+    except (ValueError, SyntaxError):
+        return None
+
+    if prop == "year":
+        #several years are alternatives, not a single facet value
+        if len(values) != 1:
+            return None
+        try:
+            year_range = llm_utils.parse_year_range(values[0])
+        except (ValueError, TypeError):
+            return None
+        if year_range.get("gte") is not None and year_range.get("gte") == year_range.get("lte"):
+            return "year", str(year_range["gte"])
+        if year_range.get("gte") is not None and year_range["gte"] % 10 == 0 and year_range.get("lte") == year_range["gte"] + 9:
+            return "decade", str(year_range["gte"])
+        return None
+
+    if len(values) != 1 or str(values[0]).strip() == "":
+        return None
+    key = str(values[0]).strip()
+    return prop, key.lower() if prop in lowercase_facets else key
+
+
+class FacetViews:
+
+    def __init__(self, data) -> None:
+        if data.get("format_version") != format_version:
+            raise ValueError(f"facet views have format version {data.get('format_version')}, expected {format_version}")
+        self.movies = data["movies"]
+        self.views = data["views"]
+        self.top_n = data["top_n"]
+        self.sort_field = data["sort_field"]
+        self.created_at = data["created_at"]
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as file:
+            return cls(json.loads(gzip.decompress(file.read()).decode("utf-8")))
+
+    #top k movies of the query with the projection, None if the query is not a single facet value or asks for more than the view holds
+    def lookup(self, prop_value_list, k=10, projection="full", sort_field="popularity"):
+        match = match_query(prop_value_list)
+        if match is None or k > self.top_n or sort_field != self.sort_field:
+            metrics.put_metrics({"FacetViewMisses": 1}, dimensions={"Facet": match[0] if match else "none"})
+            return None
+
+        #a value missing from the views (e.g. part of a director name, matched as a phrase by opensearch) goes to opensearch
+        facet, key = match
+        if key not in self.views[facet]:
+            metrics.put_metrics({"FacetViewMisses": 1}, dimensions={"Facet": facet})
+            return None
+
+        fields = llm_utils.get_source_filter(projection, llm_utils.projection_profiles["full"])["includes"]
+        rows = self.views[facet][key]
+        metrics.put_metrics({"FacetViewHits": 1}, dimensions={"Facet": facet})
+        return [{field: self.movies[row][field] for field in fields if field in self.movies[row]} for row in rows[:k]]
+
+
+#views per file, loaded once per process
+loaded_views = {}
+loaded_lock = threading.Lock()
+
+def get_views(path):
+    with loaded_lock:
+        if path not in loaded_views:
+            loaded_views[path] = FacetViews.load(path)
+        return loaded_views[path]
+
+#movies of the standard search from the views of the file, None when the query has to be sent to opensearch
+def lookup(path, prop_value_list, k=10, projection="full"):
+    if not path:
+        return None
+    return get_views(path).lookup(prop_value_list, k=k, projection=projection)
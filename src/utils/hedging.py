@@ -0,0 +1,186 @@
+import collections
+import concurrent.futures
+import os
+import threading
+import time
+
+try:
+    from utils import metrics
+except ImportError:
+    import metrics
+
+#hedging of the opensearch searches and of the embedding calls: "on" or "off" (default), can be set per call
+default_enabled = os.environ.get("HEDGE_REQUESTS", "off") == "on"
+
+#percentile of the recent latencies after which a duplicate request is sent
+default_percentile = float(os.environ.get("HEDGE_PERCENTILE", "95"))
+
+#maximum share of extra requests, e.g. 0.05 for at most 5% more requests
+default_max_ratio = float(os.environ.get("HEDGE_MAX_RATIO", "0.05"))
+
+#threads of the duplicate requests, shared by all the hedged calls of the process (the first attempts never wait for them)
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=16, thread_name_prefix="hedge")
+
+
+#latencies of the last requests of an operation
+class LatencyTracker:
+
+    def __init__(self, window=200) -> None:
+        self.latencies = collections.deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def record(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def count(self):
+        return len(self.latencies)
+
+    #latency at the percentile (0-100) of the window, None when empty
+    def percentile(self, percentile):
+        with self.lock:
+            values = sorted(self.latencies)
+        if not values:
+            return None
+        index = min(len(values) - 1, int(len(values) * percentile / 100))
+        return values[index]
+
+
+#send a duplicate request when the first one is slower than the percentile delay, and return the first answer.
+#the duplicates are limited by a token bucket: each request adds max_ratio tokens and each duplicate uses one,
+#so there are at most max_ratio extra requests on average plus a burst of max_tokens.
+class Hedger:
+
+    def __init__(self, name, percentile=None, max_ratio=None, min_delay=0.01, max_delay=5.0, min_samples=20, max_tokens=2) -> None:
+        self.name = name
+        self.percentile = percentile or default_percentile
+        self.max_ratio = default_max_ratio if max_ratio is None else max_ratio
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.min_samples = min_samples
+        self.max_tokens = max_tokens
+        self.tracker = LatencyTracker()
+        self.tokens = 0.0
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.hedges = 0
+        self.wins = 0
+
+    #delay before sending the duplicate, None while there are not enough latencies to estimate it
+    def delay(self):
+        if self.tracker.count() < self.min_samples:
+            return None
+        return min(self.max_delay, max(self.min_delay, self.tracker.percentile(self.percentile)))
+
+    #True if the budget has a token for a duplicate
+    def can_hedge(self):
+        with self.lock:
+            return self.tokens >= 1
+
+    #True if the budget allows a duplicate for this request
+    def acquire(self):
+        with self.lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.hedges += 1
+                return True
+            return False
+
+    #run an attempt into its future, the latency is measured from the start of the attempt (not from the time it was queued)
+    #and recorded for every attempt, including the ones that lost
+    def run(self, fn, future):
+        if not future.set_running_or_notify_cancel():
+            return
+        start = time.time()
+        try:
+            result = fn()
+        except BaseException as e:
+            self.tracker.record(time.time() - start)
+            future.set_exception(e)
+            return
+        self.tracker.record(time.time() - start)
+        future.set_result(result)
+
+    #run fn (no argument) and return its result, hedged when it is slower than the delay.
+    #the first attempt runs on the caller thread when no duplicate can be sent (no delay estimated yet or no budget),
+    #otherwise on a thread of its own so that the caller can return the answer of the duplicate: the first attempts are
+    #never queued behind the executor, only the duplicates are.
+    def call(self, fn):
+        with self.lock:
+            self.requests += 1
+            self.tokens = min(self.max_tokens, self.tokens + self.max_ratio)
+
+        delay = self.delay()
+        if delay is None or not self.can_hedge():
+            start = time.time()
+            try:
+                return fn()
+            finally:
+                self.tracker.record(time.time() - start)
+                if delay is not None:
+                    metrics.put_metrics({"HedgeRequests": 1, "Hedged": 0, "HedgeWins": 0}, dimensions={"Operation": self.name})
+
+        first = concurrent.futures.Future()
+        threading.Thread(target=self.run, args=(fn, first), name=f"hedge-{self.name}", daemon=True).start()
+        done, _ = concurrent.futures.wait([first], timeout=delay)
+        if done or not self.acquire():
+            metrics.put_metrics({"HedgeRequests": 1, "Hedged": 0, "HedgeWins": 0}, dimensions={"Operation": self.name})
+            return first.result()
+
+        second = concurrent.futures.Future()
+        executor.submit(self.run, fn, second)
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                won = future is second
+                if won:
+                    with self.lock:
+                        self.wins += 1
+                else:
+                    #the duplicate is not sent if it is still waiting for a thread
+                    second.cancel()
+                metrics.put_metrics({"HedgeRequests": 1, "Hedged": 1, "HedgeWins": int(won)}, dimensions={"Operation": self.name})
+                return future.result()
+
+        #both attempts failed
+        metrics.put_metrics({"HedgeRequests": 1, "Hedged": 1, "HedgeWins": 0}, dimensions={"Operation": self.name})
+        raise error
+
+    def stats(self):
+        with self.lock:
+            return {
+                "operation": self.name,
+                "requests": self.requests,
+                "hedges": self.hedges,
+                "wins": self.wins,
+                "hedge_rate": self.hedges / self.requests if self.requests else 0.0,
+                "win_rate": self.wins / self.hedges if self.hedges else 0.0,
+                "delay": self.delay(),
+            }
+
+
+#hedgers per operation, the latencies of each operation are tracked separately
+hedgers = {}
+hedgers_lock = threading.Lock()
+
+def get_hedger(name):
+    with hedgers_lock:
+        if name not in hedgers:
+            hedgers[name] = Hedger(name)
+        return hedgers[name]
+
+#run fn, hedged if enabled (default: HEDGE_REQUESTS environment variable)
+def call(name, fn, enabled=None):
+    if not (default_enabled if enabled is None else enabled):
+        return fn()
+    return get_hedger(name).call(fn)
+
+#hedge rate and wins of each operation
+def get_stats():
+    with hedgers_lock:
+        return [hedger.stats() for hedger in hedgers.values()]
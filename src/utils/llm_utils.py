@@ -3,14 +3,303 @@ import boto3
 import json
 import time
 import ast
+import collections
+import copy
+import functools
+import heapq
+import os
+import random
+import re
+import threading
 
 from opensearchpy import (
     OpenSearch,
     RequestsHttpConnection,
-    AWSV4SignerAuth
+    AWSV4SignerAuth,
+    NotFoundError
 )
 
+try:
+    from utils import context_builder
+    from utils import hedging
+    from utils import profiling
+    from utils import rate_limit
+    from utils import single_flight
+    from utils import traffic_capture
+    from utils.deadline import DeadlineExceeded, get_bedrock_client, call_timeouts, min_time, timeout_buckets
+except ImportError:
+    import context_builder
+    import hedging
+    import profiling
+    import rate_limit
+    import single_flight
+    import traffic_capture
+    from deadline import DeadlineExceeded, get_bedrock_client, call_timeouts, min_time, timeout_buckets
+
+#type of each property in the opensearch index, subfields are listed as "property.subfield"
+#(see get_movies_index_body and notebooks/2-notebook_os_index_prep.ipynb)
+index_schema = {
+    "tmdb_id": "integer",
+    "original_language": "keyword",
+    "original_title": "text",
+    "original_title.keyword": "keyword",
+    "description": "text",
+    "genres": "text",
+    "genres.keyword": "keyword",
+    "year": "integer",
+    "keywords": "text",
+    "keywords.keyword": "keyword",
+    "director": "text",
+    "director.keyword": "keyword",
+    "actors": "text",
+    "actors.keyword": "keyword",
+    "popularity": "float",
+    "popularity_bins": "keyword",
+    "vote_average": "float",
+    "vote_average_bins": "keyword"
+}
+
+numeric_field_types = ["integer", "long", "float", "double"]
+
+#properties that can hold several values for the same movie
+multi_valued_fields = ["genres", "keywords", "actors"]
+
+#properties with a closed vocabulary, filtered with exact term queries on their keyword (sub)field.
+#names (actors, director, title) keep a phrase match on the text field to accept partial names e.g. "Stallone"
+exact_match_fields = ["genres", "original_language", "popularity_bins", "vote_average_bins"]
+
+#numeric properties and their python type
+numeric_fields = {"tmdb_id": int, "year": int, "popularity": float, "vote_average": float}
+
+#index settings and mappings of the movies index.
+#array properties are indexed as text for full text search with a lowercase keyword subfield for exact filters,
+#numeric properties keep their doc values so that filters and sorts run on doc values.
+@staticmethod
+def get_movies_index_body(dimension=1024, engine="faiss", ef_search=100):
+
+    def text_with_keyword():
+        return {
+            "type": "text",
+            "fields": {
+                "keyword": {
+                    "type": "keyword",
+                    "normalizer": "lowercase_normalizer",
+                    "ignore_above": 256
+                }
+            }
+        }
 
+    return {
+        "settings": {
+            "index": {
+                "number_of_shards": 4,
+                "number_of_replicas": 0,
+                "knn": True,
+                "knn.algo_param.ef_search": ef_search
+            },
+            "analysis": {
+                "normalizer": {
+                    "lowercase_normalizer": {
+                        "type": "custom",
+                        "filter": ["lowercase"]
+                    }
+                }
+            }
+        },
+        "mappings": {
+            "properties": {
+                "tmdb_id": {"type": "integer"},
+                "original_language": {"type": "keyword", "normalizer": "lowercase_normalizer"},
+                "original_title": text_with_keyword(),
+                "description": {"type": "text"},
+                "genres": text_with_keyword(),
+                "year": {"type": "integer", "doc_values": True},
+                "keywords": text_with_keyword(),
+                "director": text_with_keyword(),
+                "actors": text_with_keyword(),
+                "popularity": {"type": "float", "doc_values": True},
+                "popularity_bins": {"type": "keyword"},
+                "vote_average": {"type": "float", "doc_values": True},
+                "vote_average_bins": {"type": "keyword"},
+                "vector_index": {
+                    "type": "knn_vector",
+                    "dimension": dimension, #if you use cohere: dimension of the embedding is 1024, for titan: 1536
+                    "method": {
+                        "name": "hnsw",
+                        "space_type": "l2",
+                        "engine": engine, #faiss supports efficient k-NN filtering (see query_opensearch)
+                        "parameters": {
+                            "ef_construction": 512,
+                            "m": 16
+                        }
+                    }
+                }
+            }
+        }
+    }
+
+#split a comma separated value (as exported in the csv files) into a list
+@staticmethod
+def split_list_value(value):
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    if isinstance(value, float) and value != value: #NaN from pandas
+        return []
+    return [item.strip() for item in str(value).split(",") if item.strip() != ""]
+
+#convert a movie document (csv row or document from the legacy index) to the typed format of the index
+@staticmethod
+def to_typed_document(doc):
+    typed_doc = dict(doc)
+
+    for prop in multi_valued_fields:
+        if prop in typed_doc:
+            typed_doc[prop] = split_list_value(typed_doc[prop])
+
+    for prop, cast in numeric_fields.items():
+        if prop in typed_doc:
+            value = typed_doc[prop]
+            try:
+                #"1994.0" or 1994.0 -> 1994 for integer properties
+                typed_doc[prop] = cast(float(value)) if value not in (None, "") else None
+            except (ValueError, TypeError):
+                typed_doc[prop] = None
+            if typed_doc[prop] is not None and typed_doc[prop] != typed_doc[prop]: #NaN
+                typed_doc[prop] = None
+
+    return typed_doc
+
+#numeric value of a property to sort on, None when it is missing or not a number ("1994" and 1994.0 are the year 1994)
+@staticmethod
+def numeric_value(value):
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        value = float(value)
+    except (ValueError, TypeError):
+        return None
+    return None if value != value else value #NaN
+
+#order items on the numeric value returned by value_of, the items without value last in both orders as with missing: _last
+#in opensearch (used by the sorting state, the semantic search lambda and the local index).
+#the items with the same value keep their order. k: only the first k items are returned, selected with a partial sort
+@staticmethod
+def sort_by_value(items, value_of, descending=True, k=None):
+    valued = []
+    missing = []
+    for item in items:
+        value = numeric_value(value_of(item))
+        if value is None:
+            missing.append(item)
+        else:
+            valued.append((value, item))
+
+    if k is None:
+        valued.sort(key=lambda pair: pair[0], reverse=descending)
+    else:
+        valued = (heapq.nlargest if descending else heapq.nsmallest)(k, valued, key=lambda pair: pair[0])
+    result = [item for _, item in valued] + missing
+    return result if k is None else result[:k]
+
+#load the schema of an index as a dict property -> type. subfields are returned as "property.subfield"
+@staticmethod
+def load_index_schema(os_client, index_name):
+    mapping = os_client.indices.get_mapping(index=index_name)
+    #the mapping is keyed by the name of the index behind an alias
+    properties = (mapping[index_name] if index_name in mapping else next(iter(mapping.values())))["mappings"]["properties"]
+
+    schema = {}
+    for prop, definition in properties.items():
+        schema[prop] = definition.get("type", "object")
+        for subfield, sub_definition in definition.get("fields", {}).items():
+            schema[f"{prop}.{subfield}"] = sub_definition.get("type")
+    return schema
+
+#schema per index, loaded once per process
+index_schema_cache = {}
+
+#return the schema of the index. An index that does not exist raises a ValueError, the default index_schema is used (with a
+#warning) when the mapping can't be read e.g. without the permission, the filters are then compiled for the movies index.
+@staticmethod
+def get_index_schema(os_client, index_name):
+    if index_name not in index_schema_cache:
+        try:
+            index_schema_cache[index_name] = load_index_schema(os_client, index_name)
+        except NotFoundError as e:
+            raise ValueError(f"index {index_name} not found: {e}")
+        except Exception as e:
+            logging.getLogger(__name__).warning(f"could not load the schema of {index_name}, compiling the filters with the default schema of the movies index: {e}")
+            index_schema_cache[index_name] = index_schema
+    return index_schema_cache[index_name]
+
+
+#_source projection profiles: properties returned by opensearch for each route.
+#vector_index is never returned.
+projection_profiles = {
+    #every property of the movie e.g. to answer questions about a specific movie
+    "full": ['tmdb_id', 'original_language', 'original_title', 'description', 'genres', 'year', 'keywords', 'director', 'actors', 'popularity', 'popularity_bins',
+             'vote_average', 'vote_average_bins'],
+    #lists of movies returned to the user: no long description and keywords
+    "list": ['tmdb_id', 'original_language', 'original_title', 'genres', 'year', 'director', 'actors', 'popularity', 'popularity_bins',
+             'vote_average', 'vote_average_bins'],
+    #titles and the properties used for sorting
+    "titles": ['tmdb_id', 'original_title', 'year', 'popularity', 'vote_average'],
+    #ids and the properties used for sorting, the rest is hydrated from a local cache (see hydrate_documents)
+    "ids": ['tmdb_id', 'year', 'popularity', 'vote_average']
+}
+
+#build the _source filter for a projection profile name or a list of properties.
+#data_columns is the list of properties the caller is allowed to return.
+@staticmethod
+def get_source_filter(projection, data_columns):
+    if isinstance(projection, str):
+        if projection not in projection_profiles:
+            raise ValueError(f"unknown projection profile {projection}, use one of {list(projection_profiles.keys())}")
+        projection = projection_profiles[projection]
+
+    return {
+        "includes": [prop for prop in projection if prop in data_columns],
+        "excludes": ["vector_index"]
+    }
+
+#movies cache per file, loaded once per process
+movies_cache = {}
+
+#load the typed dataset (json lines exported by notebooks/0-notebook_data_prep.ipynb) as a dict tmdb_id -> movie
+@staticmethod
+def load_movies_cache(path):
+    if path not in movies_cache:
+        cache = {}
+        with open(path) as file:
+            for line in file:
+                if line.strip():
+                    movie = json.loads(line)
+                    cache[movie["tmdb_id"]] = movie
+        movies_cache[path] = cache
+    return movies_cache[path]
+
+#complete documents returned with the "ids" projection with the properties of the projection from the local cache
+@staticmethod
+def hydrate_documents(documents, cache_path, projection="list"):
+    cache = load_movies_cache(cache_path)
+    fields = projection_profiles[projection] if isinstance(projection, str) else projection
+
+    result = []
+    for doc in documents:
+        cached = cache.get(doc.get("tmdb_id"), {})
+        hydrated = {prop: cached[prop] for prop in fields if prop in cached}
+        #values from opensearch take precedence over the cache
+        hydrated.update(doc)
+        result.append(hydrated)
+    return result
+
+
+#estimated number of tokens of a text (about 4 characters per token)
+@staticmethod
+def estimate_tokens(text):
+    return len(text) // 4 + 1
 
 #format the output list as a well formed text
 @staticmethod
@@ -25,50 +314,6 @@ def format_opensearch_response_for_llm(_dict):
 
 
 
-#format the output list according to what is required by the documentation.
-"""
-https://docs.aws.amazon.com/bedrock/latest/userguide/agents-lambda.html#agents-lambda-response
-
-{
-    "messageVersion": "1.0",
-    "response": {
-        "actionGroup": "string",
-        "apiPath": "string",
-        "httpMethod": "string",
-        "httpStatusCode": number,
-        "responseBody": {
-            "<contentType>": {
-                "body": "JSON-formatted string" 
-            }
-        }
-    },
-    "sessionAttributes": {
-        "string": "string",
-    },
-    "promptSessionAttributes": {
-        "string": "string"
-    }
-}
-"""
-def generate_json_response(data):
-    response = {
-        "messageVersion": "1.0",
-        "response": {
-            "actionGroup": "string",
-            "apiPath": "string",
-            "httpMethod": "string",
-            "httpStatusCode": 200,
-            "responseBody": {
-                "application/json": {
-                    "body": json.dumps(data)
-                }
-            }
-        },
-        "sessionAttributes": {},
-        "promptSessionAttributes": {}
-    }
-    return response
-
 @staticmethod
 def extract_response_from_os_response(_dict):
     result = []
@@ -79,10 +324,16 @@ def extract_response_from_os_response(_dict):
 
 
 
+#secret values per secret name, read once per process
+secrets_cache = {}
+
 #get secret from AWS secret manager
 @staticmethod
 def get_secret(secret_name, region_name):
 
+    if secret_name in secrets_cache:
+        return secrets_cache[secret_name]
+
     # Create a Secrets Manager client
     session = boto3.session.Session()
     client = session.client(
@@ -94,18 +345,34 @@ def get_secret(secret_name, region_name):
         get_secret_value_response = client.get_secret_value(
             SecretId=secret_name   
         )
-        return get_secret_value_response['SecretString']
+        secrets_cache[secret_name] = get_secret_value_response['SecretString']
+        return secrets_cache[secret_name]
 
     except Exception as e:
         print(e)
         return ""
     
 
+#opensearch clients per host, their connection pools are shared by all the requests of the process
+opensearch_clients = {}
+opensearch_clients_lock = threading.Lock()
+
 #connect to opensearch serverless
 #auth : AWSV4SignerAuth
 #host: <opensearchid>.us-east-1.aoss.amazonaws.com
+#the client of a host is created once, the signer of the first call is kept (the credentials of the session are refreshed by boto3)
 @staticmethod
 def connect_to_aoss(auth, host):
+    with opensearch_clients_lock:
+        if host not in opensearch_clients:
+            opensearch_clients[host] = create_aoss_client(auth, host)
+            if opensearch_clients[host] is None:
+                return opensearch_clients.pop(host)
+        return opensearch_clients[host]
+
+#create an opensearch serverless client
+@staticmethod
+def create_aoss_client(auth, host):
     try:
         # create an opensearch client and use the request-signer
         aoss_client = OpenSearch(
@@ -122,89 +389,371 @@ def connect_to_aoss(auth, host):
         return None 
 
 
+#parse the value passed by the model for a property.
+#it can be a list, a single value or a list serialised as a string e.g. "['Kate', 'Leonardo']"
 @staticmethod
-def standard_query_opensearch(prop_value_list, os_client, index_name, data_columns, k=10):
-
-    # if the model is not passing a list but the element itself, we turn it into a list to comply.
-    if not isinstance(prop_value_list, list):
-        prop_value_list = [prop_value_list]
+def parse_value_list(value):
+    if isinstance(value, list):
+        return value
+
+    if isinstance(value, str):
+        value = value.strip()
+        if value.startswith("["):
+            try:
+                return json.loads(value)
+            except ValueError:
+                #the model tends to use python style single quotes
+                return ast.literal_eval(value)
+
+    return [value]
+
+#range clause bounds of a numeric property from {"gte": .., "lte": ..} (years also accept "1990s", "1990-1999" and [1990, 1999])
+@staticmethod
+def parse_numeric_range(prop, value):
+    if prop == "year":
+        return parse_year_range(value)
+    if not isinstance(value, dict):
+        raise ValueError(f"range of {prop} must be an object, got {value}")
+    return {key: float(value[key]) for key in ["gte", "lte", "gt", "lt"] if key in value}
+
+#build the filter clause(s) for one property according to its type in the index schema.
+#keyword fields -> term/terms, text fields -> match_phrase, numeric fields -> term/terms and range
+@staticmethod
+def _compile_property_filter(prop, values, schema):
+    clauses = []
+    field = prop
+    field_type = schema[prop]
+
+    #exact filters on the keyword subfield when the index has one
+    if prop in exact_match_fields and field_type != "keyword" and schema.get(f"{prop}.keyword") == "keyword":
+        field = f"{prop}.keyword"
+        field_type = "keyword"
+
+    if field_type in numeric_field_types:
+        #a movie has a single value, so the values are alternatives e.g. [1994, 2001] is 1994 or 2001.
+        #only the explicit forms are ranges: {"gte": 1990, "lte": 1999}, "1990s", "1990-1999" or a nested pair [[1990, 1999]]
+        cast = numeric_fields.get(prop, float)
+        exact = []
+        for val in values:
+            if isinstance(val, (dict, list, tuple)) or (prop == "year" and isinstance(val, str) and not val.strip().isdigit()):
+                clauses.append({"range": {field: parse_numeric_range(prop, val)}})
+            elif cast(float(val)) not in exact:
+                exact.append(cast(float(val)))
+
+        if len(exact) == 1:
+            clauses.insert(0, {"term": {field: exact[0]}})
+        elif exact:
+            clauses.insert(0, {"terms": {field: exact}})
+        if len(clauses) > 1:
+            return [{"bool": {"should": clauses, "minimum_should_match": 1}}]
+        return clauses
+
+    values = [str(val) for val in values if str(val).strip() != ""]
+    if not values:
+        return clauses
+
+    #single-valued properties (e.g. director, original_language) match any of the values
+    if prop not in multi_valued_fields:
+        if field_type == "keyword":
+            clauses.append({"terms": {field: values}})
+        elif len(values) == 1:
+            clauses.append({"match_phrase": {field: values[0]}})
+        else:
+            clauses.append({
+                "bool": {
+                    "should": [{"match_phrase": {field: val}} for val in values],
+                    "minimum_should_match": 1
+                }
+            })
+        return clauses
 
-    #building dynamically the opensearch query
+    #multi-valued properties (e.g. actors, genres) must match all the values
+    for val in values:
+        if field_type == "keyword":
+            clauses.append({"term": {field: val}})
+        else:
+            clauses.append({"match_phrase": {field: val}})
+
+    return clauses
+
+#json of the schemas used by compile_standard_query, serialized once per schema object (kept with it so its id is not reused)
+schema_keys = {}
+schema_keys_lock = threading.Lock()
+
+def schema_key(schema):
+    with schema_keys_lock:
+        entry = schema_keys.get(id(schema))
+        if entry is None or entry[0] is not schema:
+            if len(schema_keys) >= 64:
+                schema_keys.clear()
+            entry = (schema, json.dumps(schema, sort_keys=True))
+            schema_keys[id(schema)] = entry
+        return entry[1]
+
+@functools.lru_cache(maxsize=512)
+def _compile_standard_query_cached(cache_key, schema_json):
+    prop_value_list, data_columns, k, sort_field, source = json.loads(cache_key)
+    schema = json.loads(schema_json)
+
+    #non scoring filter context: results are sorted on sort_field so the score is never used
+    #and the filters can be cached by opensearch
     query = {
         "query": {
             "bool": {
-                "must": []
+                "filter": []
             }
         },
         "size": k,
         "sort": [
             {
-                "popularity": {
+                sort_field: {
                     "order": "desc"
                 }
             }
-        ]
+        ],
+        "track_total_hits": False
     }
 
+    if source:
+        query["_source"] = source
+
     for elt in prop_value_list:
         for prop, value in elt.items():
-            #check that the property is valid
-            if prop in data_columns:
-                print(f"prop:{prop}")
-                #This part deals with the fact that prop_value_list can be {"actors":"['Kate', 'Leonardo']"}
-                if isinstance(value, str):
-                    if "[" in value:
-                        #it is a list so converting str to an actual list
-                        value_list = ast.literal_eval(value)
-                    else:
-                        #single value
-                        value_list = [value]
-                        
-                    #injecting the property into the filter
-                    for val in value_list:
-                        query["query"]["bool"]["must"].append({
-                            "match": {
-                                prop: {
-                                    "query": val,
-                                    "operator": "and"
-                                }
-                            }
-                        })
+            #check that the property is valid and exists in the index
+            if prop not in data_columns or prop not in schema:
+                print(f"ignoring unknown property:{prop}")
+                continue
+
+            try:
+                clauses = _compile_property_filter(prop, parse_value_list(value), schema)
+            except (ValueError, SyntaxError, TypeError) as e:
+                print(f"ignoring invalid value for {prop}:{value} ({e})")
+                continue
+
+            query["query"]["bool"]["filter"].extend(clauses)
+
+    return json.dumps(query)
+
+#compile the list of properties/values passed by the model into an opensearch query body (json string).
+#the compiled body is memoized so repeated inputs are not rebuilt.
+#schema: dict property -> opensearch field type, defaults to index_schema
+#source: optional _source filter (see get_source_filter)
+@staticmethod
+def compile_standard_query(prop_value_list, data_columns, k=10, schema=None, sort_field="popularity", source=None):
+
+    # if the model is not passing a list but the element itself, we turn it into a list to comply.
+    if not isinstance(prop_value_list, list):
+        prop_value_list = [prop_value_list]
+
+    cache_key = json.dumps([prop_value_list, list(data_columns), k, sort_field, source], sort_keys=True, default=str)
+
+    return _compile_standard_query_cached(cache_key, schema_key(schema or index_schema))
+
+#request timeout of an opensearch call for the remaining time of the deadline
+@staticmethod
+def search_timeout_params(deadline):
+    if deadline is None:
+        return {}
+    deadline.check("search")
+    return {"request_timeout": deadline.timeout(call_timeouts["search"])}
+
+#projection: projection profile name or list of properties to return (see projection_profiles)
+#hedge: send a duplicate search when the first one is slow (see hedging), default from the HEDGE_REQUESTS environment variable
+@staticmethod
+def standard_query_opensearch(prop_value_list, os_client, index_name, data_columns, k=10, schema=None, projection="full", deadline=None, hedge=None):
+
+    #building the opensearch query from the properties, against the actual schema of the index
+    if schema is None:
+        schema = get_index_schema(os_client, index_name)
+    query = compile_standard_query(prop_value_list, data_columns, k=k, schema=schema, source=get_source_filter(projection, data_columns))
 
     print(f"standard query:{query}")
 
-    search_response = os_client.search(body=query, index=index_name)
+    #the vector_index is excluded from _source so it is not transferred at all
+    #identical concurrent searches are sent once
+    timeout_params = search_timeout_params(deadline)
+    with traffic_capture.stage("search"):
+        search_response = single_flight.call("standard_search", (id(os_client), index_name, query),
+                                             lambda: hedging.call("standard_search", lambda: os_client.search(body=query, index=index_name, **timeout_params), enabled=hedge),
+                                             timeout=timeout_params.get("request_timeout"))
 
-    response = extract_response_from_os_response(search_response)
+    return extract_response_from_os_response(search_response)
 
-    #removing the vector_index as we are not using it in that scenario
-    for elt in response:
-        if "vector_index" in elt:
-            elt.pop("vector_index")
+#size in bytes of the results returned to each consumer, under its payload limit to leave room for the rest of the response:
+#step functions state (256KB), bedrock agent action group response (25KB), lambda response (6MB, e.g. with a result store)
+payload_budgets = {"step_functions": 200 * 1024, "agent": 20 * 1024, "lambda": 5 * 1024 * 1024}
 
-    return response
+#stream the documents of a standard search, in pages of page_size read with search_after on (sort_field desc, tmdb_id asc).
+#a page is requested only when the consumer reads past the previous one, so a consumer that stops early sends no more searches.
+#opensearch serverless has no point in time: the pages are read from the live index, a movie updated between two pages can be
+#missed or returned twice.
+@staticmethod
+def stream_standard_query(prop_value_list, os_client, index_name, data_columns, page_size=100, max_results=None, schema=None, projection="full", deadline=None):
+    if schema is None:
+        schema = get_index_schema(os_client, index_name)
+    query = json.loads(compile_standard_query(prop_value_list, data_columns, k=page_size, schema=schema, source=get_source_filter(projection, data_columns)))
+    #tie breaker of the sort, the movies with the same popularity are not skipped nor repeated between the pages
+    query["sort"].append({"tmdb_id": {"order": "asc"}})
+
+    returned = 0
+    while max_results is None or returned < max_results:
+        if max_results is not None:
+            query["size"] = min(page_size, max_results - returned)
+        timeout_params = search_timeout_params(deadline)
+        with traffic_capture.stage("search"):
+            hits = os_client.search(body=query, index=index_name, **timeout_params)["hits"]["hits"]
+
+        for hit in hits:
+            yield hit["_source"]
+        returned += len(hits)
+        if len(hits) < query["size"]:
+            return
+        query["search_after"] = hits[-1]["sort"]
+
+#read documents from an iterator (e.g. stream_standard_query) while their size fits in max_bytes and there are less than max_items,
+#the iterator is not read further. size_of: size of a document in the response (json by default)
+#returns the documents and True when documents were left out for the size
+def collect_within_limit(documents, max_bytes, max_items=None, size_of=None):
+    size_of = size_of or (lambda doc: len(json.dumps(doc, default=str)))
+    result = []
+    size = 2
+    iterator = iter(documents)
+    try:
+        while max_items is None or len(result) < max_items:
+            doc = next(iterator, None)
+            if doc is None:
+                return result, False
+            #separator between the documents
+            size += size_of(doc) + 2
+            if size > max_bytes:
+                return result, True
+            result.append(doc)
+        return result, False
+    finally:
+        if hasattr(iterator, "close"):
+            iterator.close()
+
+#properties that can be used to filter a semantic (k-NN) search
+knn_filter_fields = ['year', 'genres', 'original_language', 'director', 'actors']
+
+#turn a year constraint into an opensearch range
+#accepted values: 1994, "1994", "1990s", "1990-1999", [1990, 1999], {"gte": 1990, "lte": 1999}
+@staticmethod
+def parse_year_range(value):
+    if isinstance(value, dict):
+        year_range = {}
+        for key, alias in [("gte", "from"), ("lte", "to"), ("gt", None), ("lt", None)]:
+            if key in value:
+                year_range[key] = int(value[key])
+            elif alias and alias in value:
+                year_range[key] = int(value[alias])
+        return year_range
+
+    if isinstance(value, (list, tuple)):
+        if len(value) != 2:
+            raise ValueError(f"year range must have 2 values, got {value}")
+        return {"gte": int(value[0]), "lte": int(value[1])}
+
+    value = str(value).strip()
+
+    #decade e.g. 1990s
+    if value.endswith("s") and value[:-1].isdigit():
+        start = int(value[:-1])
+        return {"gte": start, "lte": start + 9}
+
+    #interval e.g. 1990-1999
+    if "-" in value:
+        start, end = value.split("-", 1)
+        return {"gte": int(start), "lte": int(end)}
+
+    return {"gte": int(value), "lte": int(value)}
+
+#build the list of opensearch filter clauses from a dict of structured constraints
+#e.g. {"year": "1990s", "genres": ["Thriller"], "original_language": "fr"}
+#values of genres and actors must all match, director and original_language match any of the values.
+@staticmethod
+def build_search_filters(filters, schema=None):
+    clauses = []
+
+    if not filters:
+        return clauses
+
+    #the filters come from the model, anything other than an object is ignored and the search runs without filters
+    if not isinstance(filters, dict):
+        print(f"ignoring filters that are not an object:{filters}")
+        return clauses
+
+    if schema is None:
+        schema = index_schema
+
+    for prop, value in filters.items():
+        #ignore properties we can't filter on and empty values
+        if prop not in knn_filter_fields or prop not in schema or value in (None, "", [], {}):
+            print(f"ignoring filter {prop}:{value}")
+            continue
+
+        try:
+            clauses.extend(_compile_property_filter(prop, value if isinstance(value, list) else [value], schema))
+        except (ValueError, TypeError) as e:
+            print(f"ignoring invalid filter {prop}:{value} ({e})")
+
+    return clauses
 
 #query opensearch
+#filters: optional dict of structured constraints, see build_search_filters
+#filter_mode: "efficient" (default) applies the filter during the k-NN search (faiss and lucene engines, see get_movies_index_body),
+#             "post" retrieves k * post_filter_factor neighbours and filters them afterwards (indexes still on the nmslib engine)
+#projection: projection profile name or list of properties to return (see projection_profiles)
+#hedge: send a duplicate embedding call or search when the first one is slow (see hedging), default from the HEDGE_REQUESTS environment variable
 @staticmethod
-def query_opensearch(question, os_client, index_name, data_columns, embedding_model="cohere", k=10):
+def query_opensearch(question, os_client, index_name, data_columns, embedding_model="cohere", k=10, filters=None, filter_mode="efficient", post_filter_factor=5, projection="full", deadline=None, hedge=None):
 
     #get embeddings for the query
-    question_embedding = get_embeddings_from_text(question, embedding_model, input_type="search_query")
+    if deadline is not None:
+        deadline.check("embedding")
+    question_embedding = get_embeddings_from_text(question, embedding_model, input_type="search_query",
+                                                  timeout=deadline.timeout(call_timeouts["embedding"]) if deadline is not None else None, hedge=hedge)
+    if question_embedding is None and deadline is not None and not deadline.has_time(timeout_buckets[0]):
+        raise DeadlineExceeded("deadline exceeded during embedding")
+
+    knn_query = {
+        "vector": question_embedding,
+        "k": k
+    }
 
     query = {
         "size": k,
         "query": {
             "knn": {
-            "vector_index": {
-                "vector": question_embedding,
-                "k": k
-            }
+            "vector_index": knn_query
             }
         },
-        "_source": data_columns
+        "_source": get_source_filter(projection, data_columns)
     }
 
-    response = os_client.search(body=query, index=index_name)
+    filter_clauses = build_search_filters(filters, schema=get_index_schema(os_client, index_name)) if filters else []
+
+    if filter_clauses:
+        if filter_mode == "efficient":
+            knn_query["filter"] = {"bool": {"filter": filter_clauses}}
+        elif filter_mode == "post":
+            #oversampling the neighbours so that we still have k results once filtered
+            knn_query["k"] = k * post_filter_factor
+            query["query"] = {
+                "bool": {
+                    "must": [{"knn": {"vector_index": knn_query}}],
+                    "filter": filter_clauses
+                }
+            }
+        else:
+            raise ValueError(f"unknown filter_mode {filter_mode}, use efficient or post")
+
+    #identical concurrent searches are sent once
+    timeout_params = search_timeout_params(deadline)
+    with traffic_capture.stage("search"):
+        response = single_flight.call("semantic_search", (id(os_client), index_name, json.dumps(query, sort_keys=True)),
+                                      lambda: hedging.call("semantic_search", lambda: os_client.search(body=query, index=index_name, **timeout_params), enabled=hedge),
+                                      timeout=timeout_params.get("request_timeout"))
 
     return response
 
@@ -219,7 +768,9 @@ def invoke_anthropic_claude(prompt,
                             top_p=0.999,
                             modelId="anthropic.claude-3-sonnet-20240229-v1:0",
                             anthropic_version="bedrock-2023-05-31",
-                            debug=False):
+                            debug=False,
+                            timeout=None,
+                            usage=None):
     try:
         if debug:
             print("invoke_anthropic_claude function config:")
@@ -239,10 +790,8 @@ def invoke_anthropic_claude(prompt,
             'system': system_prompt
             }))
 
-        bedrock_client = boto3.client('bedrock-runtime')
-        response = bedrock_client.invoke_model(
-            modelId=modelId,
-            body=json.dumps({
+        bedrock_client = get_bedrock_client(timeout)
+        body = json.dumps({
             'anthropic_version': anthropic_version, 
             'max_tokens': max_tokens,
             'temperature': temperature,
@@ -257,24 +806,64 @@ def invoke_anthropic_claude(prompt,
             }],
             'system': system_prompt
             })
-        )
-        result = json.loads(response['body'].read())
-        to_return = result['content'][0]['text']
+
+        def invoke():
+            rate_limit.acquire(modelId)
+            response = bedrock_client.invoke_model(
+                modelId=modelId,
+                body=body
+            )
+            result = json.loads(response['body'].read())
+            return result['content'][0]['text'], result.get('usage', {})
+
+        #deterministic calls (temperature 0) with the same prompt are sent once when they run at the same time
+        with traffic_capture.stage("llm"):
+            to_return, call_usage = single_flight.call("llm", (modelId, body), invoke, enabled=None if temperature == 0 else False, timeout=timeout)
+        #usage: optional dict filled with the input_tokens and output_tokens of the call
+        if usage is not None:
+            usage.update(call_usage)
         return to_return
     except Exception as e:
         print(e)
 
+#embeddings of the last texts per (model id, body), shared by the requests of the process (EMBEDDING_CACHE_SIZE, 0 to disable).
+#the embeddings can be prefetched before they are needed, e.g. while the question is routed.
+#the cache keeps its own copy and each caller gets a copy, as with single_flight.
+embedding_cache = collections.OrderedDict()
+embedding_cache_size = int(os.environ.get("EMBEDDING_CACHE_SIZE", "1024"))
+embedding_cache_lock = threading.Lock()
+
 #invoke model function
+#hedge: send a duplicate call when the first one is slow (see hedging), default from the HEDGE_REQUESTS environment variable
 @staticmethod
-def invoke_embeddings_model(body, modelId):
+def invoke_embeddings_model(body, modelId, timeout=None, hedge=None):
     try:
-        bedrock_client = boto3.client('bedrock-runtime')
-        response = bedrock_client.invoke_model( body=body, 
-                                               modelId=modelId, 
-                                               accept="application/json", 
-                                               contentType="application/json"
-        )
-        return json.loads(response['body'].read().decode('utf8'))
+        with embedding_cache_lock:
+            if (modelId, body) in embedding_cache:
+                embedding_cache.move_to_end((modelId, body))
+                return copy.deepcopy(embedding_cache[(modelId, body)])
+
+        bedrock_client = get_bedrock_client(timeout)
+
+        def invoke():
+            rate_limit.acquire(modelId)
+            response = bedrock_client.invoke_model( body=body, 
+                                                   modelId=modelId, 
+                                                   accept="application/json", 
+                                                   contentType="application/json"
+            )
+            return json.loads(response['body'].read().decode('utf8'))
+
+        #identical concurrent embedding calls are sent once
+        with traffic_capture.stage("embedding"):
+            result = single_flight.call("embedding", (modelId, body), lambda: hedging.call("embedding", invoke, enabled=hedge), timeout=timeout)
+
+        if embedding_cache_size > 0:
+            with embedding_cache_lock:
+                embedding_cache[(modelId, body)] = copy.deepcopy(result)
+                while len(embedding_cache) > embedding_cache_size:
+                    embedding_cache.popitem(last=False)
+        return result
     except Exception as e:
         print(e)
         return None
@@ -282,12 +871,12 @@ def invoke_embeddings_model(body, modelId):
 #generic function to retrieve embeddings from either titan or cohere in Bedrock
 #input_type is required for Cohere models and needs to be one of those options ["search_document","search_query","classification","clustering"]
 @staticmethod
-def get_embeddings_from_text(text:str, model:str, input_type="search_document"):
+def get_embeddings_from_text(text:str, model:str, input_type="search_document", timeout=None, hedge=None):
     try:
         if model.lower() == "titan":
             modelId = "amazon.titan-embed-text-v1"
             body = json.dumps({ "inputText": text})
-            vector_json = invoke_embeddings_model(body, modelId)
+            vector_json = invoke_embeddings_model(body, modelId, timeout=timeout, hedge=hedge)
             return vector_json['embedding']
         
         elif model.lower() == "cohere":
@@ -301,7 +890,7 @@ def get_embeddings_from_text(text:str, model:str, input_type="search_document"):
                 "texts": [text],
                 "input_type": input_type}
             )
-            vector_json = invoke_embeddings_model(body, modelId)
+            vector_json = invoke_embeddings_model(body, modelId, timeout=timeout, hedge=hedge)
             return vector_json['embeddings'][0]
         else:
             print("Model not recognized. Please use Titan or Cohere.")
@@ -343,29 +932,81 @@ class PromptTemplate:
     #list of input variables. e.g. ["context", "question"]
     input_variables = []
 
-    #constructor
+    #constructor, the template is parsed once into literal and placeholder segments
     def __init__(self, input_variables, template, system_prompt="", prefill=""):
         self.input_variables = input_variables
         self.template = template
         self.system_prompt = system_prompt
         self.prefill = prefill
-
-    #function replacing strings defined in input_variables by what is in kwargs
+        self.segments, self.static_prefix = self._compile(template, input_variables)
+        self.static_tokens = estimate_tokens("".join(segment for is_variable, segment in self.segments if not is_variable) + "\n" + prefill)
+
+    #split the template on the {variable} placeholders, other braces (e.g. json examples) are kept as literals
+    @staticmethod
+    def _compile(template, input_variables):
+        placeholders = set(re.findall(r"\{(\w+)\}", template))
+        missing = [var for var in input_variables if var not in placeholders]
+        if missing:
+            raise ValueError(f"input variables {missing} are not in the template")
+
+        #placeholders looking like variables but not declared are most likely a mistake
+        undeclared = sorted(var for var in placeholders if var not in input_variables and not var.isdigit())
+        if undeclared:
+            raise ValueError(f"template placeholders {undeclared} are not declared in input_variables")
+
+        segments = []
+        if input_variables:
+            pattern = re.compile("|".join(re.escape("{" + var + "}") for var in input_variables))
+            position = 0
+            for match in pattern.finditer(template):
+                if match.start() > position:
+                    segments.append((False, template[position:match.start()]))
+                segments.append((True, match.group(0)[1:-1]))
+                position = match.end()
+            if position < len(template):
+                segments.append((False, template[position:]))
+        elif template:
+            segments.append((False, template))
+
+        #text before the first variable, identical for every rendering
+        static_prefix = ""
+        if segments and not segments[0][0]:
+            static_prefix = segments[0][1]
+        return segments, static_prefix
+
+    #check that the values are exactly the input variables, ValueError for a missing or an undeclared variable
+    def validate(self, **kwargs):
+        missing = [var for var in self.input_variables if var not in kwargs]
+        if missing:
+            raise ValueError(f"missing values for the input variables {missing}")
+        undeclared = sorted(var for var in kwargs if var not in self.input_variables)
+        if undeclared:
+            raise ValueError(f"values given for {undeclared}, which are not input variables of the template")
+
+    #function replacing strings defined in input_variables by what is in kwargs, in a single pass
+    #raises ValueError if a value is missing or given for a variable that is not declared (see validate)
     def format_prompt(self, **kwargs):
-        try:
-            prompt = self.template
-
-            #substitute variables
-            for var in self.input_variables:
-                to_replace = "{" + var + "}"
-                replace_by = str(kwargs[var])
-                prompt = prompt.replace(to_replace, replace_by)
-            
-            #add prefill
-            prompt = prompt + "\n" + self.prefill
-            return prompt
-        except Exception as e:
-            self.logger.error(e)
+        self.validate(**kwargs)
+        values = {var: str(kwargs[var]) for var in self.input_variables}
+        prompt = "".join([values[segment] if is_variable else segment for is_variable, segment in self.segments])
+
+        #add prefill
+        return prompt + "\n" + self.prefill
+
+    #format_prompt with the values of the declared variables only, for callers giving the same values to templates
+    #that do not all use them (e.g. the chat history in the prompts of ConversationalRetrievalChain).
+    #raises ValueError if a declared variable has no value
+    def format_prompt_ignoring_extra(self, **kwargs):
+        return self.format_prompt(**{var: value for var, value in kwargs.items() if var in self.input_variables})
+
+    #static text at the beginning of every prompt
+    def get_static_prefix(self):
+        return self.static_prefix
+
+    #estimated number of tokens of the prompt for these values (system prompt included), without rendering it
+    def estimate_tokens(self, **kwargs):
+        self.validate(**kwargs)
+        return self.static_tokens + estimate_tokens(self.system_prompt) + sum(estimate_tokens(str(kwargs[segment])) for is_variable, segment in self.segments if is_variable)
     
     def get_prompt(self):
         return self.template
@@ -383,36 +1024,161 @@ class PromptTemplate:
 #simple class to create a buffer memory to store the conversation
 class BufferMemory:
 
-    memory = []
     size = 0
-
-    def __init__(self, size=5) -> None:
-        self.size = size 
+    max_tokens = None
+
+    #size: maximum number of exchanges, max_tokens: maximum estimated tokens of the exchanges (None for no limit)
+    def __init__(self, size=5, max_tokens=None) -> None:
+        self.size = size
+        self.max_tokens = max_tokens
+        #ring buffer of (exchange, tokens), one per instance
+        self.memory = collections.deque()
+        self.tokens = 0
+        #formatted text of the memory, built once per change
+        self.formatted_memory = None
+        self.last_access = time.time()
     
     #get memory
     def get_memory(self):
-        return self.memory
+        return [exchange for exchange, _ in self.memory]
     
     #reset memory
     def reset_memory(self):
-        self.memory = []
+        self.memory.clear()
+        self.tokens = 0
+        self.formatted_memory = None
 
     #add to memory
     def add_to_memory(self, question, answer):
         if self.size > 0:
-            if len(self.memory) >= self.size:
-                self.memory.pop(0) #remove the first element of the list (oldest element)
+            exchange = {"question": question, "answer": answer}
+            tokens = estimate_tokens(f"{question}{answer}")
 
             #add the new element to the list (newest element)
-            self.memory.append({"question": question, "answer": answer})
+            self.memory.append((exchange, tokens))
+            self.tokens += tokens
+
+            #remove the oldest elements over the number of exchanges or the token budget, the newest exchange is always kept
+            while len(self.memory) > 1 and (len(self.memory) > self.size or (self.max_tokens is not None and self.tokens > self.max_tokens)):
+                _, removed_tokens = self.memory.popleft()
+                self.tokens -= removed_tokens
+
+            self.formatted_memory = None
+        self.last_access = time.time()
 
     #format memory in text form to include at the beginning of the prompt
     def format_memory_for_prompt(self):
-        result = []
-        for index, value in enumerate(self.memory):
-            result.append(f"Question {index+1}: {value['question']}\n")
-            result.append(f"Answer {index+1}: {value['answer']}\n")
-        return "".join(result)
+        self.last_access = time.time()
+        if self.formatted_memory is None:
+            result = []
+            for index, (value, _) in enumerate(self.memory):
+                result.append(f"Question {index+1}: {value['question']}\n")
+                result.append(f"Answer {index+1}: {value['answer']}\n")
+            self.formatted_memory = "".join(result)
+        return self.formatted_memory
+
+#memory of several conversations: one BufferMemory per session id, the least recently used and the idle sessions are evicted
+class SessionMemoryManager:
+
+    def __init__(self, max_sessions=1000, size=20, max_tokens=2000, idle_timeout=1800) -> None:
+        self.max_sessions = max_sessions
+        self.size = size
+        self.max_tokens = max_tokens
+        self.idle_timeout = idle_timeout
+        self.sessions = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    #memory of a session, created if needed
+    def get_session_memory(self, session_id):
+        with self.lock:
+            memory = self.sessions.get(session_id)
+            if memory is None:
+                memory = BufferMemory(size=self.size, max_tokens=self.max_tokens)
+                self.sessions[session_id] = memory
+            else:
+                self.sessions.move_to_end(session_id)
+            memory.last_access = time.time()
+
+            self._evict()
+            return memory
+
+    #remove a session
+    def reset_session(self, session_id):
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+    #remove the sessions idle for more than idle_timeout seconds
+    def evict_idle_sessions(self):
+        with self.lock:
+            self._evict()
+
+    def _evict(self):
+        #sessions are ordered from the least to the most recently used
+        limit = time.time() - self.idle_timeout
+        while self.sessions:
+            session_id, memory = next(iter(self.sessions.items()))
+            if len(self.sessions) > self.max_sessions or memory.last_access < limit:
+                self.sessions.popitem(last=False)
+            else:
+                break
+
+#stages of the ConversationalRetrievalChain: retrieval decision (yes/no), query rewrite and final answer
+chain_stages = ["decision", "rewrite", "answer"]
+
+#settings of each stage of the chain, the unset values are the model of the chain and the arguments of run:
+#  model: model id of the stage
+#  models + latency_budget_ms: latency budget mode, the first model (preferred first) whose recent latency on the stage fits in the budget
+#  max_tokens, temperature, top_k, top_p: generation settings of the stage
+#the decision and the rewrite are short outputs: a small model and a few tokens are enough
+tiered_chain_stages = {
+    "decision": {"model": "anthropic.claude-3-haiku-20240307-v1:0", "max_tokens": 64},
+    "rewrite": {"model": "anthropic.claude-3-haiku-20240307-v1:0", "max_tokens": 256},
+    "answer": {"models": ["anthropic.claude-3-sonnet-20240229-v1:0", "anthropic.claude-3-haiku-20240307-v1:0"], "latency_budget_ms": 8000},
+}
+
+#percentile of the recent latencies compared to the budget, calls before a model is trusted, share of the calls sent to the
+#preferred model while it is over budget (to notice when it is fast again)
+stage_latency_percentile = 90
+stage_min_samples = 5
+stage_probe_ratio = 0.05
+
+#recent latencies of each (stage, model) of the chains of the process
+stage_trackers = {}
+stage_trackers_lock = threading.Lock()
+
+def get_stage_tracker(stage, model):
+    with stage_trackers_lock:
+        if (stage, model) not in stage_trackers:
+            stage_trackers[(stage, model)] = hedging.LatencyTracker()
+        return stage_trackers[(stage, model)]
+
+#model of a stage: the model of the stage settings, or in latency budget mode the first model whose latency percentile fits in
+#the budget (capped by the remaining time of the deadline), the fastest one when none fits
+def select_stage_model(stage, settings, default_model, deadline=None):
+    models = settings.get("models") or [settings.get("model") or default_model]
+    if len(models) == 1 or settings.get("latency_budget_ms") is None:
+        return models[0]
+
+    budget = settings["latency_budget_ms"] / 1000
+    if deadline is not None:
+        budget = min(budget, deadline.remaining())
+
+    observed = []
+    for model in models:
+        tracker = get_stage_tracker(stage, model)
+        if tracker.count() < stage_min_samples:
+            return model
+        latency = tracker.percentile(stage_latency_percentile)
+        if latency <= budget:
+            if model != models[0] and random.random() < stage_probe_ratio:
+                return models[0]
+            return model
+        observed.append((latency, model))
+    return min(observed)[1]
+
+
+#response of the chain when the answer could not be generated (e.g. the LLM call timed out)
+answer_fallback_response = "Sorry, I could not answer your question in time. Please try again."
 
 #simple class storing all information needed to handle a conversation
 class ConversationalRetrievalChain:
@@ -432,9 +1198,12 @@ class ConversationalRetrievalChain:
     main_prompt = None
     decision_prompt = None 
     retrieval_optimisation_prompt = None
+    context_builder = None
+    stages = {}
 
-    #constructor
-    def __init__(self, os_client, index_name, data_columns, main_prompt, decision_prompt, retrieval_optimisation_prompt, model="anthropic.claude-3-sonnet-20240229-v1:0", memory=None):
+    #constructor, memory is a BufferMemory for a single conversation or a SessionMemoryManager to serve several sessions
+    #stages: optional settings per stage ("decision", "rewrite", "answer"), e.g. tiered_chain_stages, all the stages run on model otherwise
+    def __init__(self, os_client, index_name, data_columns, main_prompt, decision_prompt, retrieval_optimisation_prompt, model="anthropic.claude-3-sonnet-20240229-v1:0", memory=None, builder=None, stages=None):
         self.os_client = os_client
         self.index_name = index_name
         self.model = model
@@ -444,23 +1213,21 @@ class ConversationalRetrievalChain:
         self.main_prompt = main_prompt
         self.decision_prompt = decision_prompt
         self.retrieval_optimisation_prompt = retrieval_optimisation_prompt
+        #builds the context from the retrieved documents within a token budget
+        self.context_builder = builder or context_builder.ContextBuilder(route="chain")
+        self.stages = stages or {}
 
     
-    #format the output list as a well formed text
+    #format the output list as a compact text, returns the text and the compression statistics
     def format_opensearch_response_for_llm(self, _dict):
-        result = []
-        for index, value in enumerate(_dict["hits"]["hits"]):
-            result.append("<document>\n")
-            for key, value in value["_source"].items():
-                result.append(f"{key}: {value}\n")
-            result.append("</document>\n")
-        return result
+        return self.context_builder.build([hit["_source"] for hit in _dict["hits"]["hits"]])
 
     #query opensearch
-    def query_opensearch(self, question, embedding_model="cohere", k=10):
+    def query_opensearch(self, question, embedding_model="cohere", k=10, deadline=None):
 
         #get embeddings for the query
-        question_embedding = get_embeddings_from_text(question, embedding_model, input_type="search_query")
+        question_embedding = get_embeddings_from_text(question, embedding_model, input_type="search_query",
+                                                      timeout=deadline.timeout(call_timeouts["embedding"]) if deadline is not None else None)
 
         query = {
             "size": k,
@@ -472,34 +1239,101 @@ class ConversationalRetrievalChain:
                 }
                 }
             },
-            "_source": self.data_columns
+            "_source": get_source_filter(self.data_columns, self.data_columns)
         }
 
-        return self.os_client.search(body=query, index=self.index_name)
+        timeout_params = search_timeout_params(deadline)
+        with traffic_capture.stage("search"):
+            return single_flight.call("semantic_search", (id(self.os_client), self.index_name, json.dumps(query, sort_keys=True)),
+                                      lambda: hedging.call("semantic_search", lambda: self.os_client.search(body=query, index=self.index_name, **timeout_params)),
+                                      timeout=timeout_params.get("request_timeout"))
     
-    def run(self, question, k=10, verbose=False, max_tokens=1024, temperature=0.9, top_k=250, top_p=0.999):
+    #memory of the conversation: the session memory when the chain is given a SessionMemoryManager
+    def get_memory(self, session_id=None):
+        if isinstance(self.memory, SessionMemoryManager):
+            return self.memory.get_session_memory(session_id)
+        return self.memory
+
+    #call the LLM for a stage on the model selected for the stage, settings are the arguments of run for the stage (overridden by the
+    #stage settings of the chain). The model, latency and tokens of the call are appended to timings.
+    def invoke_stage(self, stage, prompt, system_prompt, settings, timings, deadline=None, timeout=None):
+        settings = {**settings, **self.stages.get(stage, {})}
+        model = select_stage_model(stage, settings, self.model, deadline)
+        usage = {}
+        start = time.time()
+        response = invoke_anthropic_claude(prompt,
+                            system_prompt=system_prompt,
+                            max_tokens=settings["max_tokens"],
+                            temperature=settings["temperature"],
+                            top_k=settings["top_k"],
+                            top_p=settings["top_p"],
+                            modelId=model,
+                            debug=False,
+                            timeout=timeout,
+                            usage=usage)
+        latency = time.time() - start
+        #failed calls (e.g. timeout) are not recorded, their latency is the timeout
+        if response is not None:
+            get_stage_tracker(stage, model).record(latency)
+        timings.append({"stage": stage, "model": model, "latency": latency, "max_tokens": settings["max_tokens"],
+                        "input_tokens": usage.get("input_tokens", 0), "output_tokens": usage.get("output_tokens", 0)})
+        return response
+
+    #latency and tokens of the stages of a run, with the estimated savings against running every stage on the model of the chain:
+    #the latency saved is the median latency of the chain model on the stage minus the latency of the call (when the chain model
+    #has recent calls on the stage), the max tokens saved the difference with the max_tokens of run
+    def log_timings(self, timings, max_tokens):
+        latency_saved = 0.0
+        for timing in timings:
+            saved = ""
+            if timing["model"] != self.model:
+                baseline = get_stage_tracker(timing["stage"], self.model).percentile(50)
+                if baseline is not None:
+                    latency_saved += baseline - timing["latency"]
+                    saved = f", {baseline - timing['latency']:.3f}s saved"
+            self.logger.info(f"{timing['stage']}: {timing['model']} {timing['latency']:.3f}s{saved}, "
+                             f"{timing['input_tokens']} input tokens, {timing['output_tokens']}/{timing['max_tokens']} output tokens")
+        self.logger.info(f"LLM calls: {sum(timing['latency'] for timing in timings):.3f}s, "
+                         f"{sum(timing['input_tokens'] for timing in timings)} input tokens, {sum(timing['output_tokens'] for timing in timings)} output tokens, "
+                         f"estimated {latency_saved:.3f}s and {sum(max_tokens - timing['max_tokens'] for timing in timings)} max tokens saved by the stage models")
+
+    #deadline: optional Deadline, the LLM and search calls are limited to the remaining time and the optional steps skipped when it runs low
+    @profiling.profile("chain")
+    def run(self, question, k=10, verbose=False, max_tokens=1024, temperature=0.9, top_k=250, top_p=0.999, session_id=None, deadline=None):
         
+        #timeout of the LLM calls
+        def llm_timeout():
+            return deadline.timeout(call_timeouts["llm"]) if deadline is not None else None
+
+        #the chat history is formatted once and shared by the 3 LLM calls
+        memory = self.get_memory(session_id)
+        chat_history = ""
+        if memory is not None:
+            chat_history = memory.format_memory_for_prompt()
+
+        #model, latency and tokens of each LLM call
+        timings = []
+
 
         #----------------------------------------------------------------------------------------------------------------------------
-        start = time.time()
-        llm_decision_question = invoke_anthropic_claude(self.decision_prompt.format_prompt(question=question, memory=self.memory.format_memory_for_prompt()), 
-                            system_prompt=self.decision_prompt.get_system_prompt(),
-                            max_tokens=max_tokens, 
-                            temperature=0.0, 
-                            top_k=250, 
-                            top_p=0.999,
-                            modelId=self.model,
-                            debug=False)
-        end = time.time()
+        #the prompts may leave out the history (memory, chat_history), a ValueError is raised if they declare other variables
+        llm_decision_question = self.invoke_stage("decision", self.decision_prompt.format_prompt_ignoring_extra(question=question, memory=chat_history),
+                            self.decision_prompt.get_system_prompt(),
+                            {"max_tokens": max_tokens, "temperature": 0.0, "top_k": 250, "top_p": 0.999},
+                            timings, deadline=deadline, timeout=llm_timeout())
 
         #managing prefill if prefill is used.s
-        if not self.decision_prompt.is_prefill_empty():
+        if llm_decision_question is not None and not self.decision_prompt.is_prefill_empty():
             llm_decision_question = self.decision_prompt.get_prefill() + llm_decision_question
 
-        #get response from response tags
-        retrieval_required = return_response_from_tag(llm_decision_question)
+        #get response from response tags, documents are retrieved when the decision failed (e.g. timeout)
+        retrieval_required = return_response_from_tag(llm_decision_question) if llm_decision_question is not None else None
+        if retrieval_required is None:
+            retrieval_required = "yes"
+            if deadline is not None:
+                deadline.record_fallback("retrieval_decision_failed", route="chain")
         if verbose:
-            self.logger.info(f"Execution time 1st LLM call: {end - start}")
+            self.logger.info(f"Execution time 1st LLM call: {timings[-1]['latency']} ({timings[-1]['model']})")
             self.logger.info(f"is retrieval needed (yes/no)? -> {retrieval_required}")      
 
         #----------------------------------------------------------------------------------------------------------------------------
@@ -509,44 +1343,42 @@ class ConversationalRetrievalChain:
         if retrieval_required.lower() == "yes":
 
             # we had the memory as context for the model to optimise the query
-            start = time.time()
-            llm_optim_response = invoke_anthropic_claude(self.retrieval_optimisation_prompt.format_prompt(question=question, memory=self.memory.format_memory_for_prompt()), 
-                                system_prompt=self.retrieval_optimisation_prompt.get_system_prompt(),
-                                max_tokens=max_tokens, 
-                                temperature=0.5, 
-                                top_k=250, 
-                                top_p=0.999,
-                                modelId=self.model,
-                                debug=False)
-            end = time.time()
+            #the query optimisation is skipped when the time runs low, the question is searched as it is
+            llm_optim_response = None
+            if deadline is None or deadline.has_time(min_time["query_optimisation"]):
+                llm_optim_response = self.invoke_stage("rewrite", self.retrieval_optimisation_prompt.format_prompt_ignoring_extra(question=question, memory=chat_history),
+                                    self.retrieval_optimisation_prompt.get_system_prompt(),
+                                    {"max_tokens": max_tokens, "temperature": 0.5, "top_k": 250, "top_p": 0.999},
+                                    timings, deadline=deadline, timeout=llm_timeout())
+
+            if llm_optim_response is None:
+                llm_optim_response = question
+                if deadline is not None:
+                    deadline.record_fallback("skip_query_optimisation", route="chain")
 
             #managing prefill if prefill is used.s
-            if not self.retrieval_optimisation_prompt.is_prefill_empty():
+            elif not self.retrieval_optimisation_prompt.is_prefill_empty():
                 llm_optim_response = self.retrieval_optimisation_prompt.get_prefill() + llm_optim_response
 
             llm_optim_response_cleanup = return_response_from_tag(llm_optim_response)
             if verbose:
-                self.logger.info(f"Execution time 2nd LLM call: {end - start}")
+                self.logger.info(f"Execution time 2nd LLM call: {timings[-1]['latency'] if timings[-1]['stage'] == 'rewrite' else 'skipped'}")
                 self.logger.info(f"original question:{question}")
                 self.logger.info(f"optimised question:{llm_optim_response_cleanup}\n")
             
             #----------------------------------------------------------------------------------------------------------------------------
             #retrieve documents from opensearch
-            os_response = self.query_opensearch(llm_optim_response, embedding_model="cohere", k=k)
+            os_response = self.query_opensearch(llm_optim_response, embedding_model="cohere", k=k, deadline=deadline)
 
             #format the response into text to include in the context.
-            os_text_response = self.format_opensearch_response_for_llm(os_response)
-            context = "".join(os_text_response)
+            context, context_stats = self.format_opensearch_response_for_llm(os_response)
+            if verbose:
+                self.logger.info(f"context: {context_stats['documents_kept']}/{context_stats['documents']} documents, {context_stats['context_tokens']} tokens, {context_stats['tokens_saved']} tokens saved")
             #----------------------------------------------------------------------------------------------------------------------------
         
-        #set chat history
-        chat_history = ""
-        if self.memory is None:
-            chat_history = self.memory.format_memory_for_prompt()
-           
         #----------------------------------------------------------------------------------------------------------------------------
         #build the last prompt
-        full_prompt = self.main_prompt.format_prompt(context=context, question=question, chat_history=chat_history)
+        full_prompt = self.main_prompt.format_prompt_ignoring_extra(context=context, question=question, chat_history=chat_history)
 
         if verbose:
             self.logger.info("---------------------Full prompt---------------------------------")
@@ -554,17 +1386,19 @@ class ConversationalRetrievalChain:
             self.logger.info("-----------------------------------------------------------------")
 
         #call llm
-        start = time.time()
-        llm_response = invoke_anthropic_claude(full_prompt,
-                            system_prompt=self.main_prompt.get_system_prompt(),
-                            max_tokens=max_tokens, 
-                            temperature=temperature, 
-                            top_k=top_k, 
-                            top_p=top_p,
-                            modelId=self.model,
-                            anthropic_version="bedrock-2023-05-31", 
-                            debug=False)
-        end = time.time()
+        llm_response = self.invoke_stage("answer", full_prompt,
+                            self.main_prompt.get_system_prompt(),
+                            {"max_tokens": max_tokens, "temperature": temperature, "top_k": top_k, "top_p": top_p},
+                            timings, deadline=deadline, timeout=llm_timeout())
+
+        #the answer failed (e.g. timeout): a fallback response is returned and the exchange is not added to the memory
+        if llm_response is None:
+            if deadline is not None:
+                deadline.record_fallback("answer_failed", route="chain")
+            if verbose:
+                self.logger.info(f"Execution time 3rd LLM call: {timings[-1]['latency']} ({timings[-1]['model']}), no answer")
+                self.log_timings(timings, max_tokens)
+            return answer_fallback_response
 
          #managing prefill if prefill is used.
         if not self.main_prompt.is_prefill_empty():
@@ -574,11 +1408,12 @@ class ConversationalRetrievalChain:
 
         if verbose:
             self.logger.info(f"RAW Response from LLM: {response}")
-            self.logger.info(f"Execution time 3rd LLM call: {end - start}")
+            self.logger.info(f"Execution time 3rd LLM call: {timings[-1]['latency']} ({timings[-1]['model']})")
+            self.log_timings(timings, max_tokens)
         
         #update memory
-        if self.memory is None:
-            self.memory.add_to_memory(question, return_response_from_tag(llm_response))
+        if memory is not None:
+            memory.add_to_memory(question, response)
         
         return response
 
@@ -0,0 +1,200 @@
+import json
+import re
+import threading
+import time
+
+try:
+    from utils import llm_utils
+    from utils import metrics
+except ImportError:
+    import llm_utils
+    import metrics
+
+#In-process inverted index of the movies, a backend of the standard search for catalogs that fit in memory.
+#The query compiled by llm_utils.compile_standard_query is evaluated locally, with the same semantics as the index:
+#  keyword fields: term -> bitset of the movies (python int, bit i = row i), lowercase as the lowercase normalizer
+#  text fields: token -> bitset, intersected then checked for the phrase (match_phrase) within a single value
+#  numeric fields: columns scanned for ranges and terms, one bitset per year
+#The rows are ordered by popularity (descending) so the top k of the default sort are the k lowest bits of the result.
+
+#keyword fields without the lowercase normalizer
+case_sensitive_fields = ["popularity_bins", "vote_average_bins"]
+
+#text fields indexed for match_phrase
+text_fields = ["original_title", "genres", "keywords", "director", "actors"]
+
+
+#tokens of a text, close to the standard analyzer of opensearch
+def tokenize(text):
+    return re.findall(r"\w+(?:'\w+)*", str(text).lower())
+
+def values_of(doc, prop):
+    value = doc.get(prop)
+    if value is None or value == "" or value == []:
+        return []
+    if prop in llm_utils.multi_valued_fields or prop == "director":
+        return llm_utils.split_list_value(value)
+    return [value]
+
+#rows of a bitset, lowest first
+def iter_rows(bitset):
+    while bitset:
+        low = bitset & -bitset
+        yield low.bit_length() - 1
+        bitset ^= low
+
+
+class LocalIndex:
+
+    #documents: typed documents (see llm_utils.to_typed_document)
+    def __init__(self, documents, sort_field="popularity") -> None:
+        docs = [{column: doc.get(column) for column in llm_utils.projection_profiles["full"]} for doc in documents]
+        docs = llm_utils.sort_by_value(docs, lambda doc: doc.get(sort_field))
+        self.documents = docs
+        self.sort_field = sort_field
+        self.all_rows = (1 << len(docs)) - 1
+
+        self.keywords = {}
+        self.tokens = {}
+        self.phrases = {}
+        self.years = {}
+        self.columns = {prop: [doc.get(prop) for doc in docs] for prop in llm_utils.numeric_fields}
+
+        for row, doc in enumerate(docs):
+            bit = 1 << row
+            for prop in llm_utils.exact_match_fields:
+                for value in values_of(doc, prop):
+                    key = str(value) if prop in case_sensitive_fields else str(value).lower()
+                    self.keywords[(prop, key)] = self.keywords.get((prop, key), 0) | bit
+            for prop in text_fields:
+                #the values are kept tokenized to check the phrases, "|" separates the values of an array
+                token_lists = [tokenize(value) for value in values_of(doc, prop)]
+                self.phrases.setdefault(prop, []).append("|" + "|".join(f" {' '.join(tokens)} " for tokens in token_lists) + "|")
+                for token in set(token for tokens in token_lists for token in tokens):
+                    self.tokens[(prop, token)] = self.tokens.get((prop, token), 0) | bit
+            if doc.get("year") is not None:
+                self.years[doc["year"]] = self.years.get(doc["year"], 0) | bit
+
+    def __len__(self):
+        return len(self.documents)
+
+    def keyword_bits(self, prop, value):
+        key = str(value) if prop in case_sensitive_fields else str(value).lower()
+        return self.keywords.get((prop, key), 0)
+
+    #movies with the phrase in one of the values of the text field
+    def phrase_bits(self, prop, text):
+        tokens = tokenize(text)
+        if not tokens:
+            return self.all_rows
+        bits = self.all_rows
+        for token in tokens:
+            bits &= self.tokens.get((prop, token), 0)
+            if not bits:
+                return 0
+        if len(tokens) == 1:
+            return bits
+
+        phrase = f" {' '.join(tokens)} "
+        result = 0
+        for row in iter_rows(bits):
+            if phrase in self.phrases[prop][row]:
+                result |= 1 << row
+        return result
+
+    #movies of a numeric range or term
+    def numeric_bits(self, prop, check):
+        if prop == "year":
+            bits = 0
+            for year, year_bits in self.years.items():
+                if check(year):
+                    bits |= year_bits
+            return bits
+        bits = 0
+        for row, value in enumerate(self.columns[prop]):
+            if value is not None and check(value):
+                bits |= 1 << row
+        return bits
+
+    #movies of a filter clause of the compiled query, ValueError for a clause the local index does not support
+    def clause_bits(self, clause):
+        kind, body = next(iter(clause.items()))
+        if kind == "bool":
+            bits = 0
+            for should in body.get("should", []):
+                bits |= self.clause_bits(should)
+            return bits
+
+        field, value = next(iter(body.items()))
+        prop = field.split(".")[0]
+
+        if kind == "range":
+            bounds = {
+                "gte": lambda x, v: x >= v, "lte": lambda x, v: x <= v,
+                "gt": lambda x, v: x > v, "lt": lambda x, v: x < v,
+            }
+            return self.numeric_bits(prop, lambda x: all(bounds[op](x, v) for op, v in value.items()))
+
+        if kind == "term" and prop in llm_utils.numeric_fields:
+            return self.numeric_bits(prop, lambda x: x == value)
+        if kind == "term":
+            return self.keyword_bits(prop, value)
+        if kind == "terms" and prop in llm_utils.numeric_fields:
+            values = set(value)
+            return self.numeric_bits(prop, lambda x: x in values)
+        if kind == "terms":
+            bits = 0
+            for val in value:
+                bits |= self.keyword_bits(prop, val)
+            return bits
+        if kind == "match_phrase" and prop in text_fields:
+            return self.phrase_bits(prop, value)
+
+        raise ValueError(f"clause not supported by the local index: {clause}")
+
+    #evaluate a query compiled by llm_utils.compile_standard_query and return the _source of the top hits
+    def search(self, query):
+        if isinstance(query, str):
+            query = json.loads(query)
+
+        bits = self.all_rows
+        for clause in query["query"]["bool"]["filter"]:
+            bits &= self.clause_bits(clause)
+            if not bits:
+                break
+
+        k = query.get("size", 10)
+        sort_field, order = next(iter(query["sort"][0].items()))
+        if sort_field == self.sort_field and order["order"] == "desc":
+            rows = []
+            for row in iter_rows(bits):
+                rows.append(row)
+                if len(rows) == k:
+                    break
+        else:
+            #partial sort of the matching rows on another property, the movies without value last as in opensearch
+            column = self.columns[sort_field]
+            rows = llm_utils.sort_by_value(iter_rows(bits), lambda row: column[row], descending=order["order"] == "desc", k=k)
+
+        includes = query.get("_source", {}).get("includes")
+        return [{prop: self.documents[row][prop] for prop in includes or self.documents[row] if prop in self.documents[row]} for row in rows]
+
+
+#local indexes per movies file (json lines of the typed dataset, see llm_utils.load_movies_cache), built once per process
+local_indexes = {}
+local_indexes_lock = threading.Lock()
+
+def get_local_index(path):
+    with local_indexes_lock:
+        if path not in local_indexes:
+            local_indexes[path] = LocalIndex(llm_utils.load_movies_cache(path).values())
+        return local_indexes[path]
+
+#same arguments and output as llm_utils.standard_query_opensearch, against the local index of the movies file
+def standard_query_local(prop_value_list, path, data_columns, k=10, projection="full"):
+    start = time.time()
+    query = llm_utils.compile_standard_query(prop_value_list, data_columns, k=k, schema=llm_utils.index_schema,
+                                             source=llm_utils.get_source_filter(projection, data_columns))
+    result = get_local_index(path).search(query)
+    metrics.put_metrics({"LocalSearchLatency": (time.time() - start) * 1000}, dimensions={"Backend": "local"}, unit="Milliseconds")
+    return result
@@ -0,0 +1,55 @@
+import json
+import os
+import threading
+import time
+
+#cloudwatch namespace of the metrics
+namespace = "ConversationalSearch"
+
+#in-process totals per (metric name, dimensions), used by the benchmarks and the local runs
+totals = {}
+lock = threading.Lock()
+
+#metrics are printed in the CloudWatch embedded metric format when running in lambda, CloudWatch extracts them from the logs
+emit_default = "AWS_LAMBDA_FUNCTION_NAME" in os.environ
+
+
+#add values ({metric name: value}) to the totals and emit them
+def put_metrics(values, dimensions=None, unit="Count", emit=None):
+    dimensions = dimensions or {}
+    key_dimensions = tuple(sorted(dimensions.items()))
+
+    with lock:
+        for name, value in values.items():
+            key = (name, key_dimensions)
+            totals[key] = totals.get(key, 0) + value
+
+    if emit if emit is not None else emit_default:
+        print(json.dumps({
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": namespace,
+                    "Dimensions": [list(dimensions.keys())],
+                    "Metrics": [{"Name": name, "Unit": unit} for name in values]
+                }]
+            },
+            **dimensions,
+            **values
+        }))
+
+#totals of a metric, summed over all dimensions unless dimensions are given
+def get_total(name, dimensions=None):
+    with lock:
+        if dimensions is not None:
+            return totals.get((name, tuple(sorted(dimensions.items()))), 0)
+        return sum(value for (metric, _), value in totals.items() if metric == name)
+
+#all the totals as a list of {"name", "dimensions", "value"}
+def get_totals():
+    with lock:
+        return [{"name": name, "dimensions": dict(dimensions), "value": value} for (name, dimensions), value in totals.items()]
+
+def reset_metrics():
+    with lock:
+        totals.clear()
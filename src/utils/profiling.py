@@ -0,0 +1,148 @@
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+
+try:
+    from utils import metrics
+except ImportError:
+    import metrics
+
+#Sampled profiling of the handlers and of ConversationalRetrievalChain.run, to see where the python time and memory go in one route.
+#A sampled invocation runs under cProfile and tracemalloc, a summary (top functions by cumulative time, peak memory and top
+#allocations) is printed as one json line, and the full profiles are written to PROFILING_OUTPUT when it is set.
+#When the profiling is off, the wrapper only checks the sample rate and the profile flag of the event before calling the function.
+#
+#PROFILING_SAMPLE: share of the invocations profiled (default 0, off)
+#PROFILING_EVENT_FLAG: "on" to profile the invocations whose event has "profile": true (default "on")
+#PROFILING_OUTPUT: destination of the full profiles, a folder or s3://bucket/prefix/ (default "", summary in the logs only)
+#PROFILING_TOP: number of functions and allocations in the summary (default 15)
+#PROFILING_MEMORY: "off" to only profile the cpu (default "on")
+#PROFILING_FRAMES: frames kept per allocation by tracemalloc (default 1)
+#
+#cProfile only sees the thread of the invocation, tracemalloc sees the whole process: in the service, the allocations of the
+#requests running at the same time are counted too. Only one invocation is profiled at a time, the others run as usual.
+
+sample_rate = float(os.environ.get("PROFILING_SAMPLE", "0"))
+event_flag = os.environ.get("PROFILING_EVENT_FLAG", "on") == "on"
+output_uri = os.environ.get("PROFILING_OUTPUT", "")
+top = int(os.environ.get("PROFILING_TOP", "15"))
+memory_enabled = os.environ.get("PROFILING_MEMORY", "on") == "on"
+frames = int(os.environ.get("PROFILING_FRAMES", "1"))
+
+#one profiled invocation at a time: cProfile and tracemalloc are shared by the threads of the process
+profile_lock = threading.Lock()
+
+
+#profiling requested by the event of a handler ({"profile": true})
+def requested(args):
+    return event_flag and bool(args) and isinstance(args[0], dict) and args[0].get("profile") is True
+
+def sampled():
+    return sample_rate > 0 and random.random() < sample_rate
+
+#top functions by cumulative time
+def cpu_summary(profiler):
+    stats = pstats.Stats(profiler, stream=io.StringIO())
+    functions = []
+    for (filename, line, name), (_, calls, tottime, cumtime, _) in stats.stats.items():
+        functions.append({"function": f"{os.path.basename(filename)}:{line}({name})", "calls": calls,
+                          "tottime_ms": round(tottime * 1000, 2), "cumtime_ms": round(cumtime * 1000, 2)})
+    functions.sort(key=lambda function: function["cumtime_ms"], reverse=True)
+    return functions[:top]
+
+#top allocations still alive at the end of the invocation, by size
+def memory_summary(snapshot):
+    allocations = []
+    for stat in snapshot.statistics("lineno")[:top]:
+        frame = stat.traceback[0]
+        allocations.append({"line": f"{os.path.basename(frame.filename)}:{frame.lineno}", "size_kb": round(stat.size / 1024, 1), "count": stat.count})
+    return allocations
+
+#write the cpu profile (pstats format, e.g. for snakeviz), the memory snapshot and the summary to the output folder or s3 prefix
+def write_profiles(name, profiler, snapshot, summary):
+    files = [f"{name}.prof", f"{name}.json"]
+    if snapshot is not None:
+        files.append(f"{name}.tracemalloc")
+
+    folder = tempfile.mkdtemp() if output_uri.startswith("s3://") else output_uri
+    os.makedirs(folder, exist_ok=True)
+    profiler.dump_stats(os.path.join(folder, f"{name}.prof"))
+    if snapshot is not None:
+        snapshot.dump(os.path.join(folder, f"{name}.tracemalloc"))
+    with open(os.path.join(folder, f"{name}.json"), "w") as file:
+        json.dump(summary, file, indent=2)
+
+    if output_uri.startswith("s3://"):
+        import boto3
+
+        bucket, _, prefix = output_uri[len("s3://"):].partition("/")
+        client = boto3.client("s3")
+        for filename in files:
+            path = os.path.join(folder, filename)
+            client.upload_file(path, bucket, f"{prefix}{filename}")
+            os.remove(path)
+        os.rmdir(folder)
+        return [f"s3://{bucket}/{prefix}{filename}" for filename in files]
+    return [os.path.join(folder, filename) for filename in files]
+
+def run_profiled(route, function, args, kwargs):
+    profiler = cProfile.Profile()
+    trace_memory = memory_enabled and not tracemalloc.is_tracing()
+    if trace_memory:
+        tracemalloc.start(frames)
+
+    start = time.time()
+    profiler.enable()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        profiler.disable()
+        duration_ms = (time.time() - start) * 1000
+        snapshot = None
+        peak = None
+        if trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        try:
+            summary = {"profile": route, "duration_ms": round(duration_ms, 2), "functions": cpu_summary(profiler)}
+            if snapshot is not None:
+                summary["peak_memory_kb"] = round(peak / 1024, 1)
+                summary["allocations"] = memory_summary(snapshot)
+            if output_uri:
+                name = f"{route.replace('/', '-')}-{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}-{uuid.uuid4().hex[:8]}"
+                summary["files"] = write_profiles(name, profiler, snapshot, summary)
+            print(json.dumps(summary))
+
+            values = {"ProfiledInvocations": 1}
+            if peak is not None:
+                values["ProfilePeakMemoryKb"] = peak / 1024
+            metrics.put_metrics(values, dimensions={"Route": route})
+        except Exception as e:
+            #the profiling never fails the invocation
+            print(f"profiling failed: {e}")
+
+
+#decorator of a lambda_handler or of a method, profiling the sampled or requested invocations
+def profile(route):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not (sampled() or requested(args)) or not profile_lock.acquire(blocking=False):
+                return function(*args, **kwargs)
+            try:
+                return run_profiled(route, function, args, kwargs)
+            finally:
+                profile_lock.release()
+        return wrapper
+    return decorator
@@ -0,0 +1,135 @@
+import json
+import os
+
+from botocore.exceptions import ClientError, ParamValidationError
+
+try:
+    from utils import metrics
+    from utils import rate_limit
+    from utils import single_flight
+    from utils import traffic_capture
+    from utils.deadline import get_bedrock_client
+except ImportError:
+    import metrics
+    import rate_limit
+    import single_flight
+    import traffic_capture
+    from deadline import get_bedrock_client
+
+#models supporting the prompt caching cache points of the converse API (the model id can have an inference profile prefix e.g. "us.").
+#anthropic.claude-3-haiku, the default model of the step lambdas, does not support prompt caching in bedrock: with the "auto" mode
+#its calls are sent without cache points, the caching is only active once the steps use one of these models (model_id of the events).
+cache_supported_models = [
+    "anthropic.claude-3-5-haiku",
+    "anthropic.claude-3-7-sonnet",
+    "anthropic.claude-sonnet-4",
+    "anthropic.claude-opus-4",
+    "amazon.nova-micro",
+    "amazon.nova-lite",
+    "amazon.nova-pro",
+]
+
+#prompt caching mode: "auto" uses cache points for the supported models only, "on" for all models, "off" never
+default_mode = os.environ.get("PROMPT_CACHE", "auto")
+
+#models that rejected the cache points in this process, called without cache points afterwards
+unsupported_models = set()
+
+#models called without cache points in "auto" mode, logged once per process
+inactive_models = set()
+
+cache_point = {"cachePoint": {"type": "default"}}
+
+
+#True if the cache points should be sent to this model
+def use_cache(model_id, mode=None):
+    mode = mode or default_mode
+    if mode == "off" or model_id in unsupported_models:
+        return False
+    if mode == "on":
+        return True
+    if any(model in model_id for model in cache_supported_models):
+        return True
+    if model_id not in inactive_models:
+        inactive_models.add(model_id)
+        print(f"prompt caching inactive for {model_id}: the model does not support cache points (PROMPT_CACHE=on to send them anyway)")
+    return False
+
+#system blocks: the prompt is sent as it is (no json encoding) followed by a cache point,
+#the dynamic part of the system prompt (e.g. retrieved documents) is sent after the cache point
+def system_blocks(system_prompt, cached=True, system_suffix=""):
+    blocks = [{"text": system_prompt}]
+    if cached:
+        blocks.append(cache_point)
+    if system_suffix:
+        blocks.append({"text": system_suffix})
+    return blocks
+
+#tool configuration with a cache point after the tool specifications
+def tool_config(tool_list, cached=True):
+    tools = list(tool_list)
+    if cached and tools:
+        tools.append(cache_point)
+    return {"tools": tools}
+
+#record the token usage of a converse response, including the tokens read from and written to the prompt cache
+def record_usage(response, model_id, route=""):
+    usage = response.get("usage", {})
+    metrics.put_metrics({
+        "InputTokens": usage.get("inputTokens", 0),
+        "OutputTokens": usage.get("outputTokens", 0),
+        "CacheReadInputTokens": usage.get("cacheReadInputTokens", 0),
+        "CacheWriteInputTokens": usage.get("cacheWriteInputTokens", 0),
+    }, dimensions={"Route": route, "ModelId": model_id})
+    return usage
+
+#converse call with the static system prompt and tools as cacheable prefixes.
+#if the model rejects the cache points, the call is sent again without them and the model is not cached anymore in this process.
+#timeout: read timeout in seconds (e.g. the remaining time of the deadline), the call then uses a client configured with it
+#deterministic calls (temperature 0) with the same request are sent once when they run at the same time (see single_flight)
+def converse(bedrock_client, modelId, messages, system_prompt="", tool_list=None, inferenceConfig=None, route="", mode=None, system_suffix="", timeout=None):
+    cached = use_cache(modelId, mode)
+    if timeout is not None:
+        bedrock_client = get_bedrock_client(timeout)
+
+    def call(cached):
+        request = {
+            "modelId": modelId,
+            "messages": messages,
+        }
+        if inferenceConfig:
+            request["inferenceConfig"] = inferenceConfig
+        if system_prompt:
+            request["system"] = system_blocks(system_prompt, cached, system_suffix)
+        if tool_list:
+            request["toolConfig"] = tool_config(tool_list, cached)
+        rate_limit.acquire(modelId)
+        return bedrock_client.converse(**request)
+
+    def call_with_fallback():
+        try:
+            response = call(cached)
+        except ParamValidationError as e:
+            #botocore older than the cache points of the converse API rejects them before sending the request
+            if not cached or "cachePoint" not in str(e):
+                raise
+            print(f"cache points not supported by this botocore version, calling {modelId} without cache points: {e}")
+            unsupported_models.add(modelId)
+            response = call(False)
+        except ClientError as e:
+            error = e.response.get("Error", {})
+            if not cached or error.get("Code") != "ValidationException" or "cach" not in error.get("Message", "").lower():
+                raise
+            print(f"prompt caching rejected by {modelId}, calling without cache points: {e}")
+            unsupported_models.add(modelId)
+            response = call(False)
+
+        record_usage(response, modelId, route)
+        return response
+
+    with traffic_capture.stage("llm"):
+        if (inferenceConfig or {}).get("temperature") != 0:
+            return call_with_fallback()
+
+        key = json.dumps([modelId, messages, system_prompt, system_suffix, tool_list, inferenceConfig, cached], sort_keys=True, default=str)
+        return single_flight.call("converse", key, call_with_fallback, timeout=timeout)
@@ -0,0 +1,74 @@
+import os
+import threading
+import time
+
+try:
+    from utils import metrics
+except ImportError:
+    import metrics
+
+#Client-side rate limits of the bedrock calls per model id, to stay under the account quotas when many calls run at the same time
+#(batch runs, load tests). The calls over the limit wait for their turn instead of being throttled by bedrock.
+#MODEL_RATE_LIMITS: requests per minute per model, e.g. "anthropic.claude-3-haiku-20240307-v1:0=1000,cohere.embed-english-v3=2000"
+#                   (no limit by default, "*" sets the limit of the models not listed)
+
+
+#token bucket: rate tokens per second up to burst, a call takes one token and waits when the bucket is empty
+class TokenBucket:
+
+    def __init__(self, requests_per_minute, burst=None) -> None:
+        self.rate = requests_per_minute / 60
+        self.burst = burst or max(1.0, self.rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    #take a token, return the time to wait before the call (the token is reserved, so the waiting calls keep their order)
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+#parse "model=rpm,model=rpm"
+def parse_limits(value):
+    limits = {}
+    for item in value.split(","):
+        if "=" in item:
+            model, limit = item.rsplit("=", 1)
+            limits[model.strip()] = float(limit)
+    return limits
+
+limits = parse_limits(os.environ.get("MODEL_RATE_LIMITS", ""))
+buckets = {}
+buckets_lock = threading.Lock()
+
+#set the limits (requests per minute per model id) of the process, the buckets are created again
+def configure(model_limits):
+    with buckets_lock:
+        limits.clear()
+        limits.update(model_limits)
+        buckets.clear()
+
+def get_bucket(model_id):
+    with buckets_lock:
+        if model_id not in buckets:
+            limit = limits.get(model_id, limits.get("*"))
+            buckets[model_id] = TokenBucket(limit) if limit else None
+        return buckets[model_id]
+
+#wait until a call to the model is allowed, returns the time waited in seconds
+def acquire(model_id):
+    if not limits:
+        return 0.0
+    bucket = get_bucket(model_id)
+    if bucket is None:
+        return 0.0
+    wait = bucket.reserve()
+    if wait > 0:
+        time.sleep(wait)
+        metrics.put_metrics({"RateLimitWaits": 1, "RateLimitWaitTime": wait * 1000}, dimensions={"ModelId": model_id})
+    return wait
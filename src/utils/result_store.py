@@ -0,0 +1,151 @@
+import gzip
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+#properties kept in the compact references passed between the states of the step function:
+#the id of the movie and the properties used for sorting
+reference_fields = ['tmdb_id', 'popularity', 'vote_average', 'year']
+
+#default time to live of the stored results, in seconds
+default_ttl = 3600
+
+
+#serialize and compress a list of documents
+def encode_documents(documents, compresslevel=6):
+    return gzip.compress(json.dumps(documents, separators=(",", ":")).encode("utf-8"), compresslevel=compresslevel)
+
+#decompress and deserialize a list of documents
+def decode_documents(payload):
+    return json.loads(gzip.decompress(payload).decode("utf-8"))
+
+
+#local stand-in of the result store backed by a sqlite file.
+#note that /tmp is not shared between lambda functions, use S3ResultStore when the states run in different lambdas.
+class SqliteResultStore:
+
+    #purge expired results every purge_every writes
+    purge_every = 100
+
+    def __init__(self, path="/tmp/result_store.db", compresslevel=6) -> None:
+        self.path = path
+        self.compresslevel = compresslevel
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, payload BLOB, expires_at REAL)")
+            self.connection.commit()
+
+    #store the documents and return their key
+    def put(self, documents, ttl=default_ttl):
+        key = uuid.uuid4().hex
+        with self.lock:
+            self.connection.execute("INSERT INTO results (key, payload, expires_at) VALUES (?, ?, ?)",
+                                    (key, encode_documents(documents, self.compresslevel), time.time() + ttl))
+            self.connection.commit()
+            self.writes += 1
+            if self.writes % self.purge_every == 0:
+                self._purge_expired()
+        return key
+
+    #return the documents stored under key, None if they don't exist or expired
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute("SELECT payload, expires_at FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return decode_documents(row[0])
+
+    def delete(self, key):
+        with self.lock:
+            self.connection.execute("DELETE FROM results WHERE key = ?", (key,))
+            self.connection.commit()
+
+    def purge_expired(self):
+        with self.lock:
+            self._purge_expired()
+
+    def _purge_expired(self):
+        self.connection.execute("DELETE FROM results WHERE expires_at < ?", (time.time(),))
+        self.connection.commit()
+
+
+#result store backed by Amazon S3.
+#the expiry is checked on read, add a lifecycle rule on the prefix to delete the objects (minimum 1 day).
+class S3ResultStore:
+
+    def __init__(self, bucket, prefix="results/", compresslevel=6, s3_client=None) -> None:
+        import boto3
+        self.bucket = bucket
+        self.prefix = prefix
+        self.compresslevel = compresslevel
+        self.s3_client = s3_client or boto3.client('s3')
+
+    #store the documents and return their key
+    def put(self, documents, ttl=default_ttl):
+        key = f"{self.prefix}{uuid.uuid4().hex}.json.gz"
+        self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=key,
+            Body=encode_documents(documents, self.compresslevel),
+            ContentType="application/json",
+            ContentEncoding="gzip",
+            Metadata={"expires-at": str(time.time() + ttl)}
+        )
+        return key
+
+    #return the documents stored under key, None if they don't exist or expired
+    def get(self, key):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=key)
+        except self.s3_client.exceptions.NoSuchKey:
+            return None
+
+        if float(response["Metadata"].get("expires-at", "inf")) < time.time():
+            return None
+        return decode_documents(response["Body"].read())
+
+    def delete(self, key):
+        self.s3_client.delete_object(Bucket=self.bucket, Key=key)
+
+
+#result stores per uri, created once per process
+stores = {}
+
+#return the result store for an uri: sqlite:///tmp/result_store.db or s3://bucket/prefix/
+def get_result_store(uri):
+    if uri not in stores:
+        if uri.startswith("sqlite://"):
+            stores[uri] = SqliteResultStore(path=uri[len("sqlite://"):])
+        elif uri.startswith("s3://"):
+            bucket, _, prefix = uri[len("s3://"):].partition("/")
+            stores[uri] = S3ResultStore(bucket, prefix=prefix)
+        else:
+            raise ValueError(f"unsupported result store {uri}, use sqlite://<path> or s3://<bucket>/<prefix>")
+    return stores[uri]
+
+#compact version of the documents: ids and sort properties only
+def compact(documents, fields=None):
+    fields = fields or reference_fields
+    return [{prop: doc.get(prop) for prop in fields} for doc in documents]
+
+#store the documents once and return (result_ref, compact documents)
+def store_results(uri, documents, ttl=default_ttl):
+    result_ref = get_result_store(uri).put(documents, ttl=ttl)
+    return result_ref, compact(documents)
+
+#return the full documents of the compact items, in the order of the items.
+#items are returned as they are if there is no reference.
+def resolve_results(uri, result_ref, items):
+    if not uri or not result_ref:
+        return items
+
+    documents = get_result_store(uri).get(result_ref)
+    if documents is None:
+        raise KeyError(f"result {result_ref} not found or expired in {uri}")
+
+    by_id = {doc.get("tmdb_id"): doc for doc in documents}
+    return [by_id.get(item.get("tmdb_id"), item) for item in items]
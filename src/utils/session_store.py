@@ -0,0 +1,284 @@
+import json
+import sqlite3
+import threading
+import time
+
+try:
+    from utils.deadline import call_timeouts, get_bedrock_client, min_time
+except ImportError:
+    from deadline import call_timeouts, get_bedrock_client, min_time
+
+#default number of messages loaded by the handlers (user and assistant messages)
+default_window = 10
+
+#tokens of the turns not yet summarized above which the oldest turns are compacted into the summary
+default_token_budget = 2000
+
+#properties of the movies kept in the answers stored in the session
+answer_fields = ['tmdb_id', 'original_title', 'year']
+
+#time to live of the sessions, in seconds
+default_ttl = 7 * 24 * 3600
+
+#system prompt used to compact the oldest turns of a conversation
+summary_system_prompt = """You are summarizing a conversation between a user and a movie finder assistant.
+Write a short summary of the conversation, merged with the previous summary if there is one.
+Keep the movie titles, the people names, the order of the lists returned to the user and the user preferences.
+Only return the summary."""
+
+
+#approximate number of tokens of a text (about 4 characters per token)
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+#converse message with a single text block
+def to_message(role, text):
+    return {"role": role, "content": [{"text": text}]}
+
+#text of a converse message
+def message_text(message):
+    return "".join(block.get("text", "") for block in message.get("content", []))
+
+#the converse API expects alternating user and assistant messages starting with a user message:
+#consecutive messages with the same role are merged
+def normalize_messages(messages):
+    result = []
+    for message in messages:
+        if result and result[-1]["role"] == message["role"]:
+            result[-1] = {"role": message["role"], "content": result[-1]["content"] + message["content"]}
+        else:
+            result.append({"role": message["role"], "content": list(message["content"])})
+
+    while result and result[0]["role"] != "user":
+        result.pop(0)
+    return result
+
+
+#local stand-in of the session store backed by sqlite, use sqlite://:memory: for an in-memory store.
+#note that /tmp is not shared between lambda functions, use DynamoDBSessionStore when the states run in different lambdas.
+class SqliteSessionStore:
+
+    def __init__(self, path="/tmp/session_store.db") -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS turns (seq INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT, role TEXT, text TEXT, tokens INTEGER, created_at REAL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS turns_session ON turns (session_id, seq)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS summaries (session_id TEXT PRIMARY KEY, summary TEXT, upto_seq INTEGER, tokens INTEGER)")
+            self.connection.commit()
+
+    #append converse messages to the session, turns are never updated
+    def append_turns(self, session_id, messages, ttl=default_ttl):
+        now = time.time()
+        rows = []
+        for message in messages:
+            text = message_text(message)
+            rows.append((session_id, message["role"], text, estimate_tokens(text), now))
+
+        with self.lock:
+            self.connection.executemany("INSERT INTO turns (session_id, role, text, tokens, created_at) VALUES (?, ?, ?, ?, ?)", rows)
+            self.connection.commit()
+
+    #turns after after_seq in chronological order, the last max_turns only if set
+    def load_turns(self, session_id, after_seq=0, max_turns=None):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT seq, role, text, tokens FROM turns WHERE session_id = ? AND seq > ? ORDER BY seq DESC LIMIT ?",
+                (session_id, after_seq, max_turns if max_turns is not None else -1)
+            ).fetchall()
+        return [{"seq": seq, "role": role, "text": text, "tokens": tokens} for seq, role, text, tokens in reversed(rows)]
+
+    #rolling summary of the session: {"summary", "upto_seq", "tokens"}
+    def get_summary(self, session_id):
+        with self.lock:
+            row = self.connection.execute("SELECT summary, upto_seq, tokens FROM summaries WHERE session_id = ?", (session_id,)).fetchone()
+        if row is None:
+            return {"summary": "", "upto_seq": 0, "tokens": 0}
+        return {"summary": row[0], "upto_seq": row[1], "tokens": row[2]}
+
+    def put_summary(self, session_id, summary, upto_seq, ttl=default_ttl):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO summaries (session_id, summary, upto_seq, tokens) VALUES (?, ?, ?, ?)",
+                                    (session_id, summary, upto_seq, estimate_tokens(summary)))
+            self.connection.commit()
+
+
+#session store backed by an Amazon DynamoDB table with the partition key session_id (string) and the sort key seq (number).
+#the summary is stored in the item with seq 0, enable the time to live on the expires_at attribute to expire the sessions.
+class DynamoDBSessionStore:
+
+    def __init__(self, table_name, dynamodb_resource=None) -> None:
+        import boto3
+        self.table_name = table_name
+        self.table = (dynamodb_resource or boto3.resource('dynamodb')).Table(table_name)
+
+    #append converse messages to the session, turns are never updated
+    def append_turns(self, session_id, messages, ttl=default_ttl):
+        #nanosecond timestamps keep the turns ordered without reading the last sequence number
+        seq = time.time_ns()
+        expires_at = int(time.time() + ttl)
+        with self.table.batch_writer() as batch:
+            for index, message in enumerate(messages):
+                text = message_text(message)
+                batch.put_item(Item={
+                    "session_id": session_id,
+                    "seq": seq + index,
+                    "role": message["role"],
+                    "text": text,
+                    "tokens": estimate_tokens(text),
+                    "expires_at": expires_at
+                })
+
+    #turns after after_seq in chronological order, the last max_turns only if set
+    def load_turns(self, session_id, after_seq=0, max_turns=None):
+        from boto3.dynamodb.conditions import Key
+
+        query = {
+            "KeyConditionExpression": Key("session_id").eq(session_id) & Key("seq").gt(after_seq),
+            "ScanIndexForward": False
+        }
+        if max_turns is not None:
+            query["Limit"] = max_turns
+
+        items = []
+        while True:
+            response = self.table.query(**query)
+            items.extend(response["Items"])
+            if "LastEvaluatedKey" not in response or (max_turns is not None and len(items) >= max_turns):
+                break
+            query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+        return [{"seq": int(item["seq"]), "role": item["role"], "text": item["text"], "tokens": int(item["tokens"])} for item in reversed(items)]
+
+    #rolling summary of the session: {"summary", "upto_seq", "tokens"}
+    def get_summary(self, session_id):
+        item = self.table.get_item(Key={"session_id": session_id, "seq": 0}).get("Item")
+        if item is None:
+            return {"summary": "", "upto_seq": 0, "tokens": 0}
+        return {"summary": item["summary"], "upto_seq": int(item["upto_seq"]), "tokens": int(item["tokens"])}
+
+    def put_summary(self, session_id, summary, upto_seq, ttl=default_ttl):
+        self.table.put_item(Item={
+            "session_id": session_id,
+            "seq": 0,
+            "summary": summary,
+            "upto_seq": upto_seq,
+            "tokens": estimate_tokens(summary),
+            "expires_at": int(time.time() + ttl)
+        })
+
+
+#session stores per uri, created once per process
+stores = {}
+
+#return the session store for an uri: sqlite:///tmp/session_store.db, sqlite://:memory: or dynamodb://table-name
+def get_session_store(uri):
+    if uri not in stores:
+        if uri.startswith("sqlite://"):
+            stores[uri] = SqliteSessionStore(path=uri[len("sqlite://"):])
+        elif uri.startswith("dynamodb://"):
+            stores[uri] = DynamoDBSessionStore(uri[len("dynamodb://"):])
+        else:
+            raise ValueError(f"unsupported session store {uri}, use sqlite://<path> or dynamodb://<table>")
+    return stores[uri]
+
+#index of the user message of the last exchange of the turns (0 without user message)
+def last_exchange_start(turns):
+    return next((index for index in range(len(turns) - 1, -1, -1) if turns[index]["role"] == "user"), 0)
+
+#converse messages of the session for a handler: the rolling summary followed by the last max_turns messages,
+#the oldest messages are dropped first to fit in max_tokens
+def load_window(store, session_id, max_turns=default_window, max_tokens=None):
+    summary = store.get_summary(session_id)
+    turns = store.load_turns(session_id, after_seq=summary["upto_seq"], max_turns=max_turns)
+
+    if max_tokens is not None:
+        #the last exchange is kept even when it is over the budget, the window always ends with an answer
+        budget = max_tokens - summary["tokens"]
+        last_exchange = last_exchange_start(turns)
+        while last_exchange > 0 and sum(turn["tokens"] for turn in turns) > budget:
+            turns.pop(0)
+            last_exchange -= 1
+
+    messages = []
+    if summary["summary"]:
+        messages.append(to_message("user", f"<conversation_summary>{summary['summary']}</conversation_summary>"))
+    messages.extend(to_message(turn["role"], turn["text"]) for turn in turns)
+
+    return normalize_messages(messages)
+
+#compact answer stored in the session: the message and the main properties of the movies returned
+def format_answer(message, search_output=None, fields=None):
+    fields = fields or answer_fields
+    return {"text": message, "Titles": [{prop: doc.get(prop) for prop in fields if prop in doc} for doc in (search_output or [])]}
+
+#append a question / answer exchange to the session, in the same format as BufferMemory
+def append_exchange(store, session_id, question, answer, ttl=default_ttl):
+    store.append_turns(session_id, [to_message("user", json.dumps(question)), to_message("assistant", json.dumps(answer))], ttl=ttl)
+
+#compact the oldest turns into the rolling summary once the turns not yet summarized exceed token_budget.
+#the most recent turns (up to half of the budget, at least the last exchange) are kept as they are, so the window loaded by
+#the handlers ends with an answer and the next question follows it.
+#summarize(previous_summary, messages) returns the new summary. returns True if the session was compacted.
+def compact_session(store, session_id, summarize, token_budget=default_token_budget):
+    summary = store.get_summary(session_id)
+    turns = store.load_turns(session_id, after_seq=summary["upto_seq"])
+
+    if sum(turn["tokens"] for turn in turns) <= token_budget:
+        return False
+
+    #keep the most recent turns, starting with a user message
+    kept_tokens = 0
+    split = len(turns)
+    while split > 0 and kept_tokens + turns[split - 1]["tokens"] <= token_budget // 2:
+        split -= 1
+        kept_tokens += turns[split]["tokens"]
+    while split < len(turns) and turns[split]["role"] != "user":
+        split += 1
+    split = min(split, last_exchange_start(turns))
+
+    older = turns[:split]
+    if not older:
+        return False
+
+    new_summary = summarize(summary["summary"], [to_message(turn["role"], turn["text"]) for turn in older])
+    store.put_summary(session_id, new_summary, older[-1]["seq"])
+    return True
+
+#append the exchange at the end of a turn and compact the session if it is over the token budget.
+#the compaction runs on the critical path of the turn: with a deadline, it is skipped when the time left is under
+#min_time["session_compaction"] (the session stays over the budget and is compacted at the end of a later turn) and the
+#summarize call is limited to the time left. A failed compaction does not fail the exchange, which is already stored.
+def record_exchange(store, session_id, question, answer, summarize, token_budget=default_token_budget, deadline=None, route=""):
+    append_exchange(store, session_id, question, answer)
+    if deadline is not None and not deadline.has_time(min_time["session_compaction"]):
+        deadline.record_fallback("skip_session_compaction", route=route)
+        return False
+    timeout = deadline.timeout(call_timeouts["llm"]) if deadline is not None else None
+    try:
+        return compact_session(store, session_id, lambda previous_summary, messages: summarize(previous_summary, messages, timeout=timeout),
+                               token_budget=token_budget)
+    except Exception as e:
+        print(f"could not compact session {session_id}: {e}")
+        if deadline is not None:
+            deadline.record_fallback("session_compaction_failed", route=route)
+        return False
+
+#summarize function calling a bedrock model through the converse API, the call is limited to timeout seconds when given
+def bedrock_summarizer(bedrock_client, model_id="anthropic.claude-3-haiku-20240307-v1:0"):
+    def summarize(previous_summary, messages, timeout=None):
+        conversation = "\n".join(f"{message['role']}: {message_text(message)}" for message in messages)
+        client = get_bedrock_client(timeout) if timeout is not None else bedrock_client
+        response = client.converse(
+            modelId=model_id,
+            messages=[to_message("user", f"<previous_summary>{previous_summary}</previous_summary>\n<conversation>{conversation}</conversation>")],
+            inferenceConfig={
+                "maxTokens": 500,
+                "temperature": 0,
+                "topP": 1
+            },
+            system=[{"text": summary_system_prompt}]
+        )
+        return response['output']['message']["content"][0]["text"]
+    return summarize
@@ -0,0 +1,156 @@
+import asyncio
+import copy
+import os
+import threading
+
+try:
+    from utils import metrics
+except ImportError:
+    import metrics
+
+#concurrent identical calls are merged into one upstream call: "on" (default) or "off"
+default_enabled = os.environ.get("SINGLE_FLIGHT", "on") == "on"
+
+
+#call in flight, shared by the leader running it and the waiters (threads or asyncio tasks)
+class Call:
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        #(loop, future) of the asyncio waiters
+        self.futures = []
+        self.waiters = 0
+
+    #the result is copied once before the waiters are released: the leader keeps the object it returns, and the copy
+    #only read by the waiters cannot be changed by the caller of the leader while it is copied again for each waiter
+    def finish(self, result, error):
+        self.result = copy.deepcopy(result) if error is None and self.waiters else None
+        self.error = error
+        self.done.set()
+        for loop, future in self.futures:
+            loop.call_soon_threadsafe(resolve_future, future)
+
+    #result for a waiter: its own copy, so that a waiter modifying it does not change the result of the others
+    def get(self):
+        if self.error is not None:
+            raise self.error
+        return copy.deepcopy(self.result)
+
+    #wait for the leader at most timeout seconds (None: no limit), raise TimeoutError after it
+    def wait(self, timeout=None):
+        if not self.done.wait(timeout):
+            raise TimeoutError(f"timed out after {timeout}s waiting for the call in flight")
+        return self.get()
+
+#the asyncio waiters are only woken up, each one gets its copy with Call.get
+def resolve_future(future):
+    if not future.done():
+        future.set_result(None)
+
+
+#merge the concurrent calls with the same key: the first caller runs the call, the others wait for its result (or its error)
+class SingleFlight:
+
+    def __init__(self, name) -> None:
+        self.name = name
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.executions = 0
+
+    #return (call, True) for the leader, (call, False) for a waiter
+    def join(self, key, future=None):
+        with self.lock:
+            self.requests += 1
+            call = self.calls.get(key)
+            if call is None:
+                call = Call()
+                self.calls[key] = call
+                self.executions += 1
+                return call, True
+            call.waiters += 1
+            if future is not None:
+                call.futures.append((asyncio.get_running_loop(), future))
+            return call, False
+
+    def leave(self, key, call, result, error):
+        with self.lock:
+            del self.calls[key]
+        call.finish(result, error)
+        metrics.put_metrics({"SingleFlightCalls": 1, "SingleFlightCoalesced": call.waiters}, dimensions={"Operation": self.name})
+
+    #run fn (no argument) once for all the concurrent callers with the same key
+    #timeout: time in seconds a waiter waits for the leader (e.g. the remaining time of its deadline), None for no limit
+    def do(self, key, fn, timeout=None):
+        call, leader = self.join(key)
+        if not leader:
+            return call.wait(timeout)
+
+        try:
+            result = fn()
+        except BaseException as e:
+            self.leave(key, call, None, e)
+            raise
+        self.leave(key, call, result, None)
+        return result
+
+    #asyncio version: fn returns an awaitable, the waiters do not block the event loop
+    async def do_async(self, key, fn, timeout=None):
+        future = asyncio.get_running_loop().create_future()
+        call, leader = self.join(key, future)
+        if not leader:
+            try:
+                await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"timed out after {timeout}s waiting for the call in flight")
+            return call.get()
+
+        try:
+            result = await fn()
+        except BaseException as e:
+            self.leave(key, call, None, e)
+            raise
+        self.leave(key, call, result, None)
+        return result
+
+    def stats(self):
+        with self.lock:
+            coalesced = self.requests - self.executions
+            return {
+                "operation": self.name,
+                "requests": self.requests,
+                "executions": self.executions,
+                "coalesced": coalesced,
+                "coalescing_ratio": coalesced / self.requests if self.requests else 0.0,
+                "in_flight": len(self.calls),
+            }
+
+
+#single flight groups per operation
+groups = {}
+groups_lock = threading.Lock()
+
+def get_group(name):
+    with groups_lock:
+        if name not in groups:
+            groups[name] = SingleFlight(name)
+        return groups[name]
+
+#run fn once for the concurrent calls of the operation with the same key, if enabled (default: SINGLE_FLIGHT environment variable)
+#timeout: time in seconds the waiters wait for the call in flight, usually the timeout of the call itself
+def call(name, key, fn, enabled=None, timeout=None):
+    if not (default_enabled if enabled is None else enabled):
+        return fn()
+    return get_group(name).do(key, fn, timeout=timeout)
+
+async def call_async(name, key, fn, enabled=None, timeout=None):
+    if not (default_enabled if enabled is None else enabled):
+        return await fn()
+    return await get_group(name).do_async(key, fn, timeout=timeout)
+
+#coalescing ratio of each operation
+def get_stats():
+    with groups_lock:
+        return [group.stats() for group in groups.values()]
@@ -0,0 +1,190 @@
+import contextlib
+import functools
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import uuid
+
+#Opt-in capture of the handler events, to replay the production traffic against the local stand-ins (see src/service/replay.py).
+#Each captured invocation is one json line: route, sanitized event, duration, status and the timings of its stages
+#(llm, embedding and search calls). The events are sanitized: prompts, tool lists, history and documents are replaced by
+#their size, the opensearch host and index are dropped and the session ids are hashed.
+#
+#TRAFFIC_CAPTURE: destination, a jsonl file path or s3://bucket/prefix/ (capture off when empty, the default)
+#TRAFFIC_CAPTURE_SAMPLE: share of the invocations captured (default 1)
+#TRAFFIC_CAPTURE_REDACT: "on" to replace the questions by their hash (default "off")
+#TRAFFIC_CAPTURE_BATCH: records per object written to s3 (default 1 in lambda, every record is written at the end of its
+#                       invocation as a frozen or shut down environment would lose the buffer, 50 in the service)
+
+capture_uri = os.environ.get("TRAFFIC_CAPTURE", "")
+sample_rate = float(os.environ.get("TRAFFIC_CAPTURE_SAMPLE", "1"))
+redact_questions = os.environ.get("TRAFFIC_CAPTURE_REDACT", "off") == "on"
+batch_size = int(os.environ.get("TRAFFIC_CAPTURE_BATCH", "1" if "AWS_LAMBDA_FUNCTION_NAME" in os.environ else "50"))
+
+#parameters of the events kept as they are
+kept_parameters = ["number_results", "projection", "filter_mode", "k", "history_window", "text_profile", "search_backend", "time_budget_ms",
+                   "apiPath", "httpMethod"]
+
+#record of the invocation running in the thread, None when it is not captured
+local = threading.local()
+
+
+def hash_value(value):
+    return hashlib.sha256(str(value).encode("utf-8")).hexdigest()[:16]
+
+def sanitize_question(question):
+    return {"hash": hash_value(question), "chars": len(question)} if redact_questions else question
+
+#event without prompts, documents, infrastructure names nor session ids
+def sanitize(event):
+    sanitized = {key: event[key] for key in kept_parameters if key in event}
+    if "question" in event:
+        sanitized["question"] = sanitize_question(event["question"])
+    if "history" in event:
+        sanitized["history_length"] = len(event["history"] or [])
+    if "list_to_sort" in event:
+        sanitized["list_length"] = len(event["list_to_sort"] or [])
+    if "tool_list" in event:
+        sanitized["tools"] = [tool.get("toolSpec", {}).get("name") for tool in event["tool_list"] or []]
+    if event.get("session_id"):
+        sanitized["session"] = hash_value(event["session_id"])
+    #the deadline (epoch milliseconds) is replayed as the time left when the invocation started
+    if isinstance(event.get("deadline"), (int, float)) and "time_budget_ms" not in sanitized:
+        sanitized["time_budget_ms"] = max(0, int(event["deadline"] - time.time() * 1000))
+
+    prompts = {key: len(value) for key, value in event.items() if (key.startswith("system_prompt") or key == "prefill") and isinstance(value, str)}
+    if prompts:
+        sanitized["prompt_chars"] = prompts
+
+    #parameters of the bedrock agent events, the question is sanitized as the question of the step function events
+    if isinstance(event.get("parameters"), list):
+        sanitized["parameters"] = {param.get("name"): sanitize_question(param.get("value", "")) if param.get("name") == "question" else param.get("value")
+                                   for param in event["parameters"]}
+    return sanitized
+
+def status_of(result):
+    if not isinstance(result, dict):
+        return None
+    if "statusCode" in result:
+        return result["statusCode"]
+    return result.get("response", {}).get("httpStatusCode")
+
+
+#record the duration of a stage (e.g. "llm", "embedding", "search") of the captured invocation running in the thread
+@contextlib.contextmanager
+def stage(name):
+    record = getattr(local, "record", None)
+    if record is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        record["stages"].setdefault(name, []).append(round((time.time() - start) * 1000, 2))
+
+
+#collect the stage timings of the calls made in the thread, captured or not, e.g. by the batch runner (service/batch.py):
+#with traffic_capture.collect() as stages: ... -> {"llm": [ms, ...], "search": [...]}
+@contextlib.contextmanager
+def collect():
+    previous = getattr(local, "record", None)
+    local.record = {"stages": {}}
+    try:
+        yield local.record["stages"]
+    finally:
+        local.record = previous
+
+
+class FileWriter:
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, default=str) + "\n"
+        with self.lock:
+            with open(self.path, "a") as file:
+                file.write(line)
+
+    def flush(self):
+        pass
+
+
+#records buffered and written as one jsonl object per batch: s3://bucket/prefix/<date>/<uuid>.jsonl
+class S3Writer:
+
+    def __init__(self, uri, batch_size=batch_size) -> None:
+        import boto3
+
+        self.bucket, _, self.prefix = uri[len("s3://"):].partition("/")
+        self.batch_size = batch_size
+        self.client = boto3.client("s3")
+        self.buffer = []
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        with self.lock:
+            self.buffer.append(json.dumps(record, default=str))
+            if len(self.buffer) < self.batch_size:
+                return
+            lines, self.buffer = self.buffer, []
+        self.put(lines)
+
+    def flush(self):
+        with self.lock:
+            lines, self.buffer = self.buffer, []
+        if lines:
+            self.put(lines)
+
+    def put(self, lines):
+        key = f"{self.prefix}{time.strftime('%Y/%m/%d/%H', time.gmtime())}/{uuid.uuid4().hex}.jsonl"
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=("\n".join(lines) + "\n").encode("utf-8"))
+
+
+writers = {}
+writers_lock = threading.Lock()
+
+def get_writer(uri):
+    with writers_lock:
+        if uri not in writers:
+            writers[uri] = S3Writer(uri) if uri.startswith("s3://") else FileWriter(uri)
+        return writers[uri]
+
+
+#decorator of a lambda_handler capturing its invocations when TRAFFIC_CAPTURE is set
+def capture(route):
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            if not capture_uri or random.random() >= sample_rate:
+                return handler(event, context)
+
+            record = {"ts": time.time(), "route": route, "event": sanitize(event), "stages": {}}
+            previous = getattr(local, "record", None)
+            local.record = record
+            start = time.time()
+            status = "error"
+            try:
+                result = handler(event, context)
+                status = status_of(result)
+                return result
+            finally:
+                local.record = previous
+                #the stages are also kept by the record of the caller (e.g. collect)
+                if previous is not None:
+                    for name, durations in record["stages"].items():
+                        previous["stages"].setdefault(name, []).extend(durations)
+                record["duration_ms"] = round((time.time() - start) * 1000, 2)
+                record["status"] = status
+                try:
+                    get_writer(capture_uri).write(record)
+                except Exception as e:
+                    #the capture never fails the invocation
+                    print(f"traffic capture failed: {e}")
+        return wrapper
+    return decorator